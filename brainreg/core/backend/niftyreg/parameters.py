@@ -1,5 +1,10 @@
 from .niftyreg_binaries import get_binary
 
+# "freeform": a second, independent reg_f3d run from sample to atlas
+# "invert": numerically invert the forward transform with reg_transform
+# "symmetric": a single symmetric reg_f3d run producing both directions
+INVERSE_METHODS = ("freeform", "invert", "symmetric")
+
 
 class RegistrationParams:
     """
@@ -20,6 +25,7 @@ class RegistrationParams:
         smoothing_sigma_floating=-1.0,
         histogram_n_bins_floating=128,
         histogram_n_bins_reference=128,
+        inverse_method="freeform",
     ):
         self.transform_program_path = self.__get_binary("transform")
         self.affine_reg_program_path = self.__get_binary("affine")
@@ -56,6 +62,14 @@ class RegistrationParams:
         # segmentation (reg_resample)
         self.segmentation_interpolation_order = ("-inter", 0)
 
+        # how the sample to atlas transform is obtained
+        if inverse_method not in INVERSE_METHODS:
+            raise ValueError(
+                f"Inverse method: {inverse_method} is not recognised. "
+                f"Valid methods are: {INVERSE_METHODS}"
+            )
+        self.inverse_method = inverse_method
+
     def get_affine_reg_params(self):
         """
         Get the parameters (options) required for the affine registration step
@@ -3,6 +3,8 @@ from brainglobe_utils.general.numerical import (
     check_positive_int,
 )
 
+from brainreg.core.backend.niftyreg.parameters import INVERSE_METHODS
+
 
 def niftyreg_parse(parser):
     niftyreg_opt_parser = parser.add_argument_group(
@@ -120,4 +122,17 @@ def niftyreg_parse(parser):
         "for the calculation of Normalized Mutual Information on the "
         "reference image",
     )
+    niftyreg_opt_parser.add_argument(
+        "--inverse-method",
+        dest="inverse_method",
+        type=str,
+        default="freeform",
+        choices=INVERSE_METHODS,
+        help="How the inverse (sample to atlas) transform is generated. "
+        "'freeform' runs a second freeform registration from the sample to "
+        "the atlas. 'invert' numerically inverts the forward transform, "
+        "which is much faster than a second registration. 'symmetric' "
+        "runs a single symmetric freeform registration that estimates "
+        "both directions at once.",
+    )
     return parser
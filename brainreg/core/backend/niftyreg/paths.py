@@ -57,6 +57,13 @@ class NiftyRegPaths:
         self.inverse_control_point_file_path = self.make_reg_path(
             "inverse_control_point_file.nii"
         )
+        # written by reg_f3d alongside the forward grid in symmetric mode
+        self.backward_control_point_file_path = self.make_reg_path(
+            "control_point_file_backward.nii"
+        )
+        self.inverse_deformation_field = self.make_reg_path(
+            "inverse_deformation_field.nii"
+        )
 
         self.deformation_field = self.make_reg_path("deformation_field.nii")
         (
@@ -88,6 +95,10 @@ class NiftyRegPaths:
             self.invert_affine_log_file,
             self.invert_affine_error_file,
         ) = self.compute_reg_log_file_paths("invert_affine")
+        (
+            self.invert_freeform_log_file,
+            self.invert_freeform_error_file,
+        ) = self.compute_reg_log_file_paths("invert_freeform")
 
     def make_reg_path(self, basename):
         """
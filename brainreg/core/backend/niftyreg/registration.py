@@ -95,6 +95,10 @@ class BrainRegistration(object):
             self.paths.freeform_registered_atlas_brain_path,
         ]
 
+        if self.reg_params.inverse_method == "symmetric":
+            # velocity field parametrisation, also saves the backward grid
+            cmd.append("-vel")
+
         if self.n_processes is not None:
             cmd.extend(self.openmp_flag)
 
@@ -121,8 +125,31 @@ class BrainRegistration(object):
             )
 
     def generate_inverse_transforms(self):
-        self.generate_inverse_affine()
-        self.register_inverse_freeform()
+        """
+        Generate the transforms needed to move images from sample space to
+        standard space, using the method set in the registration parameters.
+        In symmetric mode, the backward transform has already been
+        estimated by the freeform registration.
+        """
+        if self.reg_params.inverse_method == "freeform":
+            self.generate_inverse_affine()
+            self.register_inverse_freeform()
+        elif self.reg_params.inverse_method == "invert":
+            self.invert_freeform()
+
+    @property
+    def inverse_transform_path(self):
+        """
+        The transform used to resample sample space images into standard
+        space. Depending on the inverse method, this is either a control
+        point grid or a deformation field.
+        """
+        if self.reg_params.inverse_method == "invert":
+            return self.paths.inverse_deformation_field
+        elif self.reg_params.inverse_method == "symmetric":
+            return self.paths.backward_control_point_file_path
+        else:
+            return self.paths.inverse_control_point_file_path
 
     def _prepare_invert_affine_cmd(self):
         return [
@@ -197,6 +224,39 @@ class BrainRegistration(object):
                 "Inverse freeform registration failed; {}".format(err)
             )
 
+    def _prepare_invert_freeform_cmd(self):
+        return [
+            self.reg_params.transform_program_path,
+            "-ref",
+            self.dataset_img_path,
+            "-invNrr",
+            self.paths.control_point_file_path,
+            self.brain_of_atlas_img_path,
+            self.paths.inverse_deformation_field,
+        ]
+
+    def invert_freeform(self):
+        """
+        Numerically inverts the freeform (atlas to sample) transform using
+        nifty_reg reg_transform. The result is a deformation field defined
+        in atlas space, which avoids a second freeform registration.
+
+        :return:
+        :raises RegistrationError: If any error was detected during the
+            inversion.
+        """
+        logging.debug("Inverting freeform transform")
+        try:
+            safe_execute_command(
+                self._prepare_invert_freeform_cmd(),
+                self.paths.invert_freeform_log_file,
+                self.paths.invert_freeform_error_file,
+            )
+        except SafeExecuteCommandError as err:
+            raise RegistrationError(
+                "Inversion of freeform transform failed; {}".format(err)
+            )
+
     def _prepare_segmentation_cmd(self, floating_image_path, dest_img_path):
         return [
             self.reg_params.segmentation_program_path,
@@ -218,7 +278,7 @@ class BrainRegistration(object):
             self.reg_params.segmentation_program_path,
             *self.reg_params.format_segmentation_params().split(),
             "-cpp",
-            self.paths.inverse_control_point_file_path,
+            self.inverse_transform_path,
             "-flo",
             floating_image_path,
             "-ref",
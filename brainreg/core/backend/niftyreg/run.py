@@ -1,20 +1,47 @@
 import logging
 import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from glob import glob
 from pathlib import Path
 
 import brainglobe_space as bg
 import numpy as np
 from brainglobe_atlasapi import BrainGlobeAtlas
 from brainglobe_utils.general.system import delete_directory_contents
-from brainglobe_utils.image.scale import scale_and_convert_to_16_bits
 from brainglobe_utils.IO.image.load import load_any
-from brainglobe_utils.IO.image.save import to_tiff
 
 from brainreg.core.backend.niftyreg.parameters import RegistrationParams
 from brainreg.core.backend.niftyreg.paths import NiftyRegPaths
 from brainreg.core.backend.niftyreg.registration import BrainRegistration
-from brainreg.core.backend.niftyreg.utils import save_nii
+from brainreg.core.backend.niftyreg.transform_bundle import (
+    save_transform_bundle,
+)
+from brainreg.core.backend.niftyreg.utils import (
+    load_nii,
+    load_nii_memmap,
+    save_nii,
+)
+from brainreg.core.paths import resolve_outputs
 from brainreg.core.utils import preprocess
+from brainreg.core.utils.artifacts import ArtifactStore
+from brainreg.core.utils.deformation import (
+    deformation_field_scales,
+    save_deformation_field,
+    save_deformation_field_component,
+    save_jacobian_determinant,
+)
+from brainreg.core.utils.image_io import load_image
+from brainreg.core.utils.intensity import RegionIndex, calculate_intensities
+from brainreg.core.utils.labels import (
+    remove_labels_lookup,
+    save_labels_lookup,
+    to_compact_labels,
+)
+from brainreg.core.utils.memory import MemoryBudget
+from brainreg.core.utils.qc import calculate_qc_metrics, save_qc_metrics
+from brainreg.core.utils.writer import AsyncWriter
 
 
 def crop_atlas(atlas, brain_geometry):
@@ -32,29 +59,100 @@ def crop_atlas(atlas, brain_geometry):
     return atlas_cropped
 
 
-def run_niftyreg(
-    registration_output_folder,
+@contextmanager
+def intermediate_directory(
+    registration_output_folder, scratch_directory=None, debug=False
+):
+    """
+    Provide a directory for the intermediate niftyreg files.
+
+    By default, this is the "niftyreg" directory in the output folder, which
+    is deleted on success unless debug is True. If a scratch directory is
+    given (e.g. /dev/shm or a local disk), a new directory is made there and
+    always deleted afterwards. In debug mode its contents are first copied
+    to the output folder, and on failure the niftyreg logs are copied, so
+    that errors can be investigated.
+
+    :param registration_output_folder: brainreg output folder
+    :param scratch_directory: Where to make the intermediate directory
+    :param bool debug: If True, keep the intermediate files
+    """
+    output_directory = os.path.join(registration_output_folder, "niftyreg")
+    if scratch_directory is None:
+        yield output_directory
+        if not debug:
+            logging.info("Deleting intermediate niftyreg files")
+            delete_directory_contents(output_directory)
+            os.rmdir(output_directory)
+        return
+
+    os.makedirs(scratch_directory, exist_ok=True)
+    niftyreg_directory = tempfile.mkdtemp(
+        prefix="brainreg_niftyreg_", dir=scratch_directory
+    )
+    logging.debug(
+        f"Saving intermediate niftyreg files to {niftyreg_directory}"
+    )
+    try:
+        yield niftyreg_directory
+        if debug:
+            logging.info("Copying intermediate niftyreg files")
+            shutil.copytree(
+                niftyreg_directory, output_directory, dirs_exist_ok=True
+            )
+    except BaseException:
+        os.makedirs(output_directory, exist_ok=True)
+        for log_path in glob(os.path.join(niftyreg_directory, "*.log")) + glob(
+            os.path.join(niftyreg_directory, "*.err")
+        ):
+            shutil.copy(log_path, output_directory)
+        raise
+    finally:
+        shutil.rmtree(niftyreg_directory, ignore_errors=True)
+
+
+def delete_intermediate_files(*file_paths):
+    """
+    Delete intermediate files that are no longer needed, to limit the space
+    used while registration is running.
+
+    :param file_paths: Files to delete (if they exist)
+    """
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def prepare_niftyreg_inputs(
+    niftyreg_paths,
     paths,
     atlas,
     target_brain,
-    n_processes,
-    additional_images_downsample,
-    DATA_ORIENTATION,
-    ATLAS_ORIENTATION,
-    niftyreg_args,
     preprocessing_args,
-    scaling,
-    load_parallel,
-    sort_input_file,
-    n_free_cpus,
-    debug=False,
-    save_original_orientation=False,
     brain_geometry="full",
+    memory_budget=None,
+    writer=None,
 ):
-    niftyreg_directory = os.path.join(registration_output_folder, "niftyreg")
-
-    niftyreg_paths = NiftyRegPaths(niftyreg_directory)
-
+    """
+    Save the (filtered) atlas and sample images needed for registration.
+    These only depend on the data and the atlas, so can be reused by any
+    number of registrations with different parameters.
+
+    :param NiftyRegPaths niftyreg_paths: Where to save the niftyreg inputs
+    :param Paths paths: brainreg output paths
+    :param atlas: BrainGlobeAtlas
+    :param np.ndarray target_brain: Downsampled sample image, in the atlas
+        orientation
+    :param preprocessing_args: Pre-processing options
+    :param str brain_geometry: "full", "hemisphere_l" or "hemisphere_r"
+    :param MemoryBudget memory_budget: Optional memory limit for filtering
+    :param AsyncWriter writer: Writer for the downsampled tiff. If None, it
+        is written immediately.
+    :return: The filtered sample image
+    :rtype: np.ndarray
+    """
     if brain_geometry != "full":
         atlas_cropped = crop_atlas(atlas, brain_geometry)
         save_nii(
@@ -62,28 +160,83 @@ def run_niftyreg(
             atlas.resolution,
             niftyreg_paths.annotations,
         )
-        reference = preprocess.filter_image(atlas_cropped.reference)
+        reference = preprocess.filter_image(
+            atlas_cropped.reference, memory_budget=memory_budget
+        )
     else:
         save_nii(
             atlas.annotation, atlas.resolution, niftyreg_paths.annotations
         )
-        reference = preprocess.filter_image(atlas.reference)
+        reference = preprocess.filter_image(
+            atlas.reference, memory_budget=memory_budget
+        )
 
     save_nii(atlas.hemispheres, atlas.resolution, niftyreg_paths.hemispheres)
     save_nii(reference, atlas.resolution, niftyreg_paths.brain_filtered)
+    del reference
     save_nii(target_brain, atlas.resolution, niftyreg_paths.downsampled_brain)
 
-    to_tiff(
-        scale_and_convert_to_16_bits(target_brain),
-        paths.downsampled_brain_path,
+    if writer is None:
+        writer = AsyncWriter(n_threads=0)
+    writer.write_tiff(
+        preprocess.scale_to_uint16(target_brain), paths.downsampled_brain_path
     )
 
-    target_brain = preprocess.filter_image(target_brain, preprocessing_args)
+    # the unfiltered image has been saved, so can be overwritten
+    target_brain = preprocess.filter_image(
+        target_brain,
+        preprocessing_args,
+        memory_budget=memory_budget,
+        in_place=True,
+    )
     save_nii(
         target_brain, atlas.resolution, niftyreg_paths.downsampled_filtered
     )
 
-    logging.info("Registering")
+    return target_brain
+
+
+def run_niftyreg(
+    registration_output_folder,
+    paths,
+    atlas,
+    target_brain,
+    n_processes,
+    additional_images_downsample,
+    DATA_ORIENTATION,
+    ATLAS_ORIENTATION,
+    niftyreg_args,
+    preprocessing_args,
+    scaling,
+    load_parallel,
+    sort_input_file,
+    n_free_cpus,
+    debug=False,
+    save_original_orientation=False,
+    brain_geometry="full",
+    memory_budget=None,
+    scratch_directory=None,
+    outputs=None,
+    artifacts=None,
+    compact_labels=False,
+):
+    outputs = resolve_outputs(outputs)
+    if memory_budget is None:
+        memory_budget = MemoryBudget()
+    # outputs are written in the background, unless a store is passed in
+    # (whose writer is flushed by the caller)
+    own_writer = artifacts is None
+    if own_writer:
+        artifacts = ArtifactStore(
+            AsyncWriter(n_threads=0 if memory_budget.limited else 2),
+            keep_in_memory=not memory_budget.limited,
+        )
+    writer = artifacts.writer
+
+    def load_result(src_path, dtype=None):
+        # niftyreg results are memory-mapped, and with a memory limit, read
+        # lazily. Otherwise they are read into memory in a single copy.
+        return load_nii(src_path, dtype=dtype, lazy=memory_budget.limited)
 
     registration_params = RegistrationParams(
         affine_n_steps=niftyreg_args.affine_n_steps,
@@ -96,145 +249,327 @@ def run_niftyreg(
         smoothing_sigma_floating=niftyreg_args.smoothing_sigma_floating,
         histogram_n_bins_floating=niftyreg_args.histogram_n_bins_floating,
         histogram_n_bins_reference=niftyreg_args.histogram_n_bins_reference,
-    )
-    brain_reg = BrainRegistration(
-        niftyreg_paths, registration_params, n_processes=n_processes
+        inverse_method=niftyreg_args.inverse_method,
     )
 
-    logging.info("Starting affine registration")
-    brain_reg.register_affine()
+    with intermediate_directory(
+        registration_output_folder,
+        scratch_directory=scratch_directory,
+        debug=debug,
+    ) as niftyreg_directory:
+        niftyreg_paths = NiftyRegPaths(niftyreg_directory)
+
+        target_brain = prepare_niftyreg_inputs(
+            niftyreg_paths,
+            paths,
+            atlas,
+            target_brain,
+            preprocessing_args,
+            brain_geometry=brain_geometry,
+            memory_budget=memory_budget,
+            writer=writer,
+        )
 
-    logging.info("Starting freeform registration")
-    brain_reg.register_freeform()
+        logging.info("Registering")
 
-    logging.info("Starting segmentation")
-    brain_reg.segment()
+        brain_reg = BrainRegistration(
+            niftyreg_paths, registration_params, n_processes=n_processes
+        )
 
-    logging.info("Segmenting hemispheres")
-    brain_reg.register_hemispheres()
+        def delete_if_not_debug(*file_paths):
+            if not debug:
+                delete_intermediate_files(*file_paths)
 
-    logging.info("Generating inverse (sample to atlas) transforms")
-    brain_reg.generate_inverse_transforms()
+        logging.info("Starting affine registration")
+        brain_reg.register_affine()
+        delete_if_not_debug(niftyreg_paths.affine_registered_atlas_brain_path)
 
-    logging.info("Transforming image to standard space")
-    brain_reg.transform_to_standard_space(
-        niftyreg_paths.downsampled_brain,
-        niftyreg_paths.downsampled_brain_standard_space,
-    )
+        logging.info("Starting freeform registration")
+        brain_reg.register_freeform()
 
-    logging.info("Generating deformation field")
-    brain_reg.generate_deformation_field(niftyreg_paths.deformation_field)
+        logging.info("Starting segmentation")
+        brain_reg.segment()
+        delete_if_not_debug(niftyreg_paths.annotations)
 
-    logging.info("Exporting images as tiff")
-    to_tiff(
-        load_any(niftyreg_paths.registered_atlas_path).astype(
-            np.uint32, copy=False
-        ),
-        paths.registered_atlas,
-    )
+        if "hemispheres" in outputs:
+            logging.info("Segmenting hemispheres")
+            brain_reg.register_hemispheres()
+        delete_if_not_debug(niftyreg_paths.hemispheres)
 
-    if save_original_orientation:
-        registered_atlas = load_any(
-            niftyreg_paths.registered_atlas_path
-        ).astype(np.uint32, copy=False)
-        atlas_remapped = bg.map_stack_to(
-            ATLAS_ORIENTATION, DATA_ORIENTATION, registered_atlas
-        ).astype(np.uint32, copy=False)
-        to_tiff(atlas_remapped, paths.registered_atlas_original_orientation)
-
-    to_tiff(
-        load_any(niftyreg_paths.registered_hemispheres_img_path).astype(
-            np.uint8, copy=False
-        ),
-        paths.registered_hemispheres,
-    )
-    to_tiff(
-        load_any(niftyreg_paths.downsampled_brain_standard_space).astype(
-            np.uint16, copy=False
-        ),
-        paths.downsampled_brain_standard_space,
-    )
+        if "downsampled_standard" in outputs:
+            logging.info("Generating inverse (sample to atlas) transforms")
+            brain_reg.generate_inverse_transforms()
 
-    del reference
-    del target_brain
+        logging.info("Saving transforms")
+        save_transform_bundle(
+            niftyreg_paths,
+            paths.transform_directory,
+            registration_params.inverse_method,
+            save_inverse="downsampled_standard" in outputs,
+        )
+        delete_if_not_debug(
+            niftyreg_paths.affine_matrix_path,
+            niftyreg_paths.invert_affine_matrix_path,
+            niftyreg_paths.inverse_freeform_registered_atlas_brain_path,
+        )
 
-    deformation_image = load_any(niftyreg_paths.deformation_field)
-    to_tiff(
-        deformation_image[..., 0, 0].astype(np.float32, copy=False),
-        paths.deformation_field_0,
-    )
-    to_tiff(
-        deformation_image[..., 0, 1].astype(np.float32, copy=False),
-        paths.deformation_field_1,
-    )
-    to_tiff(
-        deformation_image[..., 0, 2].astype(np.float32, copy=False),
-        paths.deformation_field_2,
-    )
+        if "downsampled_standard" in outputs:
+            logging.info("Transforming image to standard space")
+            brain_reg.transform_to_standard_space(
+                niftyreg_paths.downsampled_brain,
+                niftyreg_paths.downsampled_brain_standard_space,
+            )
 
-    if additional_images_downsample:
-        logging.info("Saving additional downsampled images")
-        for name, filename in additional_images_downsample.items():
-            logging.info(f"Processing: {name}")
+        if "deformation_field" in outputs:
+            logging.info("Generating deformation field")
+            brain_reg.generate_deformation_field(
+                niftyreg_paths.deformation_field
+            )
+        delete_if_not_debug(
+            niftyreg_paths.control_point_file_path,
+            niftyreg_paths.downsampled_filtered,
+        )
 
-            name_to_save = (
-                Path(name).stem
-                if name.lower().endswith((".tiff", ".tif"))
-                else name
+        logging.info("Exporting images as tiff")
+        registered_atlas = load_result(
+            niftyreg_paths.registered_atlas_path, dtype=np.uint32
+        )
+        # QC uses the atlas IDs, the saved image may be compact
+        atlas_image, labels_lookup = registered_atlas, None
+        if compact_labels:
+            atlas_image, labels_lookup = to_compact_labels(registered_atlas)
+        atlas_image_paths = [paths.registered_atlas]
+        artifacts.put(paths.registered_atlas, atlas_image)
+
+        if save_original_orientation:
+            # a view of the atlas, written plane by plane
+            atlas_remapped = bg.map_stack_to(
+                ATLAS_ORIENTATION, DATA_ORIENTATION, atlas_image
             )
+            writer.write_tiff(
+                atlas_remapped, paths.registered_atlas_original_orientation
+            )
+            del atlas_remapped
+            atlas_image_paths.append(
+                paths.registered_atlas_original_orientation
+            )
+
+        for atlas_image_path in atlas_image_paths:
+            if labels_lookup is None:
+                remove_labels_lookup(atlas_image_path)
+            else:
+                save_labels_lookup(labels_lookup, atlas_image_path)
 
-            downsampled_brain_path = os.path.join(
-                registration_output_folder, f"downsampled_{name_to_save}.tiff"
+        registered_hemispheres = None
+        if "hemispheres" in outputs:
+            registered_hemispheres = load_result(
+                niftyreg_paths.registered_hemispheres_img_path, dtype=np.uint8
             )
-            tmp_downsampled_brain_path = os.path.join(
-                niftyreg_paths.niftyreg_directory,
-                f"downsampled_{name_to_save}.nii",
+            artifacts.put(paths.registered_hemispheres, registered_hemispheres)
+
+        # indexed once, and used for every channel, and for the Jacobian
+        # determinant
+        region_index = None
+        if {"intensities", "jacobian"} & outputs:
+            region_index = RegionIndex(
+                atlas_image,
+                registered_hemispheres,
+                labels_lookup=labels_lookup,
             )
-            downsampled_brain_standard_path = os.path.join(
-                registration_output_folder,
-                f"downsampled_standard_{name_to_save}.tiff",
+        if "intensities" in outputs:
+            logging.info("Calculating intensity of each brain area")
+            # the downsampled data, converted to uint16 as the additional
+            # channels are, rather than downsampled.tiff, which is rescaled
+            # to the full uint16 range, so that all channels are comparable
+            calculate_intensities(
+                atlas,
+                region_index,
+                load_result(niftyreg_paths.downsampled_brain, dtype=np.uint16),
+                paths.intensities_csv_path,
             )
-            tmp_downsampled_brain_standard_path = os.path.join(
-                niftyreg_paths.niftyreg_directory,
-                f"downsampled_standard_{name_to_save}.nii",
+        delete_if_not_debug(niftyreg_paths.downsampled_brain)
+        del atlas_image
+
+        if "downsampled_standard" in outputs:
+            writer.write_tiff(
+                load_result(
+                    niftyreg_paths.downsampled_brain_standard_space,
+                    dtype=np.uint16,
+                ),
+                paths.downsampled_brain_standard_space,
             )
+        delete_if_not_debug(niftyreg_paths.downsampled_brain_standard_space)
 
-            # do the tiff part at the beginning
-            downsampled_brain = load_any(
-                filename,
-                scaling[1],
-                scaling[2],
-                scaling[0],
-                load_parallel=load_parallel,
-                sort_input_file=sort_input_file,
-                n_free_cpus=n_free_cpus,
+        deformation_field = None
+        if "deformation_field" in outputs:
+            logging.info("Saving deformation field")
+            niftyreg_deformation_field = load_nii_memmap(
+                niftyreg_paths.deformation_field
             )
-
-            downsampled_brain = bg.map_stack_to(
-                DATA_ORIENTATION, ATLAS_ORIENTATION, downsampled_brain
-            ).astype(np.uint16, copy=False)
-
-            save_nii(
-                downsampled_brain, atlas.resolution, tmp_downsampled_brain_path
+            field_shape = niftyreg_deformation_field.shape
+            # the strided slab read from the nifti, and the reshaped copy
+            field_slab_size = memory_budget.slab_size(
+                field_shape[0],
+                2 * 4 * 3 * int(np.prod(field_shape[1:3])),
+                default=16,
             )
-
-            to_tiff(downsampled_brain, downsampled_brain_path)
-
-            logging.info("Transforming to standard space")
-
-            brain_reg.transform_to_standard_space(
-                tmp_downsampled_brain_path, tmp_downsampled_brain_standard_path
+            save_deformation_field(
+                niftyreg_deformation_field,
+                paths.deformation_field,
+                slab_size=field_slab_size,
+            )
+            del niftyreg_deformation_field
+            delete_if_not_debug(niftyreg_paths.deformation_field)
+            deformation_field = np.load(paths.deformation_field, mmap_mode="r")
+
+        if "jacobian" in outputs:
+            logging.info("Calculating Jacobian determinant")
+            save_jacobian_determinant(
+                deformation_field,
+                deformation_field_scales(atlas.resolution),
+                paths.jacobian_determinant,
+                # the padded slab, its gradients, and the Jacobian
+                slab_size=memory_budget.slab_size(
+                    field_shape[0],
+                    4 * 16 * int(np.prod(field_shape[1:3])),
+                    default=16,
+                ),
+            )
+            calculate_intensities(
+                atlas,
+                region_index,
+                load_image(paths.jacobian_determinant, lazy=True),
+                paths.jacobian_csv_path,
+                value_name="jacobian",
             )
 
-            to_tiff(
-                load_any(tmp_downsampled_brain_standard_path).astype(
-                    np.uint16, copy=False
+        if "qc" in outputs:
+            logging.info("Calculating registration quality metrics")
+            # the metrics are calculated in slabs, so only read the image
+            # as it is needed
+            qc_metrics = calculate_qc_metrics(
+                load_nii_memmap(
+                    niftyreg_paths.freeform_registered_atlas_brain_path
                 ),
-                downsampled_brain_standard_path,
+                target_brain,
+                registered_atlas,
+                registered_hemispheres,
+                deformation_field,
+                atlas.resolution,
+                ATLAS_ORIENTATION,
+                memory_budget=memory_budget,
             )
-        del atlas
+            save_qc_metrics(qc_metrics, paths.qc_metrics_path)
+        # with a memory limit, these are memory-mapped from the niftyreg
+        # results, which can only be deleted once they are no longer used
+        # (e.g. on Windows)
+        del target_brain, registered_atlas, registered_hemispheres
+        delete_if_not_debug(
+            niftyreg_paths.registered_atlas_img_path,
+            niftyreg_paths.registered_hemispheres_img_path,
+            niftyreg_paths.freeform_registered_atlas_brain_path,
+        )
 
-    if not debug:
-        logging.info("Deleting intermediate niftyreg files")
-        delete_directory_contents(niftyreg_directory)
-        os.rmdir(niftyreg_directory)
+        if "deformation_field_tiffs" in outputs:
+            for component, dest_path in enumerate(
+                (
+                    paths.deformation_field_0,
+                    paths.deformation_field_1,
+                    paths.deformation_field_2,
+                )
+            ):
+                writer.write(
+                    save_deformation_field_component,
+                    deformation_field,
+                    dest_path,
+                    component=component,
+                    slab_size=field_slab_size,
+                )
+        del deformation_field
+
+        if additional_images_downsample:
+            logging.info("Saving additional downsampled images")
+            for name, filename in additional_images_downsample.items():
+                logging.info(f"Processing: {name}")
+
+                name_to_save = (
+                    Path(name).stem
+                    if name.lower().endswith((".tiff", ".tif"))
+                    else name
+                )
+
+                downsampled_brain_path = os.path.join(
+                    registration_output_folder,
+                    f"downsampled_{name_to_save}.tiff",
+                )
+                tmp_downsampled_brain_path = os.path.join(
+                    niftyreg_paths.niftyreg_directory,
+                    f"downsampled_{name_to_save}.nii",
+                )
+                downsampled_brain_standard_path = os.path.join(
+                    registration_output_folder,
+                    f"downsampled_standard_{name_to_save}.tiff",
+                )
+                tmp_downsampled_brain_standard_path = os.path.join(
+                    niftyreg_paths.niftyreg_directory,
+                    f"downsampled_standard_{name_to_save}.nii",
+                )
+
+                # do the tiff part at the beginning
+                downsampled_brain = load_any(
+                    filename,
+                    scaling[1],
+                    scaling[2],
+                    scaling[0],
+                    load_parallel=load_parallel,
+                    sort_input_file=sort_input_file,
+                    n_free_cpus=n_free_cpus,
+                )
+
+                # a view, unless the image needs converting to uint16
+                downsampled_brain = bg.map_stack_to(
+                    DATA_ORIENTATION, ATLAS_ORIENTATION, downsampled_brain
+                ).astype(np.uint16, copy=False)
+
+                save_nii(
+                    downsampled_brain,
+                    atlas.resolution,
+                    tmp_downsampled_brain_path,
+                )
+
+                writer.write_tiff(downsampled_brain, downsampled_brain_path)
+
+                if "intensities" in outputs:
+                    calculate_intensities(
+                        atlas,
+                        region_index,
+                        downsampled_brain,
+                        os.path.join(
+                            registration_output_folder,
+                            f"intensities_{name_to_save}.csv",
+                        ),
+                    )
+
+                if "downsampled_standard" in outputs:
+                    logging.info("Transforming to standard space")
+
+                    brain_reg.transform_to_standard_space(
+                        tmp_downsampled_brain_path,
+                        tmp_downsampled_brain_standard_path,
+                    )
+
+                    writer.write_tiff(
+                        load_result(
+                            tmp_downsampled_brain_standard_path,
+                            dtype=np.uint16,
+                        ),
+                        downsampled_brain_standard_path,
+                    )
+                delete_if_not_debug(
+                    tmp_downsampled_brain_path,
+                    tmp_downsampled_brain_standard_path,
+                )
+            del atlas
+
+    if own_writer:
+        writer.close()
@@ -0,0 +1,566 @@
+"""
+transform_bundle
+================
+
+Compact storage of the transforms estimated by niftyreg. Rather than (or as
+well as) a dense deformation field, the reg_f3d control point grids and
+the reg_aladin affine matrices are kept, and the deformation is evaluated
+from the grid on demand, for arbitrary points or sub-volumes. A control
+point grid is typically around a thousand times smaller than the dense
+field.
+
+A bundle is a directory holding:
+
+- ``control_point_file.nii``: forward (atlas to sample) grid, defined on
+  the downsampled sample
+- ``affine_matrix.txt``: forward affine matrix
+- ``inverse_control_point_file.nii``: inverse (sample to atlas) grid,
+  defined on the atlas, if it was estimated
+- ``invert_affine_matrix.txt``: inverse affine matrix, if it was estimated
+- ``transform.json``: the geometry of the images each grid is defined on
+
+The grids are saved unchanged, so can also be used directly by niftyreg
+(e.g. ``reg_resample -trans``).
+
+Symmetric registration (``reg_f3d -vel``) saves velocity field grids, which
+niftyreg integrates to give the deformation. These are evaluated densely,
+once, with ``reg_transform -def``, and then interpolated.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import nibabel as nib
+import numpy as np
+from brainglobe_utils.general.system import (
+    SafeExecuteCommandError,
+    safe_execute_command,
+)
+from scipy.ndimage import map_coordinates
+
+from brainreg.core.backend.niftyreg.niftyreg_binaries import get_binary
+from brainreg.core.backend.niftyreg.registration import TransformationError
+
+FORWARD_GRID = "control_point_file.nii"
+FORWARD_AFFINE = "affine_matrix.txt"
+INVERSE_GRID = "inverse_control_point_file.nii"
+INVERSE_AFFINE = "invert_affine_matrix.txt"
+METADATA = "transform.json"
+
+# niftyreg transformation types (stored in intent_p1 of the grid header)
+CUBIC_SPLINE_GRID = 2
+SPLINE_VELOCITY_GRID = 5
+
+# grid coordinates are rounded before finding the preceding control point,
+# so that positions on a control point (e.g. 0.99999993, from a float32
+# affine) are not placed in the previous interval, or outside the grid
+GRID_COORDINATE_DECIMALS = 6
+
+
+def cubic_bspline_weights(t):
+    """
+    Weights of the four control points around each position.
+
+    :param np.ndarray t: Position relative to the preceding control point,
+        in grid spacings (between 0 and 1)
+    :return: Array of shape (..., 4)
+    :rtype: np.ndarray
+    """
+    t2 = t * t
+    t3 = t2 * t
+    return np.stack(
+        (
+            (1 - t) ** 3 / 6,
+            (3 * t3 - 6 * t2 + 4) / 6,
+            (-3 * t3 + 3 * t2 + 3 * t + 1) / 6,
+            t3 / 6,
+        ),
+        axis=-1,
+    )
+
+
+def _axis_weights(coordinates, n_control_points):
+    """
+    Cubic B-spline weights of every control point along one axis, for a
+    regular set of positions along that axis.
+
+    :param np.ndarray coordinates: Positions, in grid spacings
+    :param int n_control_points: Number of control points along the axis
+    :return: Array of shape (len(coordinates), n_control_points). Rows of
+        positions outside the support of the grid are NaN.
+    :rtype: np.ndarray
+    """
+    coordinates = np.round(coordinates, GRID_COORDINATE_DECIMALS)
+    first = np.floor(coordinates).astype(np.int64) - 1
+    weights = cubic_bspline_weights(coordinates - (first + 1))
+    matrix = np.zeros((len(coordinates), n_control_points))
+    rows = np.arange(len(coordinates))
+    outside = (first < 0) | (first + 3 >= n_control_points)
+    for offset in range(4):
+        index = np.clip(first + offset, 0, n_control_points - 1)
+        matrix[rows, index] = weights[:, offset]
+    matrix[outside] = np.nan
+    return matrix
+
+
+class ReferenceTransform:
+    """
+    A transform giving, for each voxel of a reference image, the
+    corresponding position (in mm) in a floating image. Subclasses evaluate
+    it at arbitrary points (``transform``) and densely, on a sub-volume of
+    the reference image (``deformation_field``).
+
+    :param np.ndarray reference_affine: Voxel to mm affine of the reference
+        image
+    :param reference_shape: Shape of the reference image
+    """
+
+    def __init__(self, reference_affine, reference_shape):
+        self.reference_affine = np.asarray(reference_affine, dtype=np.float64)
+        self.reference_shape = tuple(int(n) for n in reference_shape)
+
+    def reference_positions(self, points):
+        """
+        :param np.ndarray points: N x 3 reference voxel coordinates
+        :return: N x 3 positions of the points in the reference image, in mm
+        :rtype: np.ndarray
+        """
+        points = np.asarray(points, dtype=np.float64)
+        return (
+            points @ self.reference_affine[:3, :3].T
+            + self.reference_affine[:3, 3]
+        )
+
+    def displacement(self, points):
+        """
+        :param np.ndarray points: N x 3 reference voxel coordinates
+        :return: N x 3 displacement of each point, in mm
+        :rtype: np.ndarray
+        """
+        return self.transform(points) - self.reference_positions(points)
+
+    def iter_deformation_field(self, slab_size=16):
+        """
+        Evaluate the whole deformation field, one slab (along the first
+        axis) at a time.
+
+        :param int slab_size: Number of planes per slab
+        :return: Generator of (start, stop, slab) for each slab
+        """
+        n_planes = self.reference_shape[0]
+        for start in range(0, n_planes, slab_size):
+            stop = min(start + slab_size, n_planes)
+            yield start, stop, self.deformation_field(
+                (start, 0, 0), (stop, *self.reference_shape[1:])
+            )
+
+
+def _check_points(points):
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise ValueError(f"Points must be an N x 3 array, not {points.shape}")
+    return points
+
+
+class ControlPointGrid(ReferenceTransform):
+    """
+    A cubic B-spline transform, as estimated by reg_f3d. For each voxel of
+    the reference image, it gives the corresponding position (in mm) in
+    the floating image.
+
+    :param np.ndarray coefficients: (X, Y, Z, 3) control point positions,
+        in mm
+    :param np.ndarray grid_affine: Voxel to mm affine of the control points
+    :param np.ndarray reference_affine: Voxel to mm affine of the reference
+        image
+    :param reference_shape: Shape of the reference image
+    """
+
+    def __init__(
+        self, coefficients, grid_affine, reference_affine, reference_shape
+    ):
+        super().__init__(reference_affine, reference_shape)
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.grid_affine = np.asarray(grid_affine, dtype=np.float64)
+        # reference voxels to grid coordinates
+        self._voxel_to_grid = (
+            np.linalg.inv(self.grid_affine) @ self.reference_affine
+        )
+
+    @classmethod
+    def from_nifti(cls, grid_path, reference_affine, reference_shape):
+        """
+        Load a control point grid saved by reg_f3d.
+
+        :param grid_path: Path of the grid
+        :param reference_affine: Voxel to mm affine of the reference image
+        :param reference_shape: Shape of the reference image
+        :return: ControlPointGrid
+        :raises ValueError: If the grid is not a cubic B-spline grid (e.g. a
+            velocity field grid, see ``load_transform``)
+        """
+        grid = nib.load(str(grid_path))
+        transformation_type = int(grid.header["intent_p1"])
+        if transformation_type != CUBIC_SPLINE_GRID:
+            raise ValueError(
+                f"{grid_path} is not a cubic B-spline control point grid "
+                f"(niftyreg transformation type {transformation_type})"
+            )
+        coefficients = np.asarray(grid.dataobj, dtype=np.float64)
+        coefficients = coefficients.reshape(*coefficients.shape[:3], 3)
+        return cls(
+            coefficients, grid.affine, reference_affine, reference_shape
+        )
+
+    def _to_grid(self, points):
+        return (
+            points @ self._voxel_to_grid[:3, :3].T + self._voxel_to_grid[:3, 3]
+        )
+
+    def transform(self, points):
+        """
+        Evaluate the transform at arbitrary points.
+
+        :param np.ndarray points: N x 3 reference voxel coordinates
+        :return: N x 3 corresponding positions in the floating image, in mm.
+            Points outside the support of the grid are NaN.
+        :rtype: np.ndarray
+        """
+        points = _check_points(points)
+        grid_points = np.round(self._to_grid(points), GRID_COORDINATE_DECIMALS)
+        first = np.floor(grid_points).astype(np.int64) - 1
+        weights = cubic_bspline_weights(grid_points - (first + 1))
+        grid_shape = np.array(self.coefficients.shape[:3])
+        outside = np.any((first < 0) | (first + 3 >= grid_shape), axis=1)
+        first = np.clip(first, 0, grid_shape - 4)
+
+        positions = np.zeros(points.shape, dtype=np.float64)
+        for i in range(4):
+            for j in range(4):
+                weight_ij = weights[:, 0, i] * weights[:, 1, j]
+                for k in range(4):
+                    weight = weight_ij * weights[:, 2, k]
+                    control_points = self.coefficients[
+                        first[:, 0] + i, first[:, 1] + j, first[:, 2] + k
+                    ]
+                    positions += weight[:, np.newaxis] * control_points
+        positions[outside] = np.nan
+        return positions
+
+    def deformation_field(self, start=None, stop=None):
+        """
+        Evaluate the transform densely, on the voxels of a sub-volume of the
+        reference image. This gives the same result as
+        ``reg_transform -def``, for only the voxels needed.
+
+        :param start: First voxel of the sub-volume (default: origin)
+        :param stop: End of the sub-volume, exclusive (default: the shape of
+            the reference image)
+        :return: (X, Y, Z, 3) float32 array of positions in the floating
+            image, in mm
+        :rtype: np.ndarray
+        """
+        start = (0, 0, 0) if start is None else start
+        stop = self.reference_shape if stop is None else stop
+        if not np.allclose(
+            self._voxel_to_grid[:3, :3],
+            np.diag(np.diag(self._voxel_to_grid[:3, :3])),
+        ):
+            # not separable along the voxel axes
+            indices = np.stack(
+                np.meshgrid(
+                    *[np.arange(a, b) for a, b in zip(start, stop)],
+                    indexing="ij",
+                ),
+                axis=-1,
+            )
+            return (
+                self.transform(indices.reshape(-1, 3))
+                .reshape(*indices.shape)
+                .astype(np.float32)
+            )
+
+        # the B-spline is a tensor product, so apply the weights of each
+        # axis in turn
+        field = self.coefficients
+        for axis in range(3):
+            coordinates = (
+                np.arange(start[axis], stop[axis])
+                * self._voxel_to_grid[axis, axis]
+                + self._voxel_to_grid[axis, 3]
+            )
+            weights = _axis_weights(coordinates, field.shape[axis])
+            field = np.moveaxis(
+                np.tensordot(weights, field, axes=(1, axis)), 0, axis
+            )
+        return field.astype(np.float32)
+
+
+class DenseDeformationField(ReferenceTransform):
+    """
+    A transform given by its deformation field, i.e. the position (in mm) in
+    the floating image of every voxel of the reference image. Between
+    voxels, the field is interpolated linearly, as by niftyreg.
+
+    :param np.ndarray field: (X, Y, Z, 3) deformation field
+    :param np.ndarray reference_affine: Voxel to mm affine of the reference
+        image
+    """
+
+    def __init__(self, field, reference_affine):
+        super().__init__(reference_affine, np.shape(field)[:3])
+        self.field = field
+
+    @classmethod
+    def from_velocity_grid(cls, grid_path, reference_affine, reference_shape):
+        """
+        Evaluate a velocity field grid, saved by symmetric registration,
+        with ``reg_transform -def``.
+
+        :param grid_path: Path of the grid
+        :param reference_affine: Voxel to mm affine of the reference image
+        :param reference_shape: Shape of the reference image
+        :return: DenseDeformationField
+        :raises TransformationError: If niftyreg failed
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            reference_path = os.path.join(directory, "reference.nii")
+            field_path = os.path.join(directory, "deformation_field.nii")
+            # only the geometry of the reference image is used
+            nib.save(
+                nib.Nifti1Image(
+                    np.zeros(reference_shape, dtype=np.uint8),
+                    np.asarray(reference_affine),
+                ),
+                reference_path,
+            )
+            try:
+                safe_execute_command(
+                    [
+                        str(get_binary("reg_transform")),
+                        "-ref",
+                        reference_path,
+                        "-def",
+                        str(grid_path),
+                        field_path,
+                    ],
+                    os.path.join(directory, "reg_transform.log"),
+                    os.path.join(directory, "reg_transform.err"),
+                )
+            except SafeExecuteCommandError as err:
+                raise TransformationError(
+                    f"Could not evaluate {grid_path}; {err}"
+                )
+            field = np.asarray(
+                nib.load(field_path).dataobj, dtype=np.float32
+            ).reshape(*reference_shape, 3)
+        return cls(field, reference_affine)
+
+    def transform(self, points):
+        """
+        Interpolate the deformation field at arbitrary points.
+
+        :param np.ndarray points: N x 3 reference voxel coordinates
+        :return: N x 3 corresponding positions in the floating image, in mm.
+            Points outside the reference image are NaN.
+        :rtype: np.ndarray
+        """
+        points = _check_points(points)
+        coordinates = np.ascontiguousarray(points.T)
+        positions = np.empty(points.shape, dtype=np.float64)
+        for axis in range(3):
+            positions[:, axis] = map_coordinates(
+                self.field[..., axis],
+                coordinates,
+                order=1,
+                mode="constant",
+                cval=np.nan,
+            )
+        return positions
+
+    def deformation_field(self, start=None, stop=None):
+        """
+        :param start: First voxel of the sub-volume (default: origin)
+        :param stop: End of the sub-volume, exclusive (default: the shape of
+            the reference image)
+        :return: (X, Y, Z, 3) float32 array of positions in the floating
+            image, in mm
+        :rtype: np.ndarray
+        """
+        start = (0, 0, 0) if start is None else start
+        stop = self.reference_shape if stop is None else stop
+        return np.array(
+            self.field[tuple(slice(a, b) for a, b in zip(start, stop))],
+            dtype=np.float32,
+        )
+
+
+def get_transformation_type(grid_path):
+    """
+    :param grid_path: Path of a grid saved by reg_f3d
+    :return: niftyreg transformation type (e.g. ``CUBIC_SPLINE_GRID``)
+    :rtype: int
+    """
+    return int(nib.load(str(grid_path)).header["intent_p1"])
+
+
+def load_transform(grid_path, reference_affine, reference_shape):
+    """
+    Load a grid saved by reg_f3d: a cubic B-spline grid, which is evaluated
+    directly, or a velocity field grid, which is evaluated densely by
+    niftyreg.
+
+    :param grid_path: Path of the grid
+    :param reference_affine: Voxel to mm affine of the reference image
+    :param reference_shape: Shape of the reference image
+    :return: ControlPointGrid or DenseDeformationField
+    :rtype: ReferenceTransform
+    """
+    if get_transformation_type(grid_path) == SPLINE_VELOCITY_GRID:
+        return DenseDeformationField.from_velocity_grid(
+            grid_path, reference_affine, reference_shape
+        )
+    return ControlPointGrid.from_nifti(
+        grid_path, reference_affine, reference_shape
+    )
+
+
+class TransformBundle:
+    """
+    The transforms saved by a registration (see ``save_transform_bundle``).
+
+    :param str directory: Bundle directory
+    """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        with open(os.path.join(self.directory, METADATA)) as f:
+            self.metadata = json.load(f)
+        self._forward = None
+        self._inverse = None
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @property
+    def has_inverse(self):
+        return self.metadata["inverse"] is not None
+
+    @property
+    def affine(self):
+        """
+        Forward affine matrix (4 x 4).
+        """
+        return np.loadtxt(self._path(FORWARD_AFFINE))
+
+    @property
+    def inverse_affine(self):
+        """
+        Inverse affine matrix (4 x 4), or None if it was not estimated.
+        """
+        path = self._path(INVERSE_AFFINE)
+        if not os.path.exists(path):
+            return None
+        return np.loadtxt(path)
+
+    @property
+    def forward(self):
+        """
+        Atlas to sample transform, mapping downsampled sample voxels to atlas
+        positions (in mm).
+
+        :rtype: ReferenceTransform
+        """
+        if self._forward is None:
+            self._forward = load_transform(
+                self._path(FORWARD_GRID),
+                self.metadata["reference"]["affine"],
+                self.metadata["reference"]["shape"],
+            )
+        return self._forward
+
+    @property
+    def inverse(self):
+        """
+        Sample to atlas transform, mapping atlas voxels to downsampled sample
+        positions (in mm), or None if it was not estimated.
+
+        :rtype: ReferenceTransform
+        """
+        if not self.has_inverse:
+            return None
+        if self._inverse is None:
+            self._inverse = load_transform(
+                self._path(INVERSE_GRID),
+                self.metadata["floating"]["affine"],
+                self.metadata["floating"]["shape"],
+            )
+        return self._inverse
+
+
+def _image_geometry(image_path):
+    image = nib.load(str(image_path))
+    return {
+        "shape": [int(n) for n in image.shape[:3]],
+        "affine": image.affine.tolist(),
+    }
+
+
+def save_transform_bundle(
+    niftyreg_paths, bundle_directory, inverse_method, save_inverse=True
+):
+    """
+    Copy the control point grids and affine matrices estimated by niftyreg
+    to a transform bundle.
+
+    :param NiftyRegPaths niftyreg_paths: niftyreg intermediate files
+    :param bundle_directory: Where to save the bundle
+    :param str inverse_method: How the inverse transform was estimated
+        ("freeform", "invert" or "symmetric")
+    :param bool save_inverse: Whether the inverse transform was estimated
+    """
+    os.makedirs(bundle_directory, exist_ok=True)
+    shutil.copyfile(
+        niftyreg_paths.control_point_file_path,
+        os.path.join(bundle_directory, FORWARD_GRID),
+    )
+    shutil.copyfile(
+        niftyreg_paths.affine_matrix_path,
+        os.path.join(bundle_directory, FORWARD_AFFINE),
+    )
+
+    inverse_grid = None
+    if save_inverse:
+        if inverse_method == "freeform":
+            inverse_grid = niftyreg_paths.inverse_control_point_file_path
+            shutil.copyfile(
+                niftyreg_paths.invert_affine_matrix_path,
+                os.path.join(bundle_directory, INVERSE_AFFINE),
+            )
+        elif inverse_method == "symmetric":
+            inverse_grid = niftyreg_paths.backward_control_point_file_path
+        # the numerical inverse is a dense deformation field, so there is
+        # no compact inverse to keep
+    if inverse_grid is not None:
+        shutil.copyfile(
+            inverse_grid, os.path.join(bundle_directory, INVERSE_GRID)
+        )
+    else:
+        for filename in (INVERSE_GRID, INVERSE_AFFINE):
+            try:
+                os.remove(os.path.join(bundle_directory, filename))
+            except FileNotFoundError:
+                pass
+
+    metadata = {
+        "inverse_method": inverse_method,
+        "inverse": None if inverse_grid is None else INVERSE_GRID,
+        # the downsampled sample, on which the forward grid is defined
+        "reference": _image_geometry(niftyreg_paths.downsampled_filtered),
+        # the atlas, on which the inverse grid is defined
+        "floating": _image_geometry(niftyreg_paths.brain_filtered),
+    }
+    with open(os.path.join(bundle_directory, METADATA), "w") as f:
+        json.dump(metadata, f, indent=4)
@@ -1,26 +1,52 @@
+import nibabel as nib
 import numpy as np
-from brainglobe_utils.IO.image.save import to_nii
 
 
-def save_nii(stack, atlas_pixel_sizes, dest_path):
+def save_nii(stack, atlas_pixel_sizes, dest_path, slab_size=16):
     """
-    Save self.target_brain to dest_path as a nifti image.
-    The scale (zooms of the output nifti image) is copied from the atlas
-    brain.
+    Save an image to dest_path as an uncompressed nifti image. The scale
+    (zooms of the output nifti image) is copied from the atlas brain.
 
+    The header is written first, and the image data is then copied into a
+    memory map of the file, a slab (along the last axis, which is
+    contiguous on disk) at a time. No full-size copy of the image is made,
+    so the image can itself be a view or a memory map.
+
+    :param np.ndarray stack: Image to save
+    :param atlas_pixel_sizes: Atlas voxel sizes in um
     :param str dest_path: Where to save the image on the filesystem
+    :param int slab_size: Number of planes copied at once
     """
     transformation_matrix = get_transf_matrix_from_res(atlas_pixel_sizes)
-    to_nii(
-        stack,
+    # a header for an image of this shape and type, without the data
+    image = nib.Nifti1Image(
+        np.broadcast_to(np.zeros((), dtype=stack.dtype), stack.shape),
+        transformation_matrix,
+    )
+    image.header.set_zooms(
+        tuple(pixel_size / 1000 for pixel_size in atlas_pixel_sizes[:3])
+    )
+    image.update_header()
+    header = image.header
+    header.set_data_offset(352)
+
+    with open(dest_path, "wb") as f:
+        header.write_to(f)
+        f.truncate(header.get_data_offset() + stack.nbytes)
+    data = np.memmap(
         dest_path,
-        scale=(
-            atlas_pixel_sizes[0] / 1000,
-            atlas_pixel_sizes[1] / 1000,
-            atlas_pixel_sizes[2] / 1000,
-        ),
-        affine_transform=transformation_matrix,
+        mode="r+",
+        dtype=header.get_data_dtype(),
+        shape=stack.shape,
+        order="F",
+        offset=header.get_data_offset(),
     )
+    for start in range(0, stack.shape[-1], slab_size):
+        data[..., start : start + slab_size] = stack[
+            ..., start : start + slab_size
+        ]
+    data.flush()
+    del data
 
 
 def get_transf_matrix_from_res(pix_sizes):
@@ -33,3 +59,38 @@ def get_transf_matrix_from_res(pix_sizes):
     for i in [0, 1, 2]:
         transformation_matrix[i, i] = pix_sizes[i] / 1000
     return transformation_matrix
+
+
+def load_nii_memmap(src_path):
+    """
+    Load a nifti image without decoding it into memory. For uncompressed,
+    unscaled images (such as those written by niftyreg) this is a read-only
+    memory map in the stored data type, so only the parts that are used are
+    read from disk.
+
+    :param src_path: Path to the nifti image
+    :return: The image data
+    :rtype: np.ndarray
+    """
+    return np.asanyarray(nib.load(str(src_path), mmap="r").dataobj)
+
+
+def load_nii(src_path, dtype=None, lazy=False):
+    """
+    Load an uncompressed nifti image (such as those written by niftyreg)
+    from a memory map, rather than decoding it to float64 as ``load_any``
+    does.
+
+    :param src_path: Path to the nifti image
+    :param dtype: Data type to return. Defaults to the stored data type.
+    :param bool lazy: If True, return the memory map (unless the data needs
+        converting to dtype), so only the parts that are used are read from
+        disk. Otherwise, the image is read into memory (in C order), in a
+        single copy.
+    :return: The image data
+    :rtype: np.ndarray
+    """
+    image = load_nii_memmap(src_path)
+    if lazy:
+        return image if dtype is None else image.astype(dtype, copy=False)
+    return np.array(image, dtype=dtype, order="C")
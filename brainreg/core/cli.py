@@ -1,4 +1,5 @@
 import logging
+import sys
 import tempfile
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from datetime import datetime
@@ -11,9 +12,20 @@ from fancylog import fancylog
 import brainreg as package_for_log
 from brainreg import __version__
 from brainreg.core.backend.niftyreg.parser import niftyreg_parse
+from brainreg.core.group_stats import main as group_stats
 from brainreg.core.main import main as register
-from brainreg.core.paths import Paths
+from brainreg.core.paths import OUTPUTS, Paths
+from brainreg.core.regions import main as regions
+from brainreg.core.sweep import main as sweep
+from brainreg.core.transform_image import main as transform_image
+from brainreg.core.utils import cohort
+from brainreg.core.utils.cores import (
+    CORE_PINNING_NOT_SUPPORTED_MESSAGE,
+    CORE_PINNING_SUPPORTED,
+)
+from brainreg.core.utils.memory import parse_memory_size
 from brainreg.core.utils.misc import get_arg_groups, log_metadata
+from brainreg.core.worker import main as worker
 
 temp_dir = tempfile.TemporaryDirectory()
 temp_dir_path = temp_dir.name
@@ -119,6 +131,90 @@ def misc_parse(parser):
         "as the original data.",
     )
 
+    misc_parser.add_argument(
+        "--save-native-resolution",
+        dest="save_native_resolution",
+        action="store_true",
+        help="Option to also save the atlas annotations at the resolution, "
+        "and in the orientation, of the original data. The image is "
+        "generated plane by plane, and saved as a compressed tiff.",
+    )
+
+    misc_parser.add_argument(
+        "--outputs",
+        dest="outputs",
+        nargs="+",
+        choices=OUTPUTS,
+        default=None,
+        help="Only generate these outputs, skipping the steps needed for "
+        "the others (the registered atlas and downsampled image are always "
+        "saved). 'volumes' and 'intensities' also save the hemispheres. By "
+        "default, all outputs are generated.",
+    )
+
+    misc_parser.add_argument(
+        "--compact-labels",
+        dest="compact_labels",
+        action="store_true",
+        help="Save the registered atlas as uint16 indices, with a lookup "
+        "table of the atlas ID of each index (e.g. registered_atlas_labels"
+        ".csv), rather than as uint32 atlas IDs. This halves the size of "
+        "these images, but other software will need the lookup table to "
+        "find the atlas IDs.",
+    )
+
+    misc_parser.add_argument(
+        "--cohort-volumes",
+        dest="cohort_volumes",
+        type=str,
+        default=None,
+        help="Directory of a cohort volume store, shared by many samples. "
+        "The region volumes of this sample are added to it (as a Parquet "
+        "file), so that the volumes of a cohort can be loaded as a single "
+        "table. Needs pyarrow.",
+    )
+
+    misc_parser.add_argument(
+        "--sample-id",
+        dest="sample_id",
+        type=str,
+        default=None,
+        help="ID of this sample in the cohort volume store. Defaults to the "
+        "name of the output directory.",
+    )
+
+    misc_parser.add_argument(
+        "--scratch-dir",
+        dest="scratch_directory",
+        type=str,
+        default=None,
+        help="Directory for the intermediate niftyreg files, e.g. /dev/shm "
+        "or a local disk. Only the final outputs are saved to the output "
+        "directory (and the intermediate files too, with --debug). By "
+        "default, intermediate files are saved in the output directory.",
+    )
+
+    misc_parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        type=parse_memory_size,
+        default=None,
+        help="Maximum memory to use, e.g. '16G' or '512M' (a number on its "
+        "own is in GB). If set, memory-heavy steps process images in "
+        "chunks that fit in the memory left, and read intermediate files "
+        "lazily. This does not include memory used by niftyreg itself.",
+    )
+
+    misc_parser.add_argument(
+        "--pin-cores",
+        dest="pin_cores",
+        action="store_true",
+        help="Reserve CPU cores for this registration, so that other "
+        "brainreg processes on the same machine (also using --pin-cores) "
+        "run on different cores. Cores are taken from a single NUMA node, "
+        "and the number of threads matches the number of cores reserved.",
+    )
+
     misc_parser.add_argument(
         "--brain_geometry",
         default="full",
@@ -263,10 +359,33 @@ def prep_registration(args):
     return args, additional_images_to_downsample
 
 
+# Additional tools, run as "brainreg <command>"
+SUBCOMMANDS = {
+    "group-stats": group_stats,
+    "regions": regions,
+    "sweep": sweep,
+    "transform-image": transform_image,
+    "worker": worker,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     start_time = datetime.now()
-    args = register_cli_parser().parse_args()
-    arg_groups = get_arg_groups(args, register_cli_parser())
+    parser = register_cli_parser()
+    args = parser.parse_args()
+    if args.pin_cores and not CORE_PINNING_SUPPORTED:
+        parser.error(CORE_PINNING_NOT_SUPPORTED_MESSAGE)
+    if args.cohort_volumes is not None:
+        # fail now, rather than after registering
+        try:
+            cohort._import_parquet()
+        except ImportError as err:
+            parser.error(str(err))
+    arg_groups = get_arg_groups(args, parser)
 
     args, additional_images_downsample = prep_registration(args)
 
@@ -299,7 +418,15 @@ def main():
         backend=args.backend,
         debug=args.debug,
         save_original_orientation=args.save_original_orientation,
+        save_native_resolution=args.save_native_resolution,
         brain_geometry=args.brain_geometry,
+        pin_cores=args.pin_cores,
+        max_memory=args.max_memory,
+        scratch_directory=args.scratch_directory,
+        outputs=args.outputs,
+        compact_labels=args.compact_labels,
+        cohort_volumes=args.cohort_volumes,
+        sample_id=args.sample_id,
     )
 
     logging.info("Finished. Total time taken: %s", datetime.now() - start_time)
@@ -0,0 +1,317 @@
+"""
+group_stats
+===========
+
+Voxel-wise statistics of atlas-space images (e.g.
+``downsampled_standard.tiff``) across a cohort of registrations, and
+optionally the difference between two cohorts.
+
+The images are memory-mapped, and the statistics are calculated one slab
+(along the first axis) at a time, in a single pass over the samples
+(Welford's algorithm), so only a slab of each statistic is in memory,
+however many samples there are. Slabs are processed in parallel.
+"""
+
+import logging
+import os
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from brainglobe_utils.general.numerical import check_positive_int
+from brainglobe_utils.general.system import (
+    ensure_directory_exists,
+    get_num_processes,
+)
+from fancylog import fancylog
+from scipy.special import stdtr
+
+import brainreg as package_for_log
+from brainreg.core.utils.image_io import create_tiff_memmap, load_image
+
+# saved for each cohort, and for the comparison of two cohorts
+GROUP_STATISTICS = ("mean", "variance", "count")
+COMPARISON_STATISTICS = ("difference", "t_statistic", "p_value")
+
+
+class RunningStatistics:
+    """
+    Voxel-wise mean and variance of any number of images, added one at a
+    time (Welford's algorithm).
+
+    :param shape: Shape of the images
+    """
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.uint32)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        # sum of squared differences from the mean
+        self._m2 = np.zeros(shape, dtype=np.float64)
+
+    def add(self, image, exclude_zeros=False):
+        """
+        :param image: Image to add
+        :param bool exclude_zeros: If True, voxels that are 0 (e.g. outside
+            the registered sample) are not included. Non-finite values are
+            never included.
+        """
+        image = np.asarray(image, dtype=np.float64)
+        valid = np.isfinite(image)
+        if exclude_zeros:
+            valid &= image != 0
+        self.count += valid
+        # invalid voxels are calculated, but not used
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = np.where(valid, image - self.mean, 0)
+            self.mean += np.where(valid, delta / self.count, 0)
+            self._m2 += np.where(valid, delta * (image - self.mean), 0)
+
+    @property
+    def variance(self):
+        """
+        Sample variance (NaN where there are fewer than two values).
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(
+                self.count > 1,
+                self._m2 / (self.count.astype(float) - 1),
+                np.nan,
+            )
+
+
+def welch_t_test(statistics_a, statistics_b):
+    """
+    Voxel-wise Welch's t-test of the difference between two groups.
+
+    :param RunningStatistics statistics_a: First group
+    :param RunningStatistics statistics_b: Second group
+    :return: Difference of the means (a - b), t statistic, and two-sided p
+        value (NaN where either group has fewer than two values)
+    :rtype: dict
+    """
+    difference = statistics_a.mean - statistics_b.mean
+    with np.errstate(invalid="ignore", divide="ignore"):
+        error_a = statistics_a.variance / statistics_a.count
+        error_b = statistics_b.variance / statistics_b.count
+        t_statistic = difference / np.sqrt(error_a + error_b)
+        # Welch-Satterthwaite degrees of freedom
+        degrees_of_freedom = (error_a + error_b) ** 2 / (
+            error_a**2 / (statistics_a.count - 1.0)
+            + error_b**2 / (statistics_b.count - 1.0)
+        )
+        p_value = 2 * stdtr(degrees_of_freedom, -np.abs(t_statistic))
+    return {
+        "difference": difference,
+        "t_statistic": t_statistic,
+        "p_value": p_value,
+    }
+
+
+def open_images(image_paths):
+    """
+    Memory-map a set of images, which must all have the same shape.
+
+    :param image_paths: Image paths
+    :return: The images
+    :rtype: list
+    :raises ValueError: If the images are not all the same shape
+    """
+    images = [load_image(str(path), lazy=True) for path in image_paths]
+    shapes = {image.shape for image in images}
+    if len(shapes) > 1:
+        raise ValueError(
+            f"Images must all be the same shape (i.e. in the same atlas "
+            f"grid), but have shapes: {sorted(shapes)}"
+        )
+    return images
+
+
+def group_statistics(
+    image_paths,
+    output_directory,
+    compare_image_paths=None,
+    exclude_zeros=False,
+    slab_size=8,
+    n_free_cpus=2,
+):
+    """
+    Calculate the voxel-wise mean, variance and count of a set of images,
+    and save them as float32 (count as integer) tiffs: "mean.tiff",
+    "variance.tiff" and "count.tiff". If a second set of images is given,
+    its statistics are saved as "compare_mean.tiff" etc., and the difference
+    of the means (first - second), Welch's t statistic and its two-sided p
+    value as "difference.tiff", "t_statistic.tiff" and "p_value.tiff".
+
+    :param image_paths: Images (e.g. downsampled_standard.tiff of each
+        sample), all in the same atlas grid
+    :param output_directory: Where to save the statistics
+    :param compare_image_paths: Images of a second group to compare to
+    :param bool exclude_zeros: If True, voxels that are 0 (e.g. outside the
+        registered sample) are not included
+    :param int slab_size: Number of planes processed at once by each thread
+    :param int n_free_cpus: Number of CPU cores to leave free
+    """
+    groups = {"": open_images(image_paths)}
+    if compare_image_paths:
+        groups["compare_"] = open_images(compare_image_paths)
+    shape = groups[""][0].shape
+    if compare_image_paths and groups["compare_"][0].shape != shape:
+        raise ValueError(
+            f"Both groups must be in the same atlas grid, but have shapes "
+            f"{shape} and {groups['compare_'][0].shape}"
+        )
+
+    outputs = {}
+    for prefix, images in groups.items():
+        count_dtype = np.min_scalar_type(len(images))
+        for statistic in GROUP_STATISTICS:
+            outputs[f"{prefix}{statistic}"] = create_tiff_memmap(
+                os.path.join(output_directory, f"{prefix}{statistic}.tiff"),
+                shape,
+                count_dtype if statistic == "count" else np.float32,
+            )
+    if compare_image_paths:
+        for statistic in COMPARISON_STATISTICS:
+            outputs[statistic] = create_tiff_memmap(
+                os.path.join(output_directory, f"{statistic}.tiff"),
+                shape,
+                np.float32,
+            )
+
+    def process_slab(start):
+        stop = min(start + slab_size, shape[0])
+        slab_statistics = {}
+        for prefix, images in groups.items():
+            running = RunningStatistics((stop - start, *shape[1:]))
+            for image in images:
+                running.add(image[start:stop], exclude_zeros=exclude_zeros)
+            slab_statistics[prefix] = running
+            outputs[f"{prefix}mean"][start:stop] = np.where(
+                running.count > 0, running.mean, np.nan
+            )
+            outputs[f"{prefix}variance"][start:stop] = running.variance
+            outputs[f"{prefix}count"][start:stop] = running.count
+        if compare_image_paths:
+            comparison = welch_t_test(
+                slab_statistics[""], slab_statistics["compare_"]
+            )
+            for statistic, values in comparison.items():
+                outputs[statistic][start:stop] = values
+
+    starts = range(0, shape[0], slab_size)
+    n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+    if n_processes > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_processes) as pool:
+            # consume the iterator to raise any errors
+            list(pool.map(process_slab, starts))
+    else:
+        for start in starts:
+            process_slab(start)
+
+    for output in outputs.values():
+        output.flush()
+
+
+def group_stats_cli_parser():
+    parser = ArgumentParser(
+        prog="brainreg group-stats",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description="Calculate voxel-wise group statistics (mean, variance "
+        "and count) of atlas-space images across a cohort of completed "
+        "registrations, and optionally compare two cohorts.",
+    )
+    parser.add_argument(
+        dest="output_directory",
+        type=str,
+        help="Directory to save the statistics in.",
+    )
+    parser.add_argument(
+        dest="brainreg_directories",
+        type=str,
+        nargs="+",
+        help="brainreg output directories of the cohort.",
+    )
+    parser.add_argument(
+        "--compare",
+        dest="compare_directories",
+        type=str,
+        nargs="+",
+        default=None,
+        help="brainreg output directories of a second cohort. The "
+        "difference of the means, Welch's t statistic, and its p value are "
+        "saved for each voxel.",
+    )
+    parser.add_argument(
+        "--image",
+        dest="image_name",
+        type=str,
+        default="downsampled_standard.tiff",
+        help="Atlas-space image of each registration to use, e.g. "
+        "'downsampled_standard_<channel>.tiff' for an additional channel.",
+    )
+    parser.add_argument(
+        "--exclude-zeros",
+        dest="exclude_zeros",
+        action="store_true",
+        help="Do not include voxels that are 0 (e.g. outside the registered "
+        "sample) in the statistics.",
+    )
+    parser.add_argument(
+        "--slab-size",
+        dest="slab_size",
+        type=check_positive_int,
+        default=8,
+        help="Number of planes processed at once by each thread. Larger "
+        "values are faster, but use more memory.",
+    )
+    parser.add_argument(
+        "--n-free-cpus",
+        dest="n_free_cpus",
+        type=check_positive_int,
+        default=2,
+        help="The number of CPU cores on the machine to leave "
+        "unused by the program to spare resources.",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Debug mode. Will increase verbosity of logging.",
+    )
+    return parser
+
+
+def main(argv=None):
+    start_time = datetime.now()
+    args = group_stats_cli_parser().parse_args(argv)
+    ensure_directory_exists(args.output_directory)
+
+    fancylog.start_logging(
+        args.output_directory,
+        package=package_for_log,
+        variables=[args],
+        verbose=args.debug,
+        log_header="BRAINREG GROUP-STATS LOG",
+        multiprocessing_aware=False,
+    )
+
+    def image_paths(directories):
+        if directories is None:
+            return None
+        return [
+            os.path.join(directory, args.image_name)
+            for directory in directories
+        ]
+
+    logging.info("Calculating group statistics")
+    group_statistics(
+        image_paths(args.brainreg_directories),
+        args.output_directory,
+        compare_image_paths=image_paths(args.compare_directories),
+        exclude_zeros=args.exclude_zeros,
+        slab_size=args.slab_size,
+        n_free_cpus=args.n_free_cpus,
+    )
+
+    logging.info("Finished. Total time taken: %s", datetime.now() - start_time)
@@ -1,33 +1,47 @@
 import logging
+import os
+from contextlib import ExitStack
 
 import brainglobe_space as bg
+import numpy as np
 from brainglobe_atlasapi import BrainGlobeAtlas
 from brainglobe_utils.general.system import get_num_processes
 from brainglobe_utils.IO.image.load import load_any
 
 from brainreg.core.backend.niftyreg.run import run_niftyreg
+from brainreg.core.paths import resolve_outputs
+from brainreg.core.utils import cohort
+from brainreg.core.utils.artifacts import ArtifactStore
 from brainreg.core.utils.boundaries import boundaries
+from brainreg.core.utils.cores import reserve_cores
+from brainreg.core.utils.image_io import get_image_shape
+from brainreg.core.utils.labels import (
+    load_labels_lookup,
+    remove_labels_lookup,
+    save_labels_lookup,
+)
+from brainreg.core.utils.memory import MemoryBudget
+from brainreg.core.utils.native_resolution import save_native_resolution_atlas
+from brainreg.core.utils.structure_index import build_structure_index
 from brainreg.core.utils.volume import calculate_volumes
+from brainreg.core.utils.writer import AsyncWriter
 
 
-def main(
-    atlas,
-    data_orientation,
-    target_brain_path,
-    paths,
-    voxel_sizes,
-    niftyreg_args,
-    preprocessing_args,
-    n_free_cpus=2,
-    sort_input_file=False,
-    additional_images_downsample=None,
-    backend="niftyreg",
-    scaling_rounding_decimals=5,
-    debug=False,
-    save_original_orientation=False,
-    brain_geometry="full",
+def get_scaling(
+    atlas, data_orientation, voxel_sizes, scaling_rounding_decimals=5
 ):
-    atlas = BrainGlobeAtlas(atlas)
+    """
+    Scaling from the raw data to the atlas resolution, for each axis of
+    the raw data.
+
+    :param atlas: BrainGlobeAtlas
+    :param str data_orientation: Orientation of the raw data
+    :param voxel_sizes: Voxel sizes of the raw data (in um), in the order
+        of the data orientation
+    :param int scaling_rounding_decimals: Number of decimals to round to
+    :return: Scaling for each axis
+    :rtype: list
+    """
     source_space = bg.AnatomicalSpace(data_orientation)
 
     scaling = []
@@ -41,12 +55,27 @@ def main(
                 scaling_rounding_decimals,
             )
         )
+    return scaling
 
-    n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
-    load_parallel = n_processes > 1
 
-    logging.info("Loading raw image data")
+def load_downsampled_brain(
+    target_brain_path,
+    scaling,
+    data_orientation,
+    atlas_orientation,
+    load_parallel=False,
+    sort_input_file=False,
+    n_free_cpus=2,
+):
+    """
+    Load the raw data, downsampled to the atlas resolution, and reoriented
+    to match the atlas. The reoriented image is a view of the downsampled
+    data, which is only materialised when it is filtered and written.
 
+    :return: Downsampled image (float32, or the type of the raw data if it
+        is not downsampled)
+    :rtype: np.ndarray
+    """
     target_brain = load_any(
         target_brain_path,
         scaling[1],
@@ -56,46 +85,176 @@ def main(
         sort_input_file=sort_input_file,
         n_free_cpus=n_free_cpus,
     )
+    # downsampling returns float64, but the rest of the pipeline works in
+    # float32 (see preprocess.FILTER_DTYPE)
+    if target_brain.dtype == np.float64:
+        target_brain = target_brain.astype(np.float32)
+
+    return bg.map_stack_to(data_orientation, atlas_orientation, target_brain)
 
-    target_brain = bg.map_stack_to(
-        data_orientation, atlas.metadata["orientation"], target_brain
+
+def main(
+    atlas,
+    data_orientation,
+    target_brain_path,
+    paths,
+    voxel_sizes,
+    niftyreg_args,
+    preprocessing_args,
+    n_free_cpus=2,
+    sort_input_file=False,
+    additional_images_downsample=None,
+    backend="niftyreg",
+    scaling_rounding_decimals=5,
+    debug=False,
+    save_original_orientation=False,
+    save_native_resolution=False,
+    brain_geometry="full",
+    pin_cores=False,
+    max_memory=None,
+    scratch_directory=None,
+    outputs=None,
+    compact_labels=False,
+    cohort_volumes=None,
+    sample_id=None,
+):
+    outputs = resolve_outputs(outputs)
+    if cohort_volumes is not None:
+        # check pyarrow is installed before registering
+        cohort._import_parquet()
+    atlas = BrainGlobeAtlas(atlas)
+    memory_budget = MemoryBudget(max_memory)
+    scaling = get_scaling(
+        atlas,
+        data_orientation,
+        voxel_sizes,
+        scaling_rounding_decimals=scaling_rounding_decimals,
     )
 
-    if backend == "niftyreg":
-        run_niftyreg(
-            paths.registration_output_folder,
-            paths,
-            atlas,
-            target_brain,
-            n_processes,
-            additional_images_downsample,
+    n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+    # the cores are released, and the writer threads stopped, even if
+    # registration fails
+    with ExitStack() as stack:
+        if pin_cores:
+            logging.info("Reserving CPU cores")
+            core_reservation = stack.enter_context(reserve_cores(n_processes))
+            core_reservation.pin()
+            n_processes = len(core_reservation.cores)
+        load_parallel = n_processes > 1
+        # outputs used by later steps are kept in memory, unless there is a
+        # memory limit, in which case images are written as soon as they are
+        # made, and read back lazily
+        artifacts = ArtifactStore(
+            stack.enter_context(
+                AsyncWriter(n_threads=0 if memory_budget.limited else 2)
+            ),
+            keep_in_memory=not memory_budget.limited,
+        )
+
+        logging.info("Loading raw image data")
+        target_brain = load_downsampled_brain(
+            target_brain_path,
+            scaling,
             data_orientation,
             atlas.metadata["orientation"],
-            niftyreg_args,
-            preprocessing_args,
-            scaling,
-            load_parallel,
-            sort_input_file,
-            n_free_cpus,
-            debug=debug,
-            save_original_orientation=save_original_orientation,
-            brain_geometry=brain_geometry,
+            load_parallel=load_parallel,
+            sort_input_file=sort_input_file,
+            n_free_cpus=n_free_cpus,
         )
 
-    logging.info("Calculating volumes of each brain area")
-    calculate_volumes(
-        atlas,
-        paths.registered_atlas,
-        paths.registered_hemispheres,
-        paths.volume_csv_path,
-        # for all brainglobe atlases
-        left_hemisphere_value=1,
-        right_hemisphere_value=2,
-        brain_geometry=brain_geometry,
-    )
+        if backend == "niftyreg":
+            run_niftyreg(
+                paths.registration_output_folder,
+                paths,
+                atlas,
+                target_brain,
+                n_processes,
+                additional_images_downsample,
+                data_orientation,
+                atlas.metadata["orientation"],
+                niftyreg_args,
+                preprocessing_args,
+                scaling,
+                load_parallel,
+                sort_input_file,
+                n_free_cpus,
+                debug=debug,
+                save_original_orientation=save_original_orientation,
+                brain_geometry=brain_geometry,
+                memory_budget=memory_budget,
+                scratch_directory=scratch_directory,
+                outputs=outputs,
+                artifacts=artifacts,
+                compact_labels=compact_labels,
+            )
+        del target_brain
+        # None, unless the registered atlas was saved in compact form
+        labels_lookup = load_labels_lookup(paths.registered_atlas)
+
+        if save_native_resolution:
+            logging.info("Saving registered atlas at native resolution")
+            raw_shape = get_image_shape(target_brain_path)
+            save_native_resolution_atlas(
+                artifacts.get(paths.registered_atlas),
+                atlas.metadata["orientation"],
+                data_orientation,
+                raw_shape,
+                paths.registered_atlas_native_resolution,
+                # uint32 labels, and the copy passed to the tiff encoder
+                slab_size=memory_budget.slab_size(
+                    raw_shape[0],
+                    2 * 4 * int(np.prod(raw_shape[1:])),
+                    default=1,
+                ),
+            )
+            if labels_lookup is None:
+                remove_labels_lookup(paths.registered_atlas_native_resolution)
+            else:
+                save_labels_lookup(
+                    labels_lookup, paths.registered_atlas_native_resolution
+                )
+
+        if "structure_index" in outputs:
+            logging.info("Indexing the voxels of each brain area")
+            # read one plane at a time
+            build_structure_index(
+                artifacts.get(paths.registered_atlas),
+                labels_lookup=labels_lookup,
+            ).save(paths.registered_atlas_index)
+
+        if "volumes" in outputs:
+            logging.info("Calculating volumes of each brain area")
+            calculate_volumes(
+                atlas,
+                artifacts.get(paths.registered_atlas),
+                artifacts.get(paths.registered_hemispheres),
+                paths.volume_csv_path,
+                # for all brainglobe atlases
+                left_hemisphere_value=1,
+                right_hemisphere_value=2,
+                brain_geometry=brain_geometry,
+                labels_lookup=labels_lookup,
+                cohort_store=cohort_volumes,
+                sample_id=(
+                    sample_id
+                    if sample_id is not None
+                    else os.path.basename(
+                        os.path.normpath(paths.registration_output_folder)
+                    )
+                ),
+            )
+
+        if "boundaries" in outputs:
+            logging.info("Generating boundary image")
+            boundaries(
+                artifacts.get(paths.registered_atlas),
+                paths.boundaries_file_path,
+                memory_budget=memory_budget,
+                writer=artifacts.writer,
+            )
 
-    logging.info("Generating boundary image")
-    boundaries(paths.registered_atlas, paths.boundaries_file_path)
+        logging.info("Waiting for outputs to be written")
+        artifacts.writer.close()
 
     logging.info(
         f"brainreg completed. Results can be found here: "
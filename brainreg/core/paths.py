@@ -1,5 +1,52 @@
 import os
 
+# outputs that can be chosen with "--outputs". The registered atlas and the
+# downsampled image are always saved.
+OUTPUTS = (
+    "hemispheres",
+    "downsampled_standard",
+    "deformation_field",
+    "deformation_field_tiffs",
+    "volumes",
+    "intensities",
+    "structure_index",
+    "jacobian",
+    "boundaries",
+    "qc",
+)
+# other outputs that each output needs
+OUTPUT_DEPENDENCIES = {
+    "deformation_field_tiffs": ("deformation_field",),
+    "volumes": ("hemispheres",),
+    "intensities": ("hemispheres",),
+    "jacobian": ("deformation_field", "hemispheres"),
+    # the deformation and hemisphere symmetry metrics
+    "qc": ("deformation_field", "hemispheres"),
+}
+
+
+def resolve_outputs(outputs=None):
+    """
+    Find the set of outputs to generate, including any outputs that the
+    chosen outputs depend on.
+
+    :param outputs: Chosen outputs, or None for all outputs
+    :return: Outputs to generate
+    :rtype: set
+    :raises ValueError: If an output is not recognised
+    """
+    if outputs is None:
+        return set(OUTPUTS)
+    unknown = set(outputs).difference(OUTPUTS)
+    if unknown:
+        raise ValueError(
+            f"Unknown outputs: {sorted(unknown)}. Options are: {OUTPUTS}"
+        )
+    resolved = set(outputs)
+    for output in outputs:
+        resolved.update(OUTPUT_DEPENDENCIES.get(output, ()))
+    return resolved
+
 
 class Paths:
     """
@@ -23,9 +70,18 @@ class Paths:
         self.registered_atlas_original_orientation = self.make_reg_path(
             "registered_atlas_original_orientation.tiff"
         )
+        self.registered_atlas_native_resolution = self.make_reg_path(
+            "registered_atlas_native_resolution.tiff"
+        )
+        # see brainreg.core.utils.structure_index
+        self.registered_atlas_index = self.make_reg_path(
+            "registered_atlas_index.npz"
+        )
         self.registered_hemispheres = self.make_reg_path(
             "registered_hemispheres.tiff"
         )
+        # (X, Y, Z, 3) float32, in mm
+        self.deformation_field = self.make_reg_path("deformation_field.npy")
         # for each of x,y,z
         self.deformation_field_0 = self.make_reg_path(
             "deformation_field_0.tiff"
@@ -36,8 +92,21 @@ class Paths:
         self.deformation_field_2 = self.make_reg_path(
             "deformation_field_2.tiff"
         )
+        # local volume change from the sample to the atlas, and its mean
+        # etc. in each brain area
+        self.jacobian_determinant = self.make_reg_path(
+            "jacobian_determinant.tiff"
+        )
+        self.jacobian_csv_path = self.make_reg_path("jacobian.csv")
+
+        # control point grids and affine matrices, see
+        # brainreg.core.backend.niftyreg.transform_bundle
+        self.transform_directory = self.make_reg_path("transform")
 
         self.volume_csv_path = self.make_reg_path("volumes.csv")
+        # intensities_<name>.csv for additional channels
+        self.intensities_csv_path = self.make_reg_path("intensities.csv")
+        self.qc_metrics_path = self.make_reg_path("qc.json")
 
         self.metadata_path = self.make_reg_path("brainreg.json")
 
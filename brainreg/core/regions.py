@@ -0,0 +1,433 @@
+"""
+regions
+=======
+
+Assign points (e.g. detected cells) in raw sample space to atlas regions,
+using the registered atlas and hemispheres saved by brainreg, and count
+the points in each region.
+
+The registered images are opened once (memory-mapped where possible), and
+the points are mapped onto their grid in vectorised chunks, which are
+processed in parallel. The registered images are in the same space as
+``downsampled.tiff``, so only the raw to downsampled scaling and the change
+of orientation are needed, not the deformation field.
+"""
+
+import json
+import logging
+import os
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import brainglobe_space as bg
+import numpy as np
+import pandas as pd
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.general.numerical import check_positive_int
+from brainglobe_utils.general.system import (
+    ensure_directory_exists,
+    get_num_processes,
+)
+from fancylog import fancylog
+
+import brainreg as package_for_log
+from brainreg.core.paths import Paths
+from brainreg.core.transform import (
+    DEFAULT_CHUNK_SIZE,
+    get_raw_to_downsampled_scaling,
+)
+from brainreg.core.utils.image_io import load_image
+from brainreg.core.utils.labels import load_labels_lookup
+
+# saved by the CLI, one row per point
+POINT_REGIONS_DTYPE = np.dtype(
+    [("structure_id", np.uint32), ("hemisphere", np.uint8)]
+)
+
+
+class RegionLookup:
+    """
+    Find the atlas region and hemisphere of points in raw sample space.
+
+    :param registered_atlas: Registered atlas, e.g. a memory map of
+        ``registered_atlas.tiff``
+    :param registered_hemispheres: Registered hemispheres, or None if they
+        were not saved (all points are then given a hemisphere of 0)
+    :param str data_orientation: Orientation of the raw data
+    :param str atlas_orientation: Orientation of the atlas
+    :param scaling: For each raw data axis, the factor converting raw voxel
+        coordinates to downsampled voxel coordinates
+    :param labels_lookup: If the registered atlas is compact, its lookup
+        table
+    :param int n_free_cpus: Number of CPU cores to leave free
+    :param int chunk_size: Number of points processed per chunk
+    """
+
+    def __init__(
+        self,
+        registered_atlas,
+        registered_hemispheres,
+        data_orientation,
+        atlas_orientation,
+        scaling,
+        labels_lookup=None,
+        n_free_cpus=2,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
+        self.shape = registered_atlas.shape
+        # flat views, to look up many voxels at once
+        self.registered_atlas = np.asarray(registered_atlas).reshape(-1)
+        self.registered_hemispheres = None
+        if registered_hemispheres is not None:
+            self.registered_hemispheres = np.asarray(
+                registered_hemispheres
+            ).reshape(-1)
+        self.labels_lookup = labels_lookup
+        self.n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+        self.chunk_size = chunk_size
+
+        # for each axis of the registered atlas, the raw data axis it comes
+        # from, and whether it is flipped (as in transform.remap_points)
+        order, self._flips, _, _ = bg.AnatomicalSpace(data_orientation).map_to(
+            atlas_orientation
+        )
+        self._order = list(order)
+        self._scaling = np.asarray(scaling, dtype=np.float64)[self._order]
+
+    @classmethod
+    def from_registration_directory(
+        cls, registration_directory, raw_shape=None, atlas=None, **kwargs
+    ):
+        """
+        Open the registered atlas and hemispheres in a brainreg output
+        directory.
+
+        :param registration_directory: brainreg output directory
+        :param raw_shape: Shape of the raw data. If given, the raw to
+            downsampled scaling is derived from the image shapes (which is
+            exact), otherwise from the voxel sizes in brainreg.json.
+        :param atlas: BrainGlobeAtlas used for registration. Loaded from the
+            name in brainreg.json if not given.
+        :param kwargs: Passed to RegionLookup
+        :return: RegionLookup
+        """
+        paths = Paths(registration_directory)
+        with open(paths.metadata_path) as f:
+            metadata = json.load(f)
+        if atlas is None:
+            atlas = BrainGlobeAtlas(metadata["atlas"])
+
+        # compact atlases are kept compact, only the points are converted
+        registered_atlas = load_image(paths.registered_atlas, lazy=True)
+        registered_hemispheres = None
+        if os.path.exists(paths.registered_hemispheres):
+            registered_hemispheres = load_image(
+                paths.registered_hemispheres, lazy=True
+            )
+
+        return cls(
+            registered_atlas,
+            registered_hemispheres,
+            metadata["orientation"],
+            atlas.metadata["orientation"],
+            get_raw_to_downsampled_scaling(
+                metadata, atlas, registered_atlas.shape, raw_shape=raw_shape
+            ),
+            labels_lookup=load_labels_lookup(paths.registered_atlas),
+            **kwargs,
+        )
+
+    def assign(self, points):
+        """
+        Find the atlas region and hemisphere of each point, from the voxel
+        of the registered atlas containing it.
+
+        :param np.ndarray points: N x 3 array of raw sample voxel
+            coordinates (e.g. a memory-mapped .npy file)
+        :return: Atlas ID of each point (0 outside the brain, or outside the
+            image), and hemisphere of each point
+        :rtype: tuple
+        """
+        points = np.asarray(points)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError(
+                f"Points must be an N x 3 array, not {points.shape}"
+            )
+        structure_ids = np.empty(len(points), dtype=np.uint32)
+        hemispheres = np.empty(len(points), dtype=np.uint8)
+        starts = range(0, len(points), self.chunk_size)
+
+        def process_chunk(start):
+            stop = start + self.chunk_size
+            (
+                structure_ids[start:stop],
+                hemispheres[start:stop],
+            ) = self._assign_chunk(points[start:stop])
+
+        if self.n_processes > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_processes) as pool:
+                # consume the iterator to raise any errors
+                list(pool.map(process_chunk, starts))
+        else:
+            for start in starts:
+                process_chunk(start)
+        return structure_ids, hemispheres
+
+    def _assign_chunk(self, points):
+        # the downsampled voxel containing each point, as in
+        # native_resolution.get_nearest_indices, from the edge of the image
+        # in downsampled voxels
+        coordinates = (points[:, self._order] + 0.5) * self._scaling
+        # NaN coordinates are outside
+        inside = np.all(
+            (coordinates >= 0) & (coordinates < self.shape), axis=1
+        )
+        voxels = np.floor(coordinates[inside]).astype(np.intp)
+        # in case of rounding at the far edge
+        voxels = np.minimum(voxels, np.array(self.shape) - 1)
+        for axis, flip in enumerate(self._flips):
+            if flip:
+                voxels[:, axis] = self.shape[axis] - 1 - voxels[:, axis]
+
+        flat_index = np.ravel_multi_index(voxels.T, self.shape, mode="clip")
+
+        structure_ids = np.zeros(len(points), dtype=np.uint32)
+        structure_ids[inside] = self.registered_atlas[flat_index]
+        if self.labels_lookup is not None:
+            structure_ids[inside] = self.labels_lookup[structure_ids[inside]]
+        hemispheres = np.zeros(len(points), dtype=np.uint8)
+        if self.registered_hemispheres is not None:
+            hemispheres[inside] = self.registered_hemispheres[flat_index]
+        return structure_ids, hemispheres
+
+
+def count_points(
+    structure_ids,
+    hemispheres,
+    atlas,
+    left_hemisphere_value=1,
+    right_hemisphere_value=2,
+):
+    """
+    Count the points in each atlas region, in each hemisphere, both directly
+    and including the points in all of its descendants in the structure
+    hierarchy.
+
+    :param np.ndarray structure_ids: Atlas ID of each point
+    :param np.ndarray hemispheres: Hemisphere of each point
+    :param atlas: BrainGlobeAtlas
+    :param int left_hemisphere_value: Value of the left hemisphere
+    :param int right_hemisphere_value: Value of the right hemisphere
+    :return: One row per region with any points, sorted by atlas ID. Total
+        counts include points with no hemisphere.
+    :rtype: pd.DataFrame
+    """
+    # hashing is much faster than sorting many points
+    codes, unique_ids = pd.factorize(np.asarray(structure_ids))
+    sides = np.zeros(len(codes), dtype=np.intp)
+    sides[hemispheres == left_hemisphere_value] = 1
+    sides[hemispheres == right_hemisphere_value] = 2
+    sides += codes * 3
+    counts = np.bincount(sides, minlength=3 * len(unique_ids)).reshape(-1, 3)
+
+    structures = {
+        structure["id"]: structure for structure in atlas.structures_list
+    }
+    # [left, right, total]
+    direct_counts = {}
+    descendant_counts = {}
+    for structure_id, (none, left, right) in zip(unique_ids, counts):
+        structure_id = int(structure_id)
+        if structure_id == 0:
+            logging.info(f"{none + left + right} points are outside the brain")
+            continue
+        if structure_id not in structures:
+            logging.warning(
+                f"Value: {structure_id} is not in the atlas structure "
+                f"reference file. Not counting its points"
+            )
+            continue
+        structure_counts = np.array([left, right, none + left + right])
+        direct_counts[structure_id] = structure_counts
+        for ancestor in structures[structure_id]["structure_id_path"]:
+            descendant_counts[ancestor] = (
+                descendant_counts.get(ancestor, 0) + structure_counts
+            )
+
+    structure_ids = sorted(descendant_counts)
+    direct = np.array(
+        [direct_counts.get(idx, np.zeros(3, int)) for idx in structure_ids]
+    ).reshape(-1, 3)
+    with_descendants = np.array(
+        [descendant_counts[idx] for idx in structure_ids]
+    ).reshape(-1, 3)
+    df = pd.DataFrame(
+        {
+            "structure_id": structure_ids,
+            "acronym": [structures[idx]["acronym"] for idx in structure_ids],
+            "structure_name": [
+                structures[idx]["name"] for idx in structure_ids
+            ],
+        }
+    )
+    for idx, side in enumerate(("left", "right", "total")):
+        df[f"{side}_count"] = direct[:, idx]
+        df[f"{side}_count_with_descendants"] = with_descendants[:, idx]
+    return df
+
+
+def get_structure_names(structure_ids, atlas):
+    """
+    :param np.ndarray structure_ids: Atlas ID of each point
+    :param atlas: BrainGlobeAtlas
+    :return: Name of the region of each point (None outside the brain)
+    :rtype: np.ndarray
+    """
+    codes, unique_ids = pd.factorize(np.asarray(structure_ids))
+    names = {
+        structure["id"]: structure["name"]
+        for structure in atlas.structures_list
+    }
+    unique_names = np.array(
+        [names.get(int(idx)) for idx in unique_ids], dtype=object
+    )
+    return unique_names[codes]
+
+
+def assign_points_to_regions(
+    registration_directory, points, raw_shape=None, **kwargs
+):
+    """
+    Convenience function to find the atlas region and hemisphere of raw
+    sample voxel coordinates.
+
+    :param registration_directory: brainreg output directory
+    :param np.ndarray points: N x 3 array
+    :param raw_shape: Shape of the raw data (optional)
+    :param kwargs: Passed to RegionLookup
+    :return: Atlas ID and hemisphere of each point
+    :rtype: tuple
+    """
+    region_lookup = RegionLookup.from_registration_directory(
+        registration_directory, raw_shape=raw_shape, **kwargs
+    )
+    return region_lookup.assign(points)
+
+
+def load_points(points_path):
+    """
+    :param points_path: .npy file of an N x 3 array (memory-mapped), or a
+        csv file with a header row, whose first three columns are the
+        coordinates
+    :return: N x 3 array
+    :rtype: np.ndarray
+    """
+    if str(points_path).endswith(".npy"):
+        return np.load(points_path, mmap_mode="r")
+    return pd.read_csv(points_path).iloc[:, :3].to_numpy()
+
+
+def regions_cli_parser():
+    parser = ArgumentParser(
+        prog="brainreg regions",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description="Find the atlas region and hemisphere of points (e.g. "
+        "detected cells) in raw sample space, and count the points in "
+        "each region, using a completed registration.",
+    )
+    parser.add_argument(
+        dest="brainreg_directory",
+        type=str,
+        help="brainreg output directory of a completed registration.",
+    )
+    parser.add_argument(
+        dest="points_path",
+        type=str,
+        help="Raw sample voxel coordinates, in the same axis order as the "
+        "data used for registration. Either an N x 3 array saved as .npy, "
+        "or a csv file with a header row, whose first three columns are "
+        "the coordinates.",
+    )
+    parser.add_argument(
+        dest="output_directory",
+        type=str,
+        help="Directory to save the results in. The counts in each region "
+        "are saved as region_counts.csv, and the atlas ID and hemisphere "
+        "of each point as point_regions.npy.",
+    )
+    parser.add_argument(
+        "--raw-shape",
+        dest="raw_shape",
+        type=check_positive_int,
+        nargs=3,
+        default=None,
+        help="Shape of the raw data. If given, this is used to scale the "
+        "points (which is exact), rather than the voxel sizes.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=check_positive_int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Number of points processed at once.",
+    )
+    parser.add_argument(
+        "--n-free-cpus",
+        dest="n_free_cpus",
+        type=check_positive_int,
+        default=2,
+        help="The number of CPU cores on the machine to leave "
+        "unused by the program to spare resources.",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Debug mode. Will increase verbosity of logging.",
+    )
+    return parser
+
+
+def main(argv=None):
+    start_time = datetime.now()
+    args = regions_cli_parser().parse_args(argv)
+    ensure_directory_exists(args.output_directory)
+
+    fancylog.start_logging(
+        args.output_directory,
+        package=package_for_log,
+        variables=[args],
+        verbose=args.debug,
+        log_header="BRAINREG REGIONS LOG",
+        multiprocessing_aware=False,
+    )
+
+    with open(Paths(args.brainreg_directory).metadata_path) as f:
+        atlas = BrainGlobeAtlas(json.load(f)["atlas"])
+
+    logging.info("Assigning points to regions")
+    structure_ids, hemispheres = assign_points_to_regions(
+        args.brainreg_directory,
+        load_points(args.points_path),
+        raw_shape=args.raw_shape,
+        atlas=atlas,
+        n_free_cpus=args.n_free_cpus,
+        chunk_size=args.chunk_size,
+    )
+
+    point_regions = np.empty(len(structure_ids), dtype=POINT_REGIONS_DTYPE)
+    point_regions["structure_id"] = structure_ids
+    point_regions["hemisphere"] = hemispheres
+    np.save(
+        os.path.join(args.output_directory, "point_regions.npy"),
+        point_regions,
+    )
+
+    logging.info("Counting points in each region")
+    count_points(structure_ids, hemispheres, atlas).to_csv(
+        os.path.join(args.output_directory, "region_counts.csv"),
+        index=False,
+    )
+
+    logging.info("Finished. Total time taken: %s", datetime.now() - start_time)
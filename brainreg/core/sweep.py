@@ -0,0 +1,504 @@
+"""
+sweep
+=====
+
+Register the same sample with a grid of registration parameters, to help
+choose them. The sample and atlas are loaded, downsampled and filtered
+once, and the registrations are then run in parallel, with the available
+CPU cores divided between them. The registration quality metrics and
+timings of every configuration are saved to a single table.
+"""
+
+import itertools
+import json
+import logging
+import os
+import time
+from argparse import (
+    ArgumentDefaultsHelpFormatter,
+    ArgumentParser,
+    ArgumentTypeError,
+)
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.general.numerical import check_positive_int
+from brainglobe_utils.general.system import (
+    delete_directory_contents,
+    ensure_directory_exists,
+    get_num_processes,
+)
+from fancylog import fancylog
+
+import brainreg as package_for_log
+from brainreg.core.backend.niftyreg.parameters import RegistrationParams
+from brainreg.core.backend.niftyreg.parser import niftyreg_parse
+from brainreg.core.backend.niftyreg.paths import NiftyRegPaths
+from brainreg.core.backend.niftyreg.registration import (
+    BrainRegistration,
+    RegistrationError,
+)
+from brainreg.core.backend.niftyreg.run import prepare_niftyreg_inputs
+from brainreg.core.backend.niftyreg.utils import load_nii_memmap
+from brainreg.core.main import get_scaling, load_downsampled_brain
+from brainreg.core.paths import Paths
+from brainreg.core.utils.cores import (
+    CORE_PINNING_NOT_SUPPORTED_MESSAGE,
+    CORE_PINNING_SUPPORTED,
+    reserve_cores,
+)
+from brainreg.core.utils.misc import get_arg_groups
+from brainreg.core.utils.qc import calculate_qc_metrics, save_qc_metrics
+
+NIFTYREG_OPTIONS_GROUP = "NiftyReg registration backend options"
+RESULTS_FILENAME = "sweep_results.csv"
+
+# inputs that only depend on the data and atlas, shared by all
+# configurations
+PREPARED_INPUTS = (
+    "downsampled_brain",
+    "downsampled_filtered",
+    "brain_filtered",
+    "annotations",
+    "hemispheres",
+)
+
+
+def sweep_cli_parser():
+    parser = ArgumentParser(
+        prog="brainreg sweep",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description="Register the same sample with a grid of registration "
+        "parameters, and compare the registration quality and time taken.",
+    )
+    parser.add_argument(
+        dest="image_paths",
+        type=str,
+        help="Path to the directory of the image files. Can also be a text "
+        "file pointing to the files.",
+    )
+    parser.add_argument(
+        dest="output_directory",
+        type=str,
+        help="Directory to save the results of each configuration, and the "
+        "table comparing them.",
+    )
+    parser.add_argument(
+        "-v",
+        "--voxel-sizes",
+        dest="voxel_sizes",
+        required=True,
+        nargs="+",
+        help="Voxel sizes in microns, in the order of data orientation. "
+        "e.g. '5 2 2'",
+    )
+    parser.add_argument(
+        "--orientation",
+        type=str,
+        required=True,
+        help="The orientation of the sample brain.",
+    )
+    parser.add_argument(
+        "--atlas",
+        dest="atlas",
+        type=str,
+        default="allen_mouse_25um",
+        help="Brainglobe atlas to use for registration.",
+    )
+    parser.add_argument(
+        "--sweep",
+        dest="sweep",
+        type=str,
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE,VALUE,...",
+        help="A registration option, and the values to try, e.g. "
+        "'bending_energy_weight=0.8,0.9,0.95'. Can be given multiple "
+        "times, in which case every combination of values is run. Options "
+        "that are not swept take their value from the registration "
+        "options below.",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        dest="n_jobs",
+        type=check_positive_int,
+        default=2,
+        help="Number of registrations to run at once. The available CPU "
+        "cores are divided between them.",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        dest="pin_cores",
+        action="store_true",
+        help="Run each registration on its own set of CPU cores, from a "
+        "single NUMA node. Also keeps clear of other brainreg processes "
+        "using --pin-cores.",
+    )
+    parser.add_argument(
+        "--pre-processing",
+        dest="preprocessing",
+        type=str,
+        default="default",
+        help="Pre-processing method to be applied before registration. "
+        "Possible values: skip, default.",
+    )
+    parser.add_argument(
+        "--brain_geometry",
+        default="full",
+        dest="brain_geometry",
+        choices=["full", "hemisphere_l", "hemisphere_r"],
+        help="Which part of the brain the data contains.",
+    )
+    parser.add_argument(
+        "--sort-input-file",
+        dest="sort_input_file",
+        action="store_true",
+        help="Sort the input text file using natural sorting.",
+    )
+    parser.add_argument(
+        "--n-free-cpus",
+        dest="n_free_cpus",
+        type=check_positive_int,
+        default=2,
+        help="The number of CPU cores on the machine to leave unused.",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Debug mode. Keeps the intermediate niftyreg files of every "
+        "configuration.",
+    )
+    parser = niftyreg_parse(parser)
+    return parser
+
+
+def parse_sweep_options(sweep_options, parser):
+    """
+    Parse "option=value,value,..." strings, converting the values with
+    the type of the corresponding registration option.
+
+    :param list sweep_options: Strings to parse
+    :param ArgumentParser parser: Parser with the registration options
+    :return: Values to try for each option, in the order given
+    :rtype: dict
+    """
+    actions = {
+        action.dest: action
+        for group in parser._action_groups
+        if group.title == NIFTYREG_OPTIONS_GROUP
+        for action in group._group_actions
+    }
+
+    swept = {}
+    for option in sweep_options:
+        name, _, values = option.partition("=")
+        name = name.strip().lstrip("-").replace("-", "_")
+        if name not in actions:
+            parser.error(
+                f"Cannot sweep '{name}'. Registration options are: "
+                f"{', '.join(actions)}"
+            )
+        if not values:
+            parser.error(f"No values given for '{name}'")
+        action = actions[name]
+        convert = action.type if action.type is not None else str
+        swept[name] = []
+        for value in values.split(","):
+            try:
+                value = convert(value.strip())
+            except (ArgumentTypeError, TypeError, ValueError) as err:
+                parser.error(f"Invalid value for '{name}': {err}")
+            if action.choices is not None and value not in action.choices:
+                parser.error(
+                    f"Invalid value for '{name}': {value} (choose from "
+                    f"{', '.join(map(str, action.choices))})"
+                )
+            swept[name].append(value)
+    return swept
+
+
+def get_configurations(base_params, swept):
+    """
+    Every combination of the swept option values.
+
+    :param dict base_params: Registration options, used for any option that
+        is not swept
+    :param dict swept: Values to try for each swept option
+    :return: List of (name, swept values, registration options)
+    :rtype: list
+    """
+    names = list(swept)
+    combinations = list(itertools.product(*swept.values()))
+    n_digits = len(str(len(combinations) - 1))
+    configurations = []
+    for idx, values in enumerate(combinations):
+        swept_values = dict(zip(names, values))
+        configurations.append(
+            (
+                f"configuration_{idx:0{n_digits}d}",
+                swept_values,
+                {**base_params, **swept_values},
+            )
+        )
+    return configurations
+
+
+def flatten_metrics(metrics, prefix=""):
+    """
+    Flatten nested QC metrics into a single level dict, for tabulation.
+    Lists (e.g. of the worst regions) are skipped.
+    """
+    flat = {}
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, prefix=f"{prefix}{key}_"))
+        elif not isinstance(value, list):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def run_configuration(
+    name,
+    registration_options,
+    inputs_directory,
+    output_directory,
+    atlas_resolution,
+    atlas_orientation,
+    n_processes,
+    debug=False,
+    pin_cores=False,
+):
+    """
+    Register the prepared inputs with one set of registration options, and
+    calculate the registration quality metrics.
+
+    :param str name: Name of the configuration
+    :param dict registration_options: Passed to RegistrationParams
+    :param inputs_directory: Directory of the prepared niftyreg inputs
+    :param output_directory: Where to save the results
+    :param atlas_resolution: Atlas voxel sizes in um
+    :param str atlas_orientation: Atlas orientation
+    :param int n_processes: Number of OpenMP threads for each niftyreg call
+    :param bool debug: If True, keep the intermediate niftyreg files
+    :param bool pin_cores: If True, run on n_processes reserved cores
+    :return: QC metrics and timings
+    :rtype: dict
+    """
+    if pin_cores:
+        with reserve_cores(n_processes) as core_reservation:
+            core_reservation.pin()
+            return run_configuration(
+                name,
+                registration_options,
+                inputs_directory,
+                output_directory,
+                atlas_resolution,
+                atlas_orientation,
+                len(core_reservation.cores),
+                debug=debug,
+            )
+
+    ensure_directory_exists(output_directory)
+    with open(os.path.join(output_directory, "parameters.json"), "w") as f:
+        json.dump(registration_options, f, indent=4)
+
+    niftyreg_directory = os.path.join(output_directory, "niftyreg")
+    niftyreg_paths = NiftyRegPaths(niftyreg_directory)
+    input_paths = NiftyRegPaths(inputs_directory)
+    for input_name in PREPARED_INPUTS:
+        setattr(niftyreg_paths, input_name, getattr(input_paths, input_name))
+
+    brain_reg = BrainRegistration(
+        niftyreg_paths,
+        RegistrationParams(**registration_options),
+        n_processes=n_processes,
+    )
+
+    result = {"configuration": name}
+    try:
+        start = time.perf_counter()
+        brain_reg.register_affine()
+        result["affine_time"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        brain_reg.register_freeform()
+        result["freeform_time"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        brain_reg.segment()
+        brain_reg.register_hemispheres()
+        brain_reg.generate_deformation_field(niftyreg_paths.deformation_field)
+        result["resample_time"] = time.perf_counter() - start
+    except RegistrationError as err:
+        logging.warning(f"{name} failed: {err}")
+        result["error"] = str(err)
+        return result
+
+    # the results are memory-mapped, and read as the metrics need them
+    metrics = calculate_qc_metrics(
+        load_nii_memmap(niftyreg_paths.freeform_registered_atlas_brain_path),
+        load_nii_memmap(niftyreg_paths.downsampled_filtered),
+        load_nii_memmap(niftyreg_paths.registered_atlas_img_path),
+        load_nii_memmap(niftyreg_paths.registered_hemispheres_img_path),
+        load_nii_memmap(niftyreg_paths.deformation_field)[..., 0, :],
+        atlas_resolution,
+        atlas_orientation,
+    )
+    save_qc_metrics(metrics, Paths(output_directory).qc_metrics_path)
+    result.update(flatten_metrics(metrics))
+
+    if not debug:
+        delete_directory_contents(niftyreg_directory)
+        os.rmdir(niftyreg_directory)
+    return result
+
+
+def sweep(
+    atlas,
+    data_orientation,
+    target_brain_path,
+    output_directory,
+    voxel_sizes,
+    niftyreg_args,
+    preprocessing_args,
+    swept,
+    n_jobs=2,
+    n_free_cpus=2,
+    sort_input_file=False,
+    brain_geometry="full",
+    debug=False,
+    pin_cores=False,
+):
+    """
+    Register a sample with every combination of the swept registration
+    options.
+
+    :param str atlas: Name of the atlas
+    :param str data_orientation: Orientation of the raw data
+    :param target_brain_path: Path to the raw data
+    :param output_directory: Where to save the results
+    :param voxel_sizes: Voxel sizes of the raw data (in um)
+    :param niftyreg_args: Registration options not being swept
+    :param preprocessing_args: Pre-processing options
+    :param dict swept: Values to try for each swept option
+    :param int n_jobs: Number of registrations to run at once
+    :param int n_free_cpus: Number of CPU cores to leave unused
+    :param bool sort_input_file: Sort the input text file
+    :param str brain_geometry: "full", "hemisphere_l" or "hemisphere_r"
+    :param bool debug: If True, keep the intermediate niftyreg files
+    :param bool pin_cores: If True, run each registration on its own set of
+        cores
+    :return: Table of QC metrics and timings for each configuration
+    :rtype: pd.DataFrame
+    """
+    atlas = BrainGlobeAtlas(atlas)
+    atlas_orientation = atlas.metadata["orientation"]
+    paths = Paths(output_directory)
+
+    n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+    configurations = get_configurations(vars(niftyreg_args), swept)
+    n_jobs = min(n_jobs, len(configurations))
+    threads_per_job = max(1, n_processes // n_jobs)
+
+    logging.info("Loading raw image data")
+    target_brain = load_downsampled_brain(
+        target_brain_path,
+        get_scaling(atlas, data_orientation, voxel_sizes),
+        data_orientation,
+        atlas_orientation,
+        load_parallel=n_processes > 1,
+        sort_input_file=sort_input_file,
+        n_free_cpus=n_free_cpus,
+    )
+
+    logging.info("Preparing registration inputs")
+    inputs_directory = os.path.join(output_directory, "inputs")
+    prepare_niftyreg_inputs(
+        NiftyRegPaths(inputs_directory),
+        paths,
+        atlas,
+        target_brain,
+        preprocessing_args,
+        brain_geometry=brain_geometry,
+    )
+    del target_brain
+
+    logging.info(
+        f"Running {len(configurations)} configurations, {n_jobs} at a time "
+        f"with {threads_per_job} threads each"
+    )
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(
+                run_configuration,
+                name,
+                registration_options,
+                inputs_directory,
+                os.path.join(output_directory, name),
+                atlas.resolution,
+                atlas_orientation,
+                threads_per_job,
+                debug=debug,
+                pin_cores=pin_cores,
+            )
+            for name, _, registration_options in configurations
+        ]
+        results = []
+        for (name, swept_values, _), future in zip(configurations, futures):
+            result = future.result()
+            logging.info(f"Finished {name}")
+            results.append({"configuration": name, **swept_values, **result})
+
+    if not debug:
+        delete_directory_contents(inputs_directory)
+        os.rmdir(inputs_directory)
+
+    results = pd.DataFrame(results)
+    results.to_csv(
+        os.path.join(output_directory, RESULTS_FILENAME), index=False
+    )
+    return results
+
+
+def main(argv=None):
+    start_time = datetime.now()
+    parser = sweep_cli_parser()
+    args = parser.parse_args(argv)
+    swept = parse_sweep_options(args.sweep, parser)
+    if not swept:
+        parser.error("At least one --sweep option is required")
+    if args.pin_cores and not CORE_PINNING_SUPPORTED:
+        parser.error(CORE_PINNING_NOT_SUPPORTED_MESSAGE)
+    arg_groups = get_arg_groups(args, parser)
+
+    ensure_directory_exists(args.output_directory)
+    fancylog.start_logging(
+        args.output_directory,
+        package=package_for_log,
+        variables=[args],
+        verbose=args.debug,
+        log_header="BRAINREG SWEEP LOG",
+        multiprocessing_aware=False,
+    )
+
+    results = sweep(
+        args.atlas,
+        args.orientation,
+        args.image_paths,
+        args.output_directory,
+        args.voxel_sizes,
+        arg_groups[NIFTYREG_OPTIONS_GROUP],
+        args,
+        swept,
+        n_jobs=args.n_jobs,
+        n_free_cpus=args.n_free_cpus,
+        sort_input_file=args.sort_input_file,
+        brain_geometry=args.brain_geometry,
+        debug=args.debug,
+        pin_cores=args.pin_cores,
+    )
+    logging.info(f"Results:\n{results.to_string(index=False)}")
+    logging.info("Finished. Total time taken: %s", datetime.now() - start_time)
@@ -0,0 +1,522 @@
+"""
+transform
+=========
+
+Vectorised mapping of point coordinates between raw sample space and atlas
+space, using the deformation field produced by brainreg.
+
+Three coordinate spaces are involved:
+
+- raw: voxel coordinates of the raw data, in the data orientation
+- downsampled: voxel coordinates of ``downsampled.tiff``, i.e. the sample
+  at atlas resolution and in the atlas orientation
+- atlas: voxel coordinates of the atlas
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import brainglobe_space as bg
+import numpy as np
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.general.system import get_num_processes
+from brainglobe_utils.IO.image.load import load_any
+from scipy.ndimage import map_coordinates
+from scipy.spatial import cKDTree
+
+from brainreg.core.backend.niftyreg.transform_bundle import TransformBundle
+from brainreg.core.paths import Paths
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+# number of deformation field samples used to seed the inverse mapping
+MAX_INVERSE_SEEDS = 2_000_000
+
+
+def load_deformation_field(paths):
+    """
+    Load the deformation field saved by brainreg as a single (X, Y, Z, 3)
+    array. If ``deformation_field.npy`` exists, it is memory-mapped. If
+    not, the three tiffs (one per component) are loaded, or, if those were
+    not saved either, the field is evaluated from the saved control point
+    grid.
+
+    :param paths: brainreg Paths object
+    :return: Deformation field, in mm
+    :rtype: np.ndarray
+    """
+    if os.path.exists(paths.deformation_field):
+        return np.load(paths.deformation_field, mmap_mode="r")
+    if not os.path.exists(paths.deformation_field_0) and os.path.exists(
+        paths.transform_directory
+    ):
+        return TransformBundle(
+            paths.transform_directory
+        ).forward.deformation_field()
+
+    deformation_field = None
+    for idx, component_path in enumerate(
+        [
+            paths.deformation_field_0,
+            paths.deformation_field_1,
+            paths.deformation_field_2,
+        ]
+    ):
+        component = load_any(component_path)
+        if deformation_field is None:
+            deformation_field = np.empty(
+                (*component.shape, 3), dtype=np.float32
+            )
+        deformation_field[..., idx] = component
+    return deformation_field
+
+
+def remap_points(points, source_orientation, target_orientation, shape):
+    """
+    Map voxel coordinates between two orientations of the same stack. This
+    matches the transposes and flips of ``bg.map_stack_to``, so a point at
+    index ``i`` along a flipped axis of length ``n`` moves to ``n - 1 - i``.
+
+    :param np.ndarray points: N x 3 array, in the source orientation
+    :param str source_orientation: e.g. "psl"
+    :param str target_orientation: e.g. "asr"
+    :param shape: Shape of the stack in the source orientation
+    :return: N x 3 array, in the target orientation
+    :rtype: np.ndarray
+    """
+    order, flips, _, _ = bg.AnatomicalSpace(source_orientation).map_to(
+        target_orientation
+    )
+    mapped = points[:, order].astype(np.float64, copy=True)
+    for axis, flip in enumerate(flips):
+        if flip:
+            mapped[:, axis] = shape[order[axis]] - 1 - mapped[:, axis]
+    return mapped
+
+
+def get_raw_to_downsampled_scaling(
+    metadata, atlas, downsampled_shape, raw_shape=None
+):
+    """
+    Find the factors converting raw voxel coordinates to downsampled voxel
+    coordinates, for each raw data axis.
+
+    :param dict metadata: Contents of brainreg.json
+    :param atlas: BrainGlobeAtlas used for registration
+    :param downsampled_shape: Shape of the downsampled data (in the atlas
+        orientation)
+    :param raw_shape: Shape of the raw data. If given, the scaling is
+        derived from the image shapes (which is exact), otherwise from the
+        voxel sizes in brainreg.json.
+    :return: Scaling for each raw data axis
+    :rtype: np.ndarray
+    """
+    data_orientation = metadata["orientation"]
+    if raw_shape is not None:
+        downsampled_shape = bg.map_stack_to(
+            atlas.metadata["orientation"],
+            data_orientation,
+            np.empty(downsampled_shape, dtype=bool),
+        ).shape
+        return np.array(downsampled_shape) / np.array(raw_shape)
+
+    source_space = bg.AnatomicalSpace(data_orientation)
+    return np.array(
+        [
+            float(metadata["voxel_sizes"][idx])
+            / atlas.resolution[
+                atlas.space.axes_order.index(source_space.axes_order[idx])
+            ]
+            for idx in range(3)
+        ]
+    )
+
+
+def scale_raw_to_downsampled(points, scaling, downsampled_shape):
+    """
+    Scale raw voxel coordinates to downsampled voxel coordinates, both in
+    the raw data orientation. The raw and downsampled images cover the same
+    extent, so voxel centres are scaled as ``(p + 0.5) * s - 0.5`` (as in
+    ``native_resolution.get_nearest_indices``). Points in the raw image, but
+    within half a downsampled voxel of its edge, are moved onto the centre
+    of the outermost downsampled voxel.
+
+    :param np.ndarray points: N x 3 array
+    :param scaling: For each axis, the factor converting raw voxel
+        coordinates to downsampled voxel coordinates
+    :param downsampled_shape: Shape of the downsampled data, in the raw data
+        orientation
+    :return: N x 3 array, NaN for points outside the raw image
+    :rtype: np.ndarray
+    """
+    downsampled_shape = np.asarray(downsampled_shape)
+    # from the edge of the image, in downsampled voxels
+    scaled = (np.asarray(points, dtype=np.float64) + 0.5) * scaling
+    inside = np.all((scaled >= 0) & (scaled < downsampled_shape), axis=1)
+    scaled = np.clip(scaled - 0.5, 0, downsampled_shape - 1)
+    scaled[~inside] = np.nan
+    return scaled
+
+
+def scale_downsampled_to_raw(points, scaling):
+    """
+    Scale downsampled voxel coordinates to raw voxel coordinates, both in
+    the raw data orientation (the inverse of ``scale_raw_to_downsampled``).
+
+    :param np.ndarray points: N x 3 array
+    :param scaling: For each axis, the factor converting raw voxel
+        coordinates to downsampled voxel coordinates
+    :return: N x 3 array
+    :rtype: np.ndarray
+    """
+    return (np.asarray(points, dtype=np.float64) + 0.5) / scaling - 0.5
+
+
+class RegistrationTransform:
+    """
+    Map points between raw sample space and atlas space.
+
+    The deformation field is held once in memory (or memory-mapped), and
+    points are mapped in chunks, which are processed in parallel.
+
+    :param np.ndarray deformation_field: (X, Y, Z, 3) array, defined on the
+        downsampled grid, giving the corresponding atlas position in mm.
+    :param atlas_resolution: Atlas voxel sizes in um
+    :param str data_orientation: Orientation of the raw data
+    :param str atlas_orientation: Orientation of the atlas
+    :param scaling: For each raw data axis, the factor converting raw voxel
+        coordinates to downsampled voxel coordinates
+    :param int n_free_cpus: Number of CPU cores to leave free
+    :param int chunk_size: Number of points processed per chunk
+    """
+
+    def __init__(
+        self,
+        deformation_field,
+        atlas_resolution,
+        data_orientation,
+        atlas_orientation,
+        scaling,
+        n_free_cpus=2,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
+        self.deformation_field = deformation_field
+        self.atlas_resolution = np.asarray(atlas_resolution, dtype=float)
+        self.data_orientation = data_orientation
+        self.atlas_orientation = atlas_orientation
+        self.scaling = np.asarray(scaling, dtype=float)
+        self.n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+        self.chunk_size = chunk_size
+
+        self.downsampled_shape = deformation_field.shape[:3]
+        # shape of the downsampled data, in the raw data orientation
+        self.downsampled_shape_data_orientation = bg.map_stack_to(
+            atlas_orientation,
+            data_orientation,
+            np.empty(self.downsampled_shape, dtype=bool),
+        ).shape
+
+        # mm to atlas voxels
+        self.field_scales = 1000 / self.atlas_resolution
+        self._inverse_seeds = None
+
+    @classmethod
+    def from_registration_directory(
+        cls,
+        registration_directory,
+        raw_shape=None,
+        atlas=None,
+        **kwargs,
+    ):
+        """
+        Load a transform from a brainreg output directory.
+
+        :param registration_directory: brainreg output directory
+        :param raw_shape: Shape of the raw data. If given, the raw to
+            downsampled scaling is derived from the image shapes (which is
+            exact), otherwise from the voxel sizes in brainreg.json.
+        :param atlas: BrainGlobeAtlas used for registration. Loaded from the
+            name in brainreg.json if not given.
+        :param kwargs: Passed to RegistrationTransform
+        :return: RegistrationTransform
+        """
+        paths = Paths(registration_directory)
+        with open(paths.metadata_path) as f:
+            metadata = json.load(f)
+
+        if atlas is None:
+            atlas = BrainGlobeAtlas(metadata["atlas"])
+
+        deformation_field = load_deformation_field(paths)
+        scaling = get_raw_to_downsampled_scaling(
+            metadata, atlas, deformation_field.shape[:3], raw_shape=raw_shape
+        )
+
+        return cls(
+            deformation_field,
+            atlas.resolution,
+            metadata["orientation"],
+            atlas.metadata["orientation"],
+            scaling,
+            **kwargs,
+        )
+
+    def raw_to_downsampled(self, points):
+        """
+        Map raw sample voxel coordinates to downsampled voxel coordinates.
+
+        :param np.ndarray points: N x 3 array
+        :return: N x 3 array, NaN for points outside the raw image
+        :rtype: np.ndarray
+        """
+        points = scale_raw_to_downsampled(
+            points, self.scaling, self.downsampled_shape_data_orientation
+        )
+        return remap_points(
+            points,
+            self.data_orientation,
+            self.atlas_orientation,
+            self.downsampled_shape_data_orientation,
+        )
+
+    def downsampled_to_raw(self, points):
+        """
+        Map downsampled voxel coordinates to raw sample voxel coordinates.
+
+        :param np.ndarray points: N x 3 array
+        :return: N x 3 array
+        :rtype: np.ndarray
+        """
+        points = remap_points(
+            np.asarray(points, dtype=np.float64),
+            self.atlas_orientation,
+            self.data_orientation,
+            self.downsampled_shape,
+        )
+        return scale_downsampled_to_raw(points, self.scaling)
+
+    def downsampled_to_atlas(self, points):
+        """
+        Map downsampled voxel coordinates to atlas voxel coordinates, by
+        trilinear interpolation of the deformation field. Points outside the
+        deformation field are returned as NaN.
+
+        :param np.ndarray points: N x 3 array
+        :return: N x 3 array
+        :rtype: np.ndarray
+        """
+        return self._map_in_chunks(self._downsampled_to_atlas, points)
+
+    def atlas_to_downsampled(self, points, tolerance=0.01, max_iterations=20):
+        """
+        Map atlas voxel coordinates to downsampled voxel coordinates, by
+        numerically inverting the deformation field. Points that do not
+        converge (e.g. outside the registered sample) are returned as NaN.
+
+        :param np.ndarray points: N x 3 array
+        :param float tolerance: Maximum residual, in atlas voxels
+        :param int max_iterations: Maximum number of Newton iterations
+        :return: N x 3 array
+        :rtype: np.ndarray
+        """
+        return self._map_in_chunks(
+            self._atlas_to_downsampled,
+            points,
+            tolerance=tolerance,
+            max_iterations=max_iterations,
+        )
+
+    def sample_to_atlas(self, points):
+        """
+        Map raw sample voxel coordinates to atlas voxel coordinates.
+
+        :param np.ndarray points: N x 3 array
+        :return: N x 3 array
+        :rtype: np.ndarray
+        """
+        return self._map_in_chunks(
+            lambda chunk: self._downsampled_to_atlas(
+                self.raw_to_downsampled(chunk)
+            ),
+            points,
+        )
+
+    def atlas_to_sample(self, points, **kwargs):
+        """
+        Map atlas voxel coordinates to raw sample voxel coordinates.
+
+        :param np.ndarray points: N x 3 array
+        :param kwargs: Passed to ``atlas_to_downsampled``
+        :return: N x 3 array
+        :rtype: np.ndarray
+        """
+        return self._map_in_chunks(
+            lambda chunk, **kw: self.downsampled_to_raw(
+                self._atlas_to_downsampled(chunk, **kw)
+            ),
+            points,
+            **kwargs,
+        )
+
+    def _map_in_chunks(self, func, points, **kwargs):
+        points = np.asarray(points)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError(
+                f"Points must be an N x 3 array, not {points.shape}"
+            )
+        out = np.empty(points.shape, dtype=np.float64)
+        starts = range(0, len(points), self.chunk_size)
+
+        def process_chunk(start):
+            stop = start + self.chunk_size
+            out[start:stop] = func(points[start:stop], **kwargs)
+
+        if self.n_processes > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.n_processes) as pool:
+                # consume the iterator to raise any errors
+                list(pool.map(process_chunk, starts))
+        else:
+            for start in starts:
+                process_chunk(start)
+        return out
+
+    def _interpolate_field(self, points):
+        # NaN points (e.g. outside the raw image) stay NaN
+        valid = np.all(np.isfinite(points), axis=1)
+        coordinates = np.ascontiguousarray(points[valid].T)
+        atlas_points = np.full(points.shape, np.nan)
+        for axis in range(3):
+            atlas_points[valid, axis] = map_coordinates(
+                self.deformation_field[..., axis],
+                coordinates,
+                order=1,
+                mode="constant",
+                cval=np.nan,
+            )
+        return atlas_points * self.field_scales
+
+    def _downsampled_to_atlas(self, points):
+        return self._interpolate_field(np.asarray(points, dtype=np.float64))
+
+    def _get_inverse_seeds(self):
+        """
+        Build a k-d tree of the atlas positions of a regular subset of the
+        downsampled grid, to give starting points for the inversion.
+        """
+        if self._inverse_seeds is None:
+            n_voxels = np.prod(self.downsampled_shape)
+            step = max(
+                1, int(np.ceil((n_voxels / MAX_INVERSE_SEEDS) ** (1 / 3)))
+            )
+            grid = np.stack(
+                np.meshgrid(
+                    *[np.arange(0, n, step) for n in self.downsampled_shape],
+                    indexing="ij",
+                ),
+                axis=-1,
+            ).reshape(-1, 3)
+            atlas_positions = (
+                self.deformation_field[::step, ::step, ::step].reshape(-1, 3)
+                * self.field_scales
+            )
+            valid = np.all(np.isfinite(atlas_positions), axis=1)
+            self._inverse_seeds = (
+                cKDTree(atlas_positions[valid]),
+                grid[valid],
+                step,
+            )
+        return self._inverse_seeds
+
+    def _atlas_to_downsampled(self, points, tolerance=0.01, max_iterations=20):
+        points = np.asarray(points, dtype=np.float64)
+        tree, seeds, seed_step = self._get_inverse_seeds()
+        # points far from any seed are outside the registered sample
+        distance, nearest = tree.query(
+            points, distance_upper_bound=4 * seed_step + 2
+        )
+        outside = ~np.isfinite(distance)
+        nearest[outside] = 0
+        estimate = seeds[nearest].astype(np.float64)
+
+        # Newton iterations, with the Jacobian of the (piecewise linear)
+        # deformation field estimated by central differences
+        step = 0.5
+        offsets = np.eye(3) * step
+        upper = np.array(self.downsampled_shape) - 1
+        converged = np.zeros(len(points), dtype=bool)
+        for _ in range(max_iterations):
+            active = ~converged & ~outside
+            if not active.any():
+                break
+            x = estimate[active]
+            residual = self._interpolate_field(x) - points[active]
+            done = np.all(np.abs(residual) < tolerance, axis=1)
+            jacobian = np.empty((len(x), 3, 3))
+            for axis in range(3):
+                # one-sided differences at the edge of the field
+                forward = np.clip(x + offsets[axis], 0, upper)
+                backward = np.clip(x - offsets[axis], 0, upper)
+                spacing = forward[:, axis] - backward[:, axis]
+                spacing[spacing == 0] = np.nan
+                jacobian[:, :, axis] = (
+                    self._interpolate_field(forward)
+                    - self._interpolate_field(backward)
+                ) / spacing[:, np.newaxis]
+            update = ~done & np.all(np.isfinite(jacobian), axis=(1, 2))
+            update[update] = np.abs(np.linalg.det(jacobian[update])) > 1e-6
+            delta = np.zeros_like(x)
+            delta[update] = np.linalg.solve(
+                jacobian[update], residual[update][..., np.newaxis]
+            )[..., 0]
+            x[update] -= delta[update]
+            estimate[active] = x
+            converged[np.flatnonzero(active)[done]] = True
+
+        # points may have converged on the final update
+        remaining = np.flatnonzero(~converged & ~outside)
+        residual = (
+            self._interpolate_field(estimate[remaining]) - points[remaining]
+        )
+        converged[remaining] = np.all(np.abs(residual) < tolerance, axis=1)
+        estimate[~converged] = np.nan
+        return estimate
+
+
+def transform_points_to_atlas(
+    registration_directory, points, raw_shape=None, **kwargs
+):
+    """
+    Convenience function to map raw sample voxel coordinates to atlas voxel
+    coordinates.
+
+    :param registration_directory: brainreg output directory
+    :param np.ndarray points: N x 3 array
+    :param raw_shape: Shape of the raw data (optional)
+    :param kwargs: Passed to RegistrationTransform
+    :return: N x 3 array
+    :rtype: np.ndarray
+    """
+    transform = RegistrationTransform.from_registration_directory(
+        registration_directory, raw_shape=raw_shape, **kwargs
+    )
+    return transform.sample_to_atlas(points)
+
+
+def transform_points_to_sample(
+    registration_directory, points, raw_shape=None, **kwargs
+):
+    """
+    Convenience function to map atlas voxel coordinates to raw sample voxel
+    coordinates.
+
+    :param registration_directory: brainreg output directory
+    :param np.ndarray points: N x 3 array
+    :param raw_shape: Shape of the raw data (optional)
+    :param kwargs: Passed to RegistrationTransform
+    :return: N x 3 array
+    :rtype: np.ndarray
+    """
+    transform = RegistrationTransform.from_registration_directory(
+        registration_directory, raw_shape=raw_shape, **kwargs
+    )
+    return transform.atlas_to_sample(points)
@@ -0,0 +1,485 @@
+"""
+transform_image
+===============
+
+Apply a completed registration to a full-resolution image, to generate an
+atlas-space image at any resolution. The output is processed in slabs of
+planes, and each slab in square tiles, so neither the raw image nor the
+output need to fit in memory. Only the part of the raw image covered by
+each tile is read, and the output is written as a compressed, tiled tiff.
+"""
+
+import json
+import logging
+from argparse import (
+    ArgumentDefaultsHelpFormatter,
+    ArgumentParser,
+    ArgumentTypeError,
+)
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.general.numerical import check_positive_int
+from brainglobe_utils.general.system import ensure_directory_exists
+from brainglobe_utils.IO.image.load import read_z_stack
+from fancylog import fancylog
+from scipy.ndimage import map_coordinates
+from tqdm import tqdm
+
+import brainreg as package_for_log
+from brainreg.core.paths import Paths
+from brainreg.core.transform import RegistrationTransform
+from brainreg.core.utils.image_io import write_tiff_from_slabs
+from brainreg.core.utils.memory import parse_memory_size
+
+
+def check_tile_size(value):
+    """
+    :param value: Tile size
+    :return: The tile size, if it is a positive multiple of 16 (as tiff
+        tiles must be)
+    :rtype: int
+    :raises ArgumentTypeError: If the tile size is not valid
+    """
+    tile_size = check_positive_int(value)
+    if tile_size % 16:
+        raise ArgumentTypeError(f"{value} is not a multiple of 16")
+    return tile_size
+
+
+def transform_image_cli_parser():
+    parser = ArgumentParser(
+        prog="brainreg transform-image",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description="Transform a full-resolution image into atlas space "
+        "using a completed registration.",
+    )
+    parser.add_argument(
+        dest="brainreg_directory",
+        type=str,
+        help="brainreg output directory of a completed registration.",
+    )
+    parser.add_argument(
+        dest="image_path",
+        type=str,
+        help="Path to the full-resolution image to transform. Can be a "
+        "directory of 2D tiffs, a text file pointing to the files, or a "
+        "3D tiff. Must be the same size and orientation as the data used "
+        "for registration.",
+    )
+    parser.add_argument(
+        dest="output_path",
+        type=str,
+        help="Path to save the atlas-space image (.tiff).",
+    )
+    parser.add_argument(
+        "-r",
+        "--resolution",
+        dest="resolution",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Output voxel sizes in microns, in the atlas axis order. "
+        "Either one (isotropic) or three values. Defaults to the atlas "
+        "resolution.",
+    )
+    parser.add_argument(
+        "--slab-size",
+        dest="slab_size",
+        type=check_positive_int,
+        default=8,
+        help="Number of output planes processed at once. Larger values are "
+        "faster, but use more memory.",
+    )
+    parser.add_argument(
+        "--tile-size",
+        dest="tile_size",
+        type=check_tile_size,
+        default=256,
+        help="Size (in output voxels) of the square tiles that each slab is "
+        "processed in, and that the output tiff is saved in. Must be a "
+        "multiple of 16.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=parse_memory_size,
+        default="1G",
+        help="Maximum memory used to keep planes of the raw image that have "
+        "already been read, when it is read a whole plane at a time (e.g. "
+        "a directory of 2D tiffs), e.g. '512M' or '2G'.",
+    )
+    parser.add_argument(
+        "--interpolation-order",
+        dest="interpolation_order",
+        type=int,
+        default=1,
+        choices=[0, 1, 3],
+        help="Spline interpolation order used to sample the raw image "
+        "(0: nearest neighbour, 1: linear, 3: cubic).",
+    )
+    parser.add_argument(
+        "--n-free-cpus",
+        dest="n_free_cpus",
+        type=check_positive_int,
+        default=2,
+        help="The number of CPU cores on the machine to leave "
+        "unused by the program to spare resources.",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Debug mode. Will increase verbosity of logging.",
+    )
+    return parser
+
+
+class AtlasToSampleMapper:
+    """
+    Map atlas-space planes to raw sample coordinates.
+
+    The inverse of the deformation field is computed on the atlas grid, for
+    the atlas planes covered by each slab (cached while they are still
+    needed), and then interpolated onto the output grid.
+    """
+
+    def __init__(self, transform, atlas_shape):
+        self.transform = transform
+        self.atlas_shape = atlas_shape
+        self._planes = {}
+
+    def _compute_planes(self, planes):
+        missing = [plane for plane in planes if plane not in self._planes]
+        if not missing:
+            return
+        grid = np.stack(
+            np.meshgrid(
+                missing,
+                np.arange(self.atlas_shape[1]),
+                np.arange(self.atlas_shape[2]),
+                indexing="ij",
+            ),
+            axis=-1,
+        ).reshape(-1, 3)
+        inverse = (
+            self.transform.atlas_to_downsampled(grid)
+            .reshape(len(missing), *self.atlas_shape[1:], 3)
+            .astype(np.float32)
+        )
+        for plane, inverse_plane in zip(missing, inverse):
+            self._planes[plane] = inverse_plane
+
+    def downsampled_coordinates(self, atlas_points):
+        """
+        :param np.ndarray atlas_points: (P, Y, X, 3) grid of atlas voxel
+            coordinates, covering a slab of planes
+        :return: N x 3 array of downsampled coordinates
+        """
+        first_plane = int(np.floor(atlas_points[..., 0].min()))
+        last_plane = int(np.ceil(atlas_points[..., 0].max()))
+        first_plane = max(first_plane, 0)
+        last_plane = min(last_plane, self.atlas_shape[0] - 1)
+
+        # drop cached planes that will not be needed again
+        for plane in list(self._planes):
+            if plane < first_plane:
+                del self._planes[plane]
+
+        planes = range(first_plane, last_plane + 1)
+        self._compute_planes(planes)
+        inverse_field = np.stack([self._planes[plane] for plane in planes])
+        coordinates = atlas_points.reshape(-1, 3).T.copy()
+        coordinates[0] -= first_plane
+
+        downsampled = np.empty((coordinates.shape[1], 3), dtype=np.float64)
+        for axis in range(3):
+            downsampled[:, axis] = map_coordinates(
+                inverse_field[..., axis],
+                coordinates,
+                order=1,
+                mode="constant",
+                cval=np.nan,
+            )
+        return downsampled
+
+
+def get_output_shape(atlas, resolution):
+    """
+    :param atlas: BrainGlobeAtlas
+    :param resolution: Output voxel sizes in um (one or three values)
+    :return: Output shape, and the scale from output voxels to atlas voxels
+    """
+    if resolution is None:
+        resolution = atlas.resolution
+    resolution = np.broadcast_to(np.asarray(resolution, dtype=float), (3,))
+    output_to_atlas = resolution / np.asarray(atlas.resolution)
+    output_shape = np.round(np.array(atlas.shape) / output_to_atlas).astype(
+        int
+    )
+    return tuple(output_shape), output_to_atlas
+
+
+class RawImageReader:
+    """
+    Read blocks of the raw image.
+
+    Lazily loaded images (e.g. a directory of 2D tiffs, read with dask) can
+    only be read a whole plane at a time, so the planes read are kept, up to
+    ``cache_size`` bytes, and reused by later tiles and slabs that cover the
+    same planes. The least recently used planes are dropped first. Images in
+    memory, or memory-mapped, are read directly, as then only the part of
+    each plane that is needed is read.
+
+    :param raw_image: Raw image (can be lazy, e.g. memory-mapped or dask)
+    :param int cache_size: Maximum size (in bytes) of the cached planes
+    """
+
+    def __init__(self, raw_image, cache_size=0):
+        self.raw_image = raw_image
+        self.shape = raw_image.shape
+        self.dtype = raw_image.dtype
+        self._planes = OrderedDict()
+        if isinstance(raw_image, np.ndarray):
+            self.max_planes = 0
+        else:
+            plane_bytes = self.dtype.itemsize * int(np.prod(self.shape[1:]))
+            self.max_planes = int(cache_size // plane_bytes)
+
+    def read_block(self, lower, upper):
+        """
+        :param lower: First voxel of the block, along each axis
+        :param upper: Voxel after the last voxel of the block, along each
+            axis
+        :return: The block of the raw image
+        :rtype: np.ndarray
+        """
+        planes = range(lower[0], upper[0])
+        if len(planes) > self.max_planes:
+            return np.asarray(
+                self.raw_image[
+                    lower[0] : upper[0],
+                    lower[1] : upper[1],
+                    lower[2] : upper[2],
+                ]
+            )
+
+        block = np.empty(
+            [upper[axis] - lower[axis] for axis in range(3)], self.dtype
+        )
+        for i, plane in enumerate(planes):
+            if plane in self._planes:
+                self._planes.move_to_end(plane)
+            else:
+                self._planes[plane] = np.asarray(self.raw_image[plane])
+            block[i] = self._planes[plane][
+                lower[1] : upper[1], lower[2] : upper[2]
+            ]
+        while len(self._planes) > self.max_planes:
+            self._planes.popitem(last=False)
+        return block
+
+
+def get_raw_bounding_box(raw_points, raw_shape, interpolation_order=1):
+    """
+    :param np.ndarray raw_points: N x 3 array of raw coordinates
+    :param raw_shape: Shape of the raw image
+    :param int interpolation_order: Spline interpolation order
+    :return: Which points are inside the raw image, and the bounding box
+        of the raw image needed to sample them (first voxel, and voxel after
+        the last voxel), or None if no points are inside
+    :rtype: tuple
+    """
+    valid = np.all(np.isfinite(raw_points), axis=1)
+    valid &= np.all(raw_points > -1, axis=1)
+    valid &= np.all(raw_points < np.array(raw_shape), axis=1)
+    if not valid.any():
+        return valid, None
+
+    points = raw_points[valid]
+    # pad by the support of the interpolation kernel
+    padding = max(interpolation_order, 1)
+    lower = np.maximum(np.floor(points.min(axis=0)).astype(int) - padding, 0)
+    upper = np.minimum(
+        np.ceil(points.max(axis=0)).astype(int) + padding + 1,
+        raw_shape,
+    )
+    return valid, (lower, upper)
+
+
+def sample_raw_image(raw_image, raw_points, interpolation_order=1):
+    """
+    Sample the raw image at the given (raw voxel) coordinates, reading only
+    the bounding box of the valid points.
+
+    :param raw_image: Raw image (can be lazy, e.g. memory-mapped or dask),
+        or a RawImageReader
+    :param np.ndarray raw_points: N x 3 array of raw coordinates
+    :param int interpolation_order: Spline interpolation order
+    :return: Sampled values (0 where the point is outside the raw image)
+    :rtype: np.ndarray
+    """
+    if not isinstance(raw_image, RawImageReader):
+        raw_image = RawImageReader(raw_image)
+    values = np.zeros(len(raw_points), dtype=raw_image.dtype)
+    valid, bounding_box = get_raw_bounding_box(
+        raw_points, raw_image.shape, interpolation_order=interpolation_order
+    )
+    if bounding_box is None:
+        return values
+
+    lower, upper = bounding_box
+    sampled = map_coordinates(
+        raw_image.read_block(lower, upper),
+        (raw_points[valid] - lower).T,
+        order=interpolation_order,
+        mode="nearest",
+        prefilter=interpolation_order > 1,
+    )
+    if np.issubdtype(values.dtype, np.integer):
+        info = np.iinfo(values.dtype)
+        sampled = np.clip(np.round(sampled), info.min, info.max)
+    values[valid] = sampled
+    return values
+
+
+def transform_image(
+    registration_directory,
+    image_path,
+    output_path,
+    resolution=None,
+    slab_size=8,
+    interpolation_order=1,
+    n_free_cpus=2,
+    tile_size=256,
+    cache_size=1024**3,
+):
+    """
+    Transform a full-resolution image into atlas space, at any resolution,
+    using a completed registration.
+
+    :param registration_directory: brainreg output directory
+    :param image_path: Raw image, in the same space as the registered data
+    :param output_path: Where to save the atlas-space image (tiff)
+    :param resolution: Output voxel sizes in um (one or three values, in
+        atlas axis order). Defaults to the atlas resolution.
+    :param int slab_size: Number of output planes processed at once
+    :param int interpolation_order: Spline interpolation order
+    :param int n_free_cpus: Number of CPU cores to leave free
+    :param int tile_size: Size of the (square) tiles that each slab is
+        sampled in, and that the output is saved in (a multiple of 16)
+    :param int cache_size: Maximum size (in bytes) of the raw planes kept,
+        if the raw image is read a whole plane at a time
+    """
+    paths = Paths(registration_directory)
+    with open(paths.metadata_path) as f:
+        atlas = BrainGlobeAtlas(json.load(f)["atlas"])
+
+    raw_image = read_z_stack(str(image_path))
+    transform = RegistrationTransform.from_registration_directory(
+        registration_directory,
+        raw_shape=raw_image.shape,
+        atlas=atlas,
+        n_free_cpus=n_free_cpus,
+    )
+
+    output_shape, output_to_atlas = get_output_shape(atlas, resolution)
+    logging.info(
+        f"Transforming {image_path} into atlas space, "
+        f"with an output shape of {output_shape}"
+    )
+    mapper = AtlasToSampleMapper(transform, atlas.shape)
+    raw_reader = RawImageReader(raw_image, cache_size=cache_size)
+
+    plane_grid = np.meshgrid(
+        np.arange(output_shape[1]) * output_to_atlas[1],
+        np.arange(output_shape[2]) * output_to_atlas[2],
+        indexing="ij",
+    )
+    tiles = [
+        (slice(y, y + tile_size), slice(x, x + tile_size))
+        for y in range(0, output_shape[1], tile_size)
+        for x in range(0, output_shape[2], tile_size)
+    ]
+
+    def slabs():
+        for start in tqdm(
+            range(0, output_shape[0], slab_size),
+            desc="transforming",
+            unit="slab",
+        ):
+            stop = min(start + slab_size, output_shape[0])
+            atlas_planes = np.arange(start, stop) * output_to_atlas[0]
+            atlas_points = np.empty(
+                (stop - start, *output_shape[1:], 3), dtype=np.float64
+            )
+            atlas_points[..., 0] = atlas_planes[:, np.newaxis, np.newaxis]
+            atlas_points[..., 1] = plane_grid[0]
+            atlas_points[..., 2] = plane_grid[1]
+            raw_points = transform.downsampled_to_raw(
+                mapper.downsampled_coordinates(atlas_points)
+            ).reshape(atlas_points.shape)
+            yield sample_slab(raw_points)
+
+    def sample_slab(raw_points):
+        # The tiles of a slab cover a small part of the raw image each, even
+        # if the raw image is in a different orientation to the atlas.
+        # Sampling them in order of the first raw plane they need means that
+        # the raw planes are read in order, so that each is read once per
+        # slab at most.
+        slab = np.zeros(raw_points.shape[:-1], dtype=raw_image.dtype)
+        tile_points = []
+        for tile in tiles:
+            points = raw_points[:, tile[0], tile[1]].reshape(-1, 3)
+            _, bounding_box = get_raw_bounding_box(
+                points, raw_image.shape, interpolation_order
+            )
+            if bounding_box is not None:
+                tile_points.append((bounding_box[0][0], tile, points))
+
+        for _, tile, points in sorted(tile_points, key=lambda t: t[0]):
+            slab[:, tile[0], tile[1]] = sample_raw_image(
+                raw_reader, points, interpolation_order=interpolation_order
+            ).reshape(slab[:, tile[0], tile[1]].shape)
+        return slab
+
+    write_tiff_from_slabs(
+        output_path,
+        slabs(),
+        output_shape,
+        raw_image.dtype,
+        tile_size=tile_size,
+    )
+
+
+def main(argv=None):
+    start_time = datetime.now()
+    args = transform_image_cli_parser().parse_args(argv)
+    output_directory = Path(args.output_path).parent
+    ensure_directory_exists(output_directory)
+
+    fancylog.start_logging(
+        output_directory,
+        package=package_for_log,
+        variables=[args],
+        verbose=args.debug,
+        log_header="BRAINREG TRANSFORM-IMAGE LOG",
+        multiprocessing_aware=False,
+    )
+
+    transform_image(
+        args.brainreg_directory,
+        args.image_path,
+        args.output_path,
+        resolution=args.resolution,
+        slab_size=args.slab_size,
+        interpolation_order=args.interpolation_order,
+        n_free_cpus=args.n_free_cpus,
+        tile_size=args.tile_size,
+        cache_size=args.cache_size,
+    )
+
+    logging.info("Finished. Total time taken: %s", datetime.now() - start_time)
@@ -0,0 +1,70 @@
+"""
+artifacts
+=========
+
+Pass output images from one stage of the pipeline to later stages in
+memory, rather than each stage reading them back from disk.
+"""
+
+from brainglobe_utils.IO.image.load import load_any, read_z_stack
+
+from brainreg.core.utils.writer import AsyncWriter
+
+
+class ArtifactStore:
+    """
+    Output images, keyed by the path they are saved to. Images are written
+    with the writer when they are added, and (optionally) kept in memory, so
+    that later stages can use them without reading the file. Images that are
+    not in the store are read from disk.
+
+    :param AsyncWriter writer: Used to write the images. If None, images are
+        written immediately.
+    :param bool keep_in_memory: If False, images are only written, and are
+        read back lazily (as memory maps, where possible) when needed.
+    """
+
+    def __init__(self, writer=None, keep_in_memory=True):
+        self.writer = writer if writer is not None else AsyncWriter(0)
+        self.keep_in_memory = keep_in_memory
+        self._images = {}
+
+    def put(self, dest_path, image):
+        """
+        Save an image, and keep it for later stages.
+
+        :param dest_path: Where to save the image
+        :param np.ndarray image: The image, which must not be modified
+            afterwards
+        """
+        self.writer.write_tiff(image, dest_path)
+        if self.keep_in_memory:
+            self._images[str(dest_path)] = image
+
+    def get(self, path):
+        """
+        Get an image, from memory if it is in the store, otherwise from disk
+        (once any pending write to that path has finished).
+
+        :param path: Path the image is saved to
+        :return: The image
+        :rtype: np.ndarray
+        """
+        path = str(path)
+        if path in self._images:
+            return self._images[path]
+        self.writer.wait(path)
+        if self.keep_in_memory:
+            return load_any(path)
+        return read_z_stack(path)
+
+    def discard(self, path):
+        """
+        Stop keeping an image in memory. It can still be read from disk.
+
+        :param path: Path the image is saved to
+        """
+        self._images.pop(str(path), None)
+
+    def __contains__(self, path):
+        return str(path) in self._images
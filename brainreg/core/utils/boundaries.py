@@ -1,23 +1,76 @@
 import logging
 
 import numpy as np
-from brainglobe_utils.IO.image.load import load_any
 from brainglobe_utils.IO.image.save import to_tiff
 from skimage.segmentation import find_boundaries
 
+from brainreg.core.utils.image_io import create_tiff_memmap, load_image
 
-def boundaries(registered_atlas, boundaries_out_path):
+
+def boundaries(
+    registered_atlas, boundaries_out_path, memory_budget=None, writer=None
+):
     """
     Generate the boundary image, which is the border between each segmentation
     region. Useful for overlaying on the raw image to assess the registration
     and segmentation
 
-    :param registered_atlas: The registered atlas
+    :param registered_atlas: The registered atlas, or its path
     :param boundaries_out_path: Path to save the boundary image
+    :param MemoryBudget memory_budget: If given, and limited, the atlas is
+        read lazily, and the boundaries found in slabs
+    :param AsyncWriter writer: If given, the boundary image is written in the
+        background (unless there is a memory limit)
     """
-    atlas_img = load_any(registered_atlas)
+    if memory_budget is not None and memory_budget.limited:
+        boundaries_low_memory(
+            registered_atlas, boundaries_out_path, memory_budget
+        )
+        return
+
+    atlas_img = load_image(registered_atlas)
     boundaries_image = find_boundaries(atlas_img, mode="inner").astype(
         np.int8, copy=False
     )
     logging.debug("Saving segmentation boundary image")
-    to_tiff(boundaries_image, boundaries_out_path)
+    if writer is None:
+        to_tiff(boundaries_image, boundaries_out_path)
+    else:
+        writer.write_tiff(boundaries_image, boundaries_out_path)
+
+
+def boundaries_low_memory(
+    registered_atlas, boundaries_out_path, memory_budget
+):
+    """
+    Generate the boundary image as in ``boundaries``, one slab at a time.
+    Each slab is padded by one plane on either side, so the result is the
+    same as for the whole volume.
+
+    :param registered_atlas: The registered atlas, or its path
+    :param boundaries_out_path: Path to save the boundary image
+    :param MemoryBudget memory_budget: Memory limit
+    """
+    atlas_img = load_image(registered_atlas, lazy=True)
+    n_planes = atlas_img.shape[0]
+    # the labels, and several boolean and label temporary arrays
+    slab_size = memory_budget.slab_size(
+        n_planes, 32 * np.prod(atlas_img.shape[1:])
+    )
+
+    logging.debug("Saving segmentation boundary image")
+    boundaries_image = create_tiff_memmap(
+        boundaries_out_path, atlas_img.shape, np.int8
+    )
+    for start in range(0, n_planes, slab_size):
+        stop = min(start + slab_size, n_planes)
+        padded_start = max(start - 1, 0)
+        padded_stop = min(stop + 1, n_planes)
+        slab_boundaries = find_boundaries(
+            np.asarray(atlas_img[padded_start:padded_stop]), mode="inner"
+        )
+        boundaries_image[start:stop] = slab_boundaries[
+            start - padded_start : stop - padded_start
+        ]
+    boundaries_image.flush()
+    del boundaries_image
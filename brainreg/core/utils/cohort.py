@@ -0,0 +1,156 @@
+"""
+cohort
+======
+
+A shared, columnar store of the region volumes of many samples, so that a
+cohort can be compared without parsing each sample's ``volumes.csv``.
+
+The store is a directory of Parquet files (one per sample), which can be
+read as a single table by pyarrow, pandas, polars, DuckDB etc. Each file
+has one row per structure, with columns "sample_id", "atlas",
+"structure_id", "left_volume_mm3", "right_volume_mm3" and
+"total_volume_mm3".
+
+Each sample is written to a temporary file, which is then renamed into
+place, so any number of registrations can add to the same store at once,
+and readers never see a partly written sample. Adding a sample that is
+already in the store replaces it.
+
+This needs pyarrow (``pip install brainreg[cohort]``).
+"""
+
+import os
+import tempfile
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+VOLUME_COLUMNS = ("left_volume_mm3", "right_volume_mm3", "total_volume_mm3")
+
+
+def _import_parquet():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "The cohort volume store needs pyarrow. Install it with "
+            "'pip install brainreg[cohort]'."
+        )
+    return pa, pq
+
+
+def sample_path(store_directory, sample_id):
+    """
+    :param store_directory: Cohort store directory
+    :param str sample_id: Sample ID
+    :return: Path of the file holding the volumes of a sample
+    :rtype: str
+    """
+    return os.path.join(
+        str(store_directory), f"{quote(str(sample_id), safe='')}.parquet"
+    )
+
+
+def append_cohort_volumes(
+    store_directory,
+    sample_id,
+    atlas_name,
+    structure_ids,
+    left_volumes,
+    right_volumes,
+):
+    """
+    Add the volumes of a sample to a cohort store, replacing any volumes
+    already saved for that sample.
+
+    :param store_directory: Cohort store directory (created if needed)
+    :param str sample_id: Sample ID
+    :param str atlas_name: Atlas the sample was registered to
+    :param structure_ids: Atlas ID of each structure
+    :param left_volumes: Left hemisphere volume of each structure, in mm3
+    :param right_volumes: Right hemisphere volume of each structure, in mm3
+    """
+    pa, pq = _import_parquet()
+    left_volumes = np.asarray(left_volumes, dtype=np.float64)
+    right_volumes = np.asarray(right_volumes, dtype=np.float64)
+    n_structures = len(left_volumes)
+    table = pa.table(
+        {
+            "sample_id": pa.DictionaryArray.from_arrays(
+                np.zeros(n_structures, dtype=np.int32), [str(sample_id)]
+            ),
+            "atlas": pa.DictionaryArray.from_arrays(
+                np.zeros(n_structures, dtype=np.int32), [str(atlas_name)]
+            ),
+            "structure_id": np.asarray(structure_ids, dtype=np.uint32),
+            "left_volume_mm3": left_volumes,
+            "right_volume_mm3": right_volumes,
+            "total_volume_mm3": left_volumes + right_volumes,
+        }
+    )
+
+    os.makedirs(store_directory, exist_ok=True)
+    # files starting with "." are ignored when the store is read
+    file_descriptor, tmp_path = tempfile.mkstemp(
+        dir=store_directory, prefix=".", suffix=".tmp"
+    )
+    os.close(file_descriptor)
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, sample_path(store_directory, sample_id))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_cohort_volumes(store_directory, volume="total_volume_mm3"):
+    """
+    Load the volumes of every sample in a cohort store.
+
+    :param store_directory: Cohort store directory
+    :param str volume: Which volume to load, one of "left_volume_mm3",
+        "right_volume_mm3" or "total_volume_mm3"
+    :return: Structures x samples matrix of volumes, indexed by structure ID
+        and sample ID. Structures not found in a sample have a volume of 0.
+    :rtype: pd.DataFrame
+    :raises ValueError: If the samples were registered to different atlases
+    """
+    if volume not in VOLUME_COLUMNS:
+        raise ValueError(
+            f"Unknown volume: {volume}. Options are: {VOLUME_COLUMNS}"
+        )
+    pa, pq = _import_parquet()
+    table = pq.read_table(
+        str(store_directory),
+        columns=["sample_id", "atlas", "structure_id", volume],
+    )
+
+    atlases = table.column("atlas").cast(pa.string()).unique()
+    if len(atlases) > 1:
+        raise ValueError(
+            f"Samples in {store_directory} were registered to different "
+            f"atlases: {atlases.to_pylist()}"
+        )
+
+    # each file has its own dictionary, so encode the sample IDs afresh
+    samples = (
+        table.column("sample_id")
+        .cast(pa.string())
+        .combine_chunks()
+        .dictionary_encode()
+    )
+    structure_ids, structure_index = np.unique(
+        table.column("structure_id").to_numpy(), return_inverse=True
+    )
+
+    volumes = np.zeros((len(structure_ids), len(samples.dictionary)))
+    volumes[structure_index, samples.indices.to_numpy()] = table.column(
+        volume
+    ).to_numpy()
+    return pd.DataFrame(
+        volumes,
+        index=pd.Index(structure_ids, name="structure_id"),
+        columns=pd.Index(samples.dictionary.to_pylist(), name="sample_id"),
+    )
@@ -0,0 +1,251 @@
+"""
+cores
+=====
+
+Assign disjoint sets of CPU cores to brainreg processes running at the same
+time on one machine, so that their niftyreg subprocesses do not compete for
+the same cores.
+
+Each core has a lock file in a shared directory. A process reserves cores by
+holding an exclusive ``flock`` on their lock files, which the operating
+system releases if the process exits or crashes, so reservations can never
+go stale. Cores are always reserved from a single NUMA node, so that the
+OpenMP threads of each registration share one memory controller.
+
+Reserving cores relies on ``flock`` and CPU affinity, so is only supported
+on Linux, but this module can be imported on any platform.
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+from glob import glob
+
+NODE_DIRECTORY = "/sys/devices/system/node"
+DEFAULT_LOCK_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), "brainreg_core_locks"
+)
+POLL_INTERVAL = 5
+CORE_PINNING_SUPPORTED = sys.platform.startswith("linux")
+CORE_PINNING_NOT_SUPPORTED_MESSAGE = (
+    f"Pinning CPU cores (--pin-cores) is only supported on Linux, not "
+    f"{sys.platform}"
+)
+
+
+class NoFreeCoresError(Exception):
+    pass
+
+
+class CorePinningNotSupportedError(Exception):
+    pass
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a Linux CPU list, e.g. "0-3,8,10-11".
+
+    :param str cpu_list:
+    :return: CPU indices
+    :rtype: list
+    """
+    cores = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        start, _, stop = part.partition("-")
+        cores.extend(range(int(start), int(stop or start) + 1))
+    return cores
+
+
+def get_available_cores():
+    """
+    :return: The cores this process is allowed to run on
+    :rtype: list
+    """
+    return sorted(os.sched_getaffinity(0))
+
+
+def get_numa_nodes(cores=None, node_directory=NODE_DIRECTORY):
+    """
+    Group cores by NUMA node. If the NUMA topology is not available, all
+    cores are treated as a single node.
+
+    :param cores: Only include these cores. Defaults to all the cores this
+        process can run on.
+    :param str node_directory: Where the kernel lists the NUMA nodes
+    :return: List of the cores on each node
+    :rtype: list
+    """
+    if cores is None:
+        cores = get_available_cores()
+    cores = set(cores)
+
+    nodes = []
+    for cpu_list_path in sorted(
+        glob(os.path.join(node_directory, "node*", "cpulist"))
+    ):
+        with open(cpu_list_path) as f:
+            node_cores = sorted(cores.intersection(parse_cpu_list(f.read())))
+        if node_cores:
+            nodes.append(node_cores)
+
+    if not nodes:
+        nodes = [sorted(cores)]
+    return nodes
+
+
+def choose_node(free_cores_by_node, n_cores):
+    """
+    Choose which node to take cores from: the node with the fewest free
+    cores that can still fit all n_cores (to leave larger nodes for larger
+    jobs), or otherwise the node with the most free cores.
+
+    :param list free_cores_by_node: Free cores on each node
+    :param int n_cores: Number of cores wanted
+    :return: Index of the node
+    :rtype: int
+    """
+    n_free = [len(cores) for cores in free_cores_by_node]
+    fits = [i for i, n in enumerate(n_free) if n >= n_cores]
+    if fits:
+        return min(fits, key=lambda i: n_free[i])
+    return max(range(len(n_free)), key=lambda i: n_free[i])
+
+
+class CoreReservation:
+    """
+    A set of cores reserved by this process. The reservation lasts until
+    ``release`` is called, or the process exits.
+
+    :param list cores: Reserved cores
+    :param list lock_files: Open (locked) lock file for each core
+    """
+
+    def __init__(self, cores, lock_files):
+        self.cores = cores
+        self._lock_files = lock_files
+        self._original_affinity = None
+
+    def pin(self):
+        """
+        Restrict this process (and so any subprocesses started from now on)
+        to the reserved cores.
+        """
+        self._original_affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cores)
+        logging.debug(f"Pinned to cores: {self.cores}")
+
+    def release(self):
+        """
+        Release the cores, and restore the original CPU affinity if the
+        process was pinned.
+        """
+        if self._original_affinity is not None:
+            os.sched_setaffinity(0, self._original_affinity)
+            self._original_affinity = None
+        for lock_file in self._lock_files:
+            lock_file.close()
+        self._lock_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _open_lock_file(path):
+    return open(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), "r+")
+
+
+def _try_lock(lock_file):
+    import fcntl
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _make_lock_directory(lock_directory):
+    os.makedirs(lock_directory, exist_ok=True)
+    try:
+        # shared between users, like /tmp
+        os.chmod(lock_directory, 0o1777)
+    except PermissionError:
+        pass
+
+
+def reserve_cores(
+    n_cores,
+    lock_directory=DEFAULT_LOCK_DIRECTORY,
+    timeout=None,
+    node_directory=NODE_DIRECTORY,
+):
+    """
+    Reserve up to n_cores free cores, all on the same NUMA node. If fewer
+    than n_cores are free on any node, as many as are free on one node are
+    reserved. If no cores are free, wait until some are.
+
+    :param int n_cores: Number of cores wanted
+    :param str lock_directory: Directory shared by all processes reserving
+        cores on this machine
+    :param timeout: Maximum time to wait for a free core (in seconds). Waits
+        indefinitely if None.
+    :param str node_directory: Where the kernel lists the NUMA nodes
+    :return: The reservation
+    :rtype: CoreReservation
+    :raises NoFreeCoresError: If no cores became free before the timeout
+    :raises CorePinningNotSupportedError: If not running on Linux
+    """
+    if not CORE_PINNING_SUPPORTED:
+        raise CorePinningNotSupportedError(CORE_PINNING_NOT_SUPPORTED_MESSAGE)
+    # only available on POSIX systems
+    import fcntl
+
+    _make_lock_directory(lock_directory)
+    nodes = get_numa_nodes(node_directory=node_directory)
+    start_time = time.monotonic()
+
+    while True:
+        # only one process chooses cores at a time
+        with _open_lock_file(
+            os.path.join(lock_directory, "scheduler.lock")
+        ) as scheduler_lock:
+            fcntl.flock(scheduler_lock, fcntl.LOCK_EX)
+
+            free_cores_by_node = []
+            lock_files = {}
+            for node_cores in nodes:
+                free_cores = []
+                for core in node_cores:
+                    lock_file = _open_lock_file(
+                        os.path.join(lock_directory, f"core_{core}.lock")
+                    )
+                    if _try_lock(lock_file):
+                        free_cores.append(core)
+                        lock_files[core] = lock_file
+                    else:
+                        lock_file.close()
+                free_cores_by_node.append(free_cores)
+
+            node = choose_node(free_cores_by_node, n_cores)
+            cores = free_cores_by_node[node][:n_cores]
+            for core, lock_file in lock_files.items():
+                if core not in cores:
+                    lock_file.close()
+
+        if cores:
+            logging.debug(f"Reserved {len(cores)} cores: {cores}")
+            return CoreReservation(cores, [lock_files[c] for c in cores])
+
+        if timeout is not None and time.monotonic() - start_time > timeout:
+            raise NoFreeCoresError(
+                f"No CPU cores became free within {timeout} seconds"
+            )
+        logging.debug("No free cores, waiting")
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,158 @@
+import numpy as np
+
+from brainreg.core.utils.image_io import create_tiff_memmap
+
+
+def deformation_field_scales(atlas_resolution):
+    """
+    Scale to convert deformation field values (mm) to atlas voxels.
+
+    :param atlas_resolution: Atlas voxel sizes in um
+    :return: Scale for each component of the deformation field
+    :rtype: np.ndarray
+    """
+    return 1000 / np.asarray(atlas_resolution, dtype=np.float64)
+
+
+def determinant_3x3(matrices):
+    """
+    Determinant of an array of 3x3 matrices, stored in the last two axes.
+
+    :param np.ndarray matrices: Array of shape (..., 3, 3)
+    :return: Array of shape (...)
+    :rtype: np.ndarray
+    """
+    a = matrices
+    return (
+        a[..., 0, 0]
+        * (a[..., 1, 1] * a[..., 2, 2] - a[..., 1, 2] * a[..., 2, 1])
+        - a[..., 0, 1]
+        * (a[..., 1, 0] * a[..., 2, 2] - a[..., 1, 2] * a[..., 2, 0])
+        + a[..., 0, 2]
+        * (a[..., 1, 0] * a[..., 2, 1] - a[..., 1, 1] * a[..., 2, 0])
+    )
+
+
+def iter_jacobian_determinant(deformation_field, scales, slab_size=16):
+    """
+    Compute the Jacobian determinant of a deformation field by finite
+    differences, one slab (along the first axis) at a time. Each slab is
+    padded by one plane on either side, so the result is identical to
+    computing the whole volume at once, while only a slab of gradients is
+    held in memory.
+
+    :param deformation_field: (X, Y, Z, 3) array (can be memory-mapped)
+    :param scales: Scale applied to each component, e.g. to convert mm to
+        atlas voxels
+    :param int slab_size: Number of planes per slab
+    :return: Generator of (start, stop, determinant) for each slab
+    """
+    n_planes = deformation_field.shape[0]
+    scales = np.asarray(scales, dtype=np.float32)
+    for start in range(0, n_planes, slab_size):
+        stop = min(start + slab_size, n_planes)
+        padded_start = max(start - 1, 0)
+        padded_stop = min(stop + 1, n_planes)
+        slab = (
+            np.asarray(
+                deformation_field[padded_start:padded_stop], dtype=np.float32
+            )
+            * scales
+        )
+        jacobian = np.empty((*slab.shape[:3], 3, 3), dtype=np.float32)
+        for component in range(3):
+            gradients = np.gradient(slab[..., component])
+            for axis in range(3):
+                jacobian[..., component, axis] = gradients[axis]
+        determinant = determinant_3x3(jacobian)
+        yield start, stop, determinant[start - padded_start :][: stop - start]
+
+
+def jacobian_determinant(deformation_field, scales, slab_size=16):
+    """
+    Compute the Jacobian determinant of a deformation field (see
+    ``iter_jacobian_determinant``).
+
+    :param deformation_field: (X, Y, Z, 3) array
+    :param scales: Scale applied to each component
+    :param int slab_size: Number of planes processed at once
+    :return: (X, Y, Z) array
+    :rtype: np.ndarray
+    """
+    determinant = np.empty(deformation_field.shape[:3], dtype=np.float32)
+    for start, stop, slab in iter_jacobian_determinant(
+        deformation_field, scales, slab_size=slab_size
+    ):
+        determinant[start:stop] = slab
+    return determinant
+
+
+def save_jacobian_determinant(
+    deformation_field, scales, dest_path, slab_size=16
+):
+    """
+    Save the Jacobian determinant of a deformation field (see
+    ``iter_jacobian_determinant``) as a float32 tiff stack, one slab at a
+    time.
+
+    :param deformation_field: (X, Y, Z, 3) array (can be memory-mapped)
+    :param scales: Scale applied to each component
+    :param dest_path: Where to save the tiff stack
+    :param int slab_size: Number of planes processed at once
+    """
+    image = create_tiff_memmap(
+        dest_path, deformation_field.shape[:3], np.float32
+    )
+    for start, stop, slab in iter_jacobian_determinant(
+        deformation_field, scales, slab_size=slab_size
+    ):
+        image[start:stop] = slab
+    image.flush()
+    del image
+
+
+def save_deformation_field(deformation_field, dest_path, slab_size=16):
+    """
+    Save a deformation field as a single contiguous (X, Y, Z, 3) float32
+    ``.npy`` file, copying one slab (along the first axis) at a time, so
+    the whole field never needs to be in memory. The file can be memory
+    mapped with ``np.load(dest_path, mmap_mode="r")``.
+
+    :param deformation_field: (X, Y, Z, 3) array, or (X, Y, Z, 1, 3) as
+        saved by niftyreg (can be memory-mapped)
+    :param dest_path: Where to save the field
+    :param int slab_size: Number of planes copied at once
+    """
+    shape = tuple(deformation_field.shape[:3])
+    saved_field = np.lib.format.open_memmap(
+        str(dest_path), mode="w+", dtype=np.float32, shape=(*shape, 3)
+    )
+    for start in range(0, shape[0], slab_size):
+        slab = np.asarray(deformation_field[start : start + slab_size])
+        saved_field[start : start + slab_size] = slab.reshape(
+            *slab.shape[:3], 3
+        )
+    saved_field.flush()
+    del saved_field
+
+
+def save_deformation_field_component(
+    deformation_field, dest_path, component, slab_size=16
+):
+    """
+    Save one component of a deformation field as a float32 tiff stack, one
+    slab at a time.
+
+    :param deformation_field: (X, Y, Z, 3) array (can be memory-mapped)
+    :param dest_path: Where to save the tiff stack
+    :param int component: Which component to save
+    :param int slab_size: Number of planes copied at once
+    """
+    shape = deformation_field.shape[:3]
+    image = create_tiff_memmap(dest_path, shape, np.float32)
+    for start in range(0, shape[0], slab_size):
+        image[start : start + slab_size] = deformation_field[
+            start : start + slab_size, :, :, component
+        ]
+    image.flush()
+    del image
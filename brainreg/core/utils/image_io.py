@@ -0,0 +1,130 @@
+import nibabel as nib
+import numpy as np
+import tifffile
+from brainglobe_utils.IO.image.load import load_any, read_z_stack
+from brainglobe_utils.IO.image.save import to_tiff
+
+
+def create_tiff_memmap(dest_path, shape, dtype):
+    """
+    Create an uncompressed (BigTIFF) tiff stack on disk, and return it as a
+    writeable memory map. This allows large volumes to be written slab by
+    slab, without holding the whole volume in memory. The file can be read
+    back with ``tifffile.memmap`` or ``load_any``.
+
+    :param dest_path: Where to save the tiff stack
+    :param shape: Shape of the volume
+    :param dtype: Data type of the volume
+    :return: Memory-mapped array
+    :rtype: np.memmap
+    """
+    return tifffile.memmap(
+        str(dest_path),
+        shape=tuple(int(n) for n in shape),
+        dtype=np.dtype(dtype),
+        bigtiff=True,
+        metadata={"axes": "ZYX"},
+    )
+
+
+def write_tiff_from_slabs(
+    dest_path, slabs, shape, dtype, compression="zlib", tile_size=None
+):
+    """
+    Stream a volume to a (compressed) tiff stack, slab by slab. Each plane is
+    stored as a separate page, so only one slab needs to be in memory at
+    once, and planes can later be read individually.
+
+    :param dest_path: Where to save the tiff stack
+    :param slabs: Iterable of 3D arrays, which are concatenated along the
+        first axis to make up the volume
+    :param shape: Shape of the full volume
+    :param dtype: Data type of the volume
+    :param compression: Compression passed to tifffile, or None
+    :param int tile_size: If given, each plane is written as square tiles
+        of this size (a multiple of 16), rather than as strips, so that part
+        of a plane can be read without decompressing the whole plane
+    """
+
+    def planes():
+        for slab in slabs:
+            for plane in slab:
+                yield np.asarray(plane, dtype=dtype)
+
+    def tiles():
+        for plane in planes():
+            for y in range(0, plane.shape[0], tile_size):
+                for x in range(0, plane.shape[1], tile_size):
+                    # edge tiles are padded to the full tile size
+                    tile = np.zeros((tile_size, tile_size), dtype=dtype)
+                    part = plane[y : y + tile_size, x : x + tile_size]
+                    tile[: part.shape[0], : part.shape[1]] = part
+                    yield tile
+
+    tifffile.imwrite(
+        str(dest_path),
+        data=planes() if tile_size is None else tiles(),
+        shape=tuple(int(n) for n in shape),
+        dtype=np.dtype(dtype),
+        compression=compression,
+        tile=None if tile_size is None else (tile_size, tile_size),
+        bigtiff=True,
+        metadata={"axes": "ZYX"},
+    )
+
+
+def save_tiff(image, dest_path):
+    """
+    Save an image to a tiff stack. Reoriented images (from
+    ``bg.map_stack_to``) are strided views, rather than copies, so that an
+    image is only materialised in the new orientation when it is written.
+    Such images are written one plane at a time, rather than tifffile first
+    making a contiguous copy of the whole volume.
+
+    :param np.ndarray image: Image to save
+    :param dest_path: Where to save the tiff stack
+    """
+    if image.flags.c_contiguous:
+        to_tiff(image, dest_path)
+        return
+    tifffile.imwrite(
+        str(dest_path),
+        data=(np.ascontiguousarray(plane) for plane in image),
+        shape=image.shape,
+        dtype=image.dtype,
+        photometric="minisblack",
+        metadata={"axes": "ZYX"},
+    )
+
+
+def load_image(image, lazy=False):
+    """
+    Load an image, if it is not already loaded.
+
+    :param image: An image, or its path
+    :param bool lazy: If True, tiff stacks are read as memory maps where
+        possible, rather than loaded into memory
+    :return: The image
+    :rtype: np.ndarray
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if lazy:
+        return read_z_stack(str(image))
+    return load_any(image)
+
+
+def get_image_shape(image_path):
+    """
+    Get the shape of an image (as it would be loaded by brainreg), without
+    loading the image data.
+
+    :param image_path: Directory of 2D tiffs, text file listing 2D tiffs,
+        3D tiff or nifti image
+    :return: Image shape
+    :rtype: tuple
+    """
+    image_path = str(image_path)
+    if image_path.endswith((".nii", ".nii.gz")):
+        return tuple(nib.load(image_path).shape[:3])
+    return tuple(read_z_stack(image_path).shape)
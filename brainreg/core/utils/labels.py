@@ -0,0 +1,132 @@
+"""
+labels
+======
+
+Compact storage of registered atlas labels. Rather than saving atlas IDs
+(which can be large numbers, so need uint32), each distinct label is given
+an index, and the image of indices is saved as uint16, alongside a lookup
+table mapping the indices back to atlas IDs.
+
+The lookup table of ``registered_atlas.tiff`` is saved as
+``registered_atlas_labels.csv``, with columns "index" and "id". Index 0 is
+always 0 (outside the brain), so that label images can be masked in the
+same way whether or not they are compact.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from brainreg.core.utils.image_io import load_image
+
+MAX_COMPACT_LABELS = np.iinfo(np.uint16).max + 1
+
+
+def labels_lookup_path(image_path):
+    """
+    :param image_path: Path of a compact label image
+    :return: Path of its lookup table
+    :rtype: str
+    """
+    root, _ = os.path.splitext(str(image_path))
+    return f"{root}_labels.csv"
+
+
+def to_compact_labels(labels):
+    """
+    Convert a label image to a uint16 image of indices, and a lookup table.
+
+    :param np.ndarray labels: Label image
+    :return: Index image and lookup table (atlas ID of each index), or
+        (labels, None) if there are too many labels to fit in uint16
+    :rtype: tuple
+    """
+    lookup, indices = np.unique(
+        np.concatenate(([0], np.unique(labels))), return_inverse=True
+    )
+    if len(lookup) > MAX_COMPACT_LABELS:
+        logging.warning(
+            f"{len(lookup)} labels do not fit in a compact label image, "
+            f"saving atlas IDs instead"
+        )
+        return labels, None
+
+    lookup = lookup.astype(np.uint32, copy=False)
+    compact = np.empty(labels.shape, dtype=np.uint16)
+    # one plane at a time, to avoid an int64 index image
+    for plane, compact_plane in zip(labels, compact):
+        compact_plane[...] = np.searchsorted(lookup, plane)
+    return compact, lookup
+
+
+def restore_labels(indices, lookup):
+    """
+    :param np.ndarray indices: Compact label image
+    :param np.ndarray lookup: Its lookup table
+    :return: Atlas IDs
+    :rtype: np.ndarray
+    """
+    return lookup[indices]
+
+
+def save_labels_lookup(lookup, image_path):
+    """
+    Save the lookup table of a compact label image, next to the image.
+
+    :param np.ndarray lookup: Lookup table
+    :param image_path: Path of the compact label image
+    """
+    pd.DataFrame({"index": np.arange(len(lookup)), "id": lookup}).to_csv(
+        labels_lookup_path(image_path), index=False
+    )
+
+
+def remove_labels_lookup(image_path):
+    """
+    Remove the lookup table of a label image (e.g. left by an earlier
+    registration to the same directory), so that the image is read as atlas
+    IDs.
+
+    :param image_path: Path of the label image
+    """
+    try:
+        os.remove(labels_lookup_path(image_path))
+    except FileNotFoundError:
+        pass
+
+
+def load_labels_lookup(image_path):
+    """
+    Load the lookup table of a label image, if it is compact.
+
+    :param image_path: Path of the label image
+    :return: Lookup table, or None if the image is not compact
+    :rtype: np.ndarray
+    """
+    lookup_path = labels_lookup_path(image_path)
+    if not os.path.exists(lookup_path):
+        return None
+    lookup_df = pd.read_csv(lookup_path)
+    lookup = np.zeros(lookup_df["index"].max() + 1, dtype=np.uint32)
+    lookup[lookup_df["index"].to_numpy()] = lookup_df["id"].to_numpy()
+    return lookup
+
+
+def load_registered_atlas(image_path, lazy=False):
+    """
+    Load a registered atlas image as atlas IDs, whether or not it was saved
+    in compact form.
+
+    :param image_path: Path of the label image
+    :param bool lazy: If True, and the image is not compact, it is read as
+        a memory map where possible
+    :return: Label image of atlas IDs
+    :rtype: np.ndarray
+    """
+    image = load_image(image_path, lazy=lazy)
+    lookup = load_labels_lookup(image_path)
+    if lookup is None:
+        return image
+    return restore_labels(image, lookup)
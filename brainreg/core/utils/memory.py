@@ -0,0 +1,88 @@
+"""
+memory
+======
+
+An optional limit on how much memory brainreg uses. When a limit is set,
+memory-heavy stages process volumes in slabs, sized to fit in whatever is
+left of the limit at the time, rather than all at once.
+"""
+
+from argparse import ArgumentTypeError
+
+import numpy as np
+import psutil
+
+UNITS = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+# never use slabs smaller than this, even if the process is already over
+# its limit, so that progress is always made
+MIN_WORKING_MEMORY = 64 * 1024**2
+
+
+def parse_memory_size(value):
+    """
+    Parse a memory size, e.g. "16G", "512M" or "16" (in GB).
+
+    :param str value:
+    :return: Size in bytes
+    :rtype: int
+    :raises ArgumentTypeError: If the size is not valid
+    """
+    text = str(value).strip().lower().rstrip("b")
+    multiplier = UNITS["g"]
+    if text and text[-1] in UNITS:
+        multiplier = UNITS[text[-1]]
+        text = text[:-1]
+    try:
+        size = float(text)
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is not a valid memory size")
+    if size <= 0:
+        raise ArgumentTypeError(f"{value} is not a valid memory size")
+    return int(size * multiplier)
+
+
+class MemoryBudget:
+    """
+    A limit on the memory used by this process.
+
+    :param max_memory: Maximum memory (in bytes), or None for no limit
+    """
+
+    def __init__(self, max_memory=None):
+        self.max_memory = max_memory
+
+    @property
+    def limited(self):
+        return self.max_memory is not None
+
+    def available(self):
+        """
+        :return: Memory (in bytes) that can still be used, given the memory
+            this process is already using
+        :rtype: float
+        """
+        if not self.limited:
+            return np.inf
+        used = psutil.Process().memory_info().rss
+        return max(self.max_memory - used, MIN_WORKING_MEMORY)
+
+    def slab_size(self, n_planes, bytes_per_plane, default=None):
+        """
+        How many planes to process at once.
+
+        :param int n_planes: Number of planes in the volume
+        :param bytes_per_plane: Working memory needed for each plane,
+            including any temporary arrays
+        :param default: Slab size to use if there is no memory limit. If
+            None, the whole volume is processed at once.
+        :return: Number of planes per slab
+        :rtype: int
+        """
+        if not self.limited:
+            return n_planes if default is None else default
+        n_fit = int(self.available() // max(bytes_per_plane, 1))
+        return int(np.clip(n_fit, 1, n_planes))
+
+    def __repr__(self):
+        return f"MemoryBudget(max_memory={self.max_memory})"
@@ -0,0 +1,190 @@
+import json
+import logging
+
+import brainglobe_space as bg
+import numpy as np
+from brainglobe_atlasapi import BrainGlobeAtlas
+from brainglobe_utils.IO.image.load import load_any
+from tqdm import tqdm
+
+from brainreg.core.paths import Paths
+from brainreg.core.utils.image_io import get_image_shape, write_tiff_from_slabs
+from brainreg.core.utils.labels import load_labels_lookup, restore_labels
+
+
+def get_nearest_indices(n_raw, n_downsampled):
+    """
+    For each raw voxel along an axis, the index of the downsampled voxel
+    containing its centre, so that each downsampled voxel covers an even
+    block of raw voxels.
+
+    :param int n_raw: Number of raw voxels
+    :param int n_downsampled: Number of downsampled voxels
+    :return: Index array of length n_raw
+    :rtype: np.ndarray
+    """
+    scale = n_downsampled / n_raw
+    indices = np.floor((np.arange(n_raw) + 0.5) * scale).astype(np.intp)
+    return np.minimum(indices, n_downsampled - 1)
+
+
+class NativeResolutionAtlas:
+    """
+    The registered atlas at the resolution, and in the orientation, of the
+    raw data.
+
+    This is a lazy array: indexing it computes only the requested voxels,
+    by nearest neighbour upsampling of the registered atlas, so a slab of a
+    volume that would not fit in memory can be generated on demand.
+
+    :param np.ndarray registered_atlas: Registered atlas, as saved by
+        brainreg (atlas resolution, atlas orientation)
+    :param str atlas_orientation: Orientation of the atlas
+    :param str data_orientation: Orientation of the raw data
+    :param raw_shape: Shape of the raw data
+    :param labels_lookup: If the registered atlas is compact, its lookup
+        table, so that atlas IDs are returned
+    """
+
+    def __init__(
+        self,
+        registered_atlas,
+        atlas_orientation,
+        data_orientation,
+        raw_shape,
+        labels_lookup=None,
+    ):
+        # a view, so no copy is made of the registered atlas
+        self.labels = bg.map_stack_to(
+            atlas_orientation, data_orientation, registered_atlas
+        )
+        self.shape = tuple(int(n) for n in raw_shape)
+        self.labels_lookup = labels_lookup
+        self.dtype = (
+            self.labels.dtype if labels_lookup is None else labels_lookup.dtype
+        )
+        self.ndim = 3
+        self._indices = [
+            get_nearest_indices(n_raw, n_downsampled)
+            for n_raw, n_downsampled in zip(self.shape, self.labels.shape)
+        ]
+
+    @classmethod
+    def from_registration_directory(
+        cls, registration_directory, raw_shape=None, atlas=None
+    ):
+        """
+        :param registration_directory: brainreg output directory
+        :param raw_shape: Shape of the raw data. If not given, this is read
+            from the raw data used for registration.
+        :param atlas: BrainGlobeAtlas used for registration. Loaded from the
+            name in brainreg.json if not given.
+        :return: NativeResolutionAtlas
+        """
+        paths = Paths(registration_directory)
+        with open(paths.metadata_path) as f:
+            metadata = json.load(f)
+        if atlas is None:
+            atlas = BrainGlobeAtlas(metadata["atlas"])
+        if raw_shape is None:
+            raw_shape = get_image_shape(metadata["image_paths"])
+
+        return cls(
+            load_any(paths.registered_atlas),
+            atlas.metadata["orientation"],
+            metadata["orientation"],
+            raw_shape,
+            labels_lookup=load_labels_lookup(paths.registered_atlas),
+        )
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3 or any(k is Ellipsis for k in key):
+            raise IndexError(
+                "Only integers and slices (up to one per axis) "
+                "are supported"
+            )
+        key = key + (slice(None),) * (3 - len(key))
+
+        indices = []
+        squeeze = []
+        for axis, (axis_key, axis_indices) in enumerate(
+            zip(key, self._indices)
+        ):
+            if isinstance(axis_key, slice):
+                indices.append(axis_indices[axis_key])
+            else:
+                indices.append(np.atleast_1d(axis_indices[axis_key]))
+                squeeze.append(axis)
+
+        values = self.labels[np.ix_(*indices)]
+        if self.labels_lookup is not None:
+            values = restore_labels(values, self.labels_lookup)
+        if squeeze:
+            values = values.squeeze(axis=tuple(squeeze))
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+    def iter_slabs(self, slab_size=1):
+        """
+        Generate the volume slab by slab along the first axis.
+
+        :param int slab_size: Number of planes per slab
+        """
+        for start in range(0, self.shape[0], slab_size):
+            yield self[start : start + slab_size]
+
+    def save(self, dest_path, slab_size=1):
+        """
+        Save the volume to a compressed tiff stack, one slab at a time.
+
+        :param dest_path: Where to save the tiff stack
+        :param int slab_size: Number of planes generated at once
+        """
+        n_slabs = int(np.ceil(self.shape[0] / slab_size))
+        write_tiff_from_slabs(
+            dest_path,
+            tqdm(
+                self.iter_slabs(slab_size=slab_size),
+                total=n_slabs,
+                desc="upsampling",
+                unit="slab",
+            ),
+            self.shape,
+            self.dtype,
+        )
+
+
+def save_native_resolution_atlas(
+    registered_atlas,
+    atlas_orientation,
+    data_orientation,
+    raw_shape,
+    dest_path,
+    slab_size=1,
+):
+    """
+    Save the registered atlas at the resolution, and in the orientation, of
+    the raw data.
+
+    :param np.ndarray registered_atlas: Registered atlas
+    :param str atlas_orientation: Orientation of the atlas
+    :param str data_orientation: Orientation of the raw data
+    :param raw_shape: Shape of the raw data
+    :param dest_path: Where to save the tiff stack
+    :param int slab_size: Number of planes generated at once
+    """
+    native_atlas = NativeResolutionAtlas(
+        registered_atlas, atlas_orientation, data_orientation, raw_shape
+    )
+    logging.debug(
+        f"Saving registered atlas at native resolution: {native_atlas.shape}"
+    )
+    native_atlas.save(dest_path, slab_size=slab_size)
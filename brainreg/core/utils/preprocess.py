@@ -1,24 +1,102 @@
 import numpy as np
-from brainglobe_utils.image.scale import scale_and_convert_to_16_bits
 from scipy.ndimage import gaussian_filter
 from skimage import morphology
 from tqdm import trange
 
+# Images are filtered in float32. Filtered images are scaled to (at most)
+# 2**16 - 1 before conversion to uint16, and float32 represents values of
+# that size to within 0.004, so the result can only differ from a float64
+# calculation where a value is within that of an integer, and then by one
+# grey level.
+FILTER_DTYPE = np.float32
 
-def filter_image(brain, preprocessing_args=None):
+
+def filter_image(
+    brain, preprocessing_args=None, memory_budget=None, in_place=False
+):
     """
     Filter a 3D image to allow registration
+    :param brain: The image to filter
+    :param preprocessing_args: Pre-processing options
+    :param MemoryBudget memory_budget: If given, and limited, the image is
+        filtered plane by plane into a new float32 array, rather than being
+        converted to float32 as a whole
+    :param bool in_place: Allow the input image to be overwritten. Without
+        a memory limit, a float32 input image is filtered in place, rather
+        than being copied. With a memory limit, the result is written into
+        a uint16 input image, rather than into a new image.
     :return: The filtered brain
     :rtype: np.array
     """
-    brain = brain.astype(np.float64, copy=False)
+    if memory_budget is not None and memory_budget.limited:
+        return filter_image_low_memory(
+            brain, preprocessing_args, memory_budget, in_place=in_place
+        )
+
+    brain = brain.astype(FILTER_DTYPE, copy=not in_place)
     if preprocessing_args and preprocessing_args.preprocessing == "skip":
         pass
     else:  # default pre-processing
         for i in trange(brain.shape[-1], desc="filtering", unit="plane"):
             brain[..., i] = filter_plane(brain[..., i])
-    brain = scale_and_convert_to_16_bits(brain)
-    return brain
+    return scale_to_uint16(brain)
+
+
+def filter_image_low_memory(
+    brain, preprocessing_args, memory_budget, in_place=False
+):
+    """
+    Filter a 3D image as in ``filter_image``, with the same result, but
+    without converting the whole input image to float32 first.
+
+    :param brain: The image to filter
+    :param preprocessing_args: Pre-processing options
+    :param MemoryBudget memory_budget: Memory limit for the scaling step
+    :param bool in_place: Write the result into the input image, if it is a
+        writeable uint16 image
+    :return: The filtered brain
+    :rtype: np.array
+    """
+    if preprocessing_args and preprocessing_args.preprocessing == "skip":
+        filtered = brain
+    else:
+        filtered = np.empty(brain.shape, dtype=FILTER_DTYPE)
+        for i in trange(brain.shape[-1], desc="filtering", unit="plane"):
+            filtered[..., i] = filter_plane(brain[..., i].astype(FILTER_DTYPE))
+
+    out = None
+    if in_place and brain.dtype == np.uint16 and brain.flags.writeable:
+        out = brain
+    # float32 for the scaled slab, and the input slab
+    slab_size = memory_budget.slab_size(
+        brain.shape[0], 2 * 4 * np.prod(brain.shape[1:])
+    )
+    return scale_to_uint16(filtered, out=out, slab_size=slab_size)
+
+
+def scale_to_uint16(image, out=None, slab_size=16):
+    """
+    Scale an image to the full uint16 range, and convert it to uint16, as
+    ``brainglobe_utils.image.scale.scale_and_convert_to_16_bits`` does, but
+    in float32, and one slab at a time rather than with full-size float64
+    temporary arrays. Results can differ from the float64 calculation by
+    one grey level.
+
+    :param np.ndarray image: Image to scale (e.g. a float32 filtered image)
+    :param np.ndarray out: uint16 image to write the result into. If None,
+        a new image is allocated.
+    :param int slab_size: Number of planes scaled at once
+    :return: Scaled image
+    :rtype: np.ndarray
+    """
+    scale = FILTER_DTYPE((2**16 - 1) / float(image.max()))
+    if out is None:
+        out = np.empty(image.shape, dtype=np.uint16)
+    for start in range(0, image.shape[0], slab_size):
+        out[start : start + slab_size] = np.multiply(
+            image[start : start + slab_size], scale, dtype=FILTER_DTYPE
+        )
+    return out
 
 
 def filter_plane(img_plane):
@@ -0,0 +1,417 @@
+"""
+qc
+==
+
+Registration quality metrics, so that failed registrations can be flagged
+without loading the images. All metrics are computed from arrays that are
+already in memory at the end of registration (in the downsampled, atlas
+orientation space).
+"""
+
+import json
+import logging
+
+import numpy as np
+
+from brainreg.core.utils.deformation import (
+    deformation_field_scales,
+    iter_jacobian_determinant,
+)
+from brainreg.core.utils.memory import MemoryBudget
+
+N_HISTOGRAM_BINS = 64
+# regions smaller than this give very noisy correlations
+MIN_REGION_VOXELS = 100
+N_WORST_REGIONS = 10
+
+
+def _slabs(n_planes, slab_size):
+    """
+    Slices along the first axis, slab_size planes at a time (or all at once
+    if slab_size is None).
+    """
+    slab_size = n_planes if slab_size is None else max(int(slab_size), 1)
+    for start in range(0, n_planes, slab_size):
+        yield slice(start, min(start + slab_size, n_planes))
+
+
+def _to_bins(image, n_bins, low, high):
+    image = np.asarray(image, dtype=np.float32)
+    if high == low:
+        return np.zeros(image.shape, dtype=np.intp)
+    bins = (image - low) * ((n_bins - 1) / (high - low))
+    return bins.astype(np.intp)
+
+
+def _entropy(counts):
+    p = counts[counts > 0] / counts.sum()
+    return -np.sum(p * np.log(p))
+
+
+def normalised_mutual_information(
+    image_a, image_b, n_bins=N_HISTOGRAM_BINS, slab_size=None
+):
+    """
+    Normalised mutual information, (H(A) + H(B)) / H(A, B), from a joint
+    histogram. 1 for independent images, 2 for identical images.
+
+    :param np.ndarray image_a:
+    :param np.ndarray image_b: Same shape as image_a
+    :param int n_bins: Number of histogram bins per image
+    :param slab_size: Number of planes to process at once (all if None)
+    :return: NMI
+    :rtype: float
+    """
+    range_a = (float(np.min(image_a)), float(np.max(image_a)))
+    range_b = (float(np.min(image_b)), float(np.max(image_b)))
+    joint = np.zeros(n_bins * n_bins, dtype=np.int64)
+    for slab in _slabs(image_a.shape[0], slab_size):
+        joint += np.bincount(
+            (
+                _to_bins(image_a[slab], n_bins, *range_a) * n_bins
+                + _to_bins(image_b[slab], n_bins, *range_b)
+            ).ravel(),
+            minlength=n_bins * n_bins,
+        )
+    joint = joint.reshape(n_bins, n_bins)
+    joint_entropy = _entropy(joint)
+    if joint_entropy == 0:
+        return np.nan
+    return (
+        _entropy(joint.sum(axis=1)) + _entropy(joint.sum(axis=0))
+    ) / joint_entropy
+
+
+def normalised_cross_correlation(image_a, image_b, slab_size=None):
+    """
+    Normalised cross correlation (Pearson's r) of two images.
+
+    :param np.ndarray image_a:
+    :param np.ndarray image_b: Same shape as image_a
+    :param slab_size: Number of planes to process at once (all if None)
+    :return: NCC
+    :rtype: float
+    """
+    sums = np.zeros(5)
+    for slab in _slabs(image_a.shape[0], slab_size):
+        a = np.asarray(image_a[slab], dtype=np.float32).ravel()
+        b = np.asarray(image_b[slab], dtype=np.float32).ravel()
+        sums += [
+            np.sum(x, dtype=np.float64) for x in (a, b, a * b, a * a, b * b)
+        ]
+
+    n = image_a.size
+    mean_a, mean_b, mean_ab, mean_aa, mean_bb = sums / n
+    covariance = mean_ab - mean_a * mean_b
+    variance_a = mean_aa - mean_a**2
+    variance_b = mean_bb - mean_b**2
+    if variance_a <= 0 or variance_b <= 0:
+        return np.nan
+    return covariance / np.sqrt(variance_a * variance_b)
+
+
+def region_correlations(
+    image_a, image_b, labels, min_voxels=MIN_REGION_VOXELS, slab_size=None
+):
+    """
+    Pearson's r between two images within each labelled region. All regions
+    are computed in a single pass, by accumulating per-label sums with
+    ``np.bincount``.
+
+    :param np.ndarray image_a:
+    :param np.ndarray image_b: Same shape as image_a
+    :param np.ndarray labels: Region labels (0 is background)
+    :param int min_voxels: Regions with fewer voxels are skipped
+    :param slab_size: Number of planes to process at once (all if None)
+    :return: Region ids, correlations and number of voxels in each region
+    :rtype: tuple
+    """
+    slabs = list(_slabs(labels.shape[0], slab_size))
+    region_ids = np.unique(
+        np.concatenate([np.unique(labels[slab]) for slab in slabs])
+    )
+    region_ids = region_ids[region_ids > 0]
+    n_regions = len(region_ids)
+
+    counts = np.zeros(n_regions, dtype=np.int64)
+    # sums of a, b, a * b, a * a and b * b
+    sums = np.zeros((5, n_regions))
+    for slab in slabs:
+        slab_labels = labels[slab]
+        in_brain = slab_labels > 0
+        indices = np.searchsorted(region_ids, slab_labels[in_brain])
+        a = image_a[slab][in_brain].astype(np.float64)
+        b = image_b[slab][in_brain].astype(np.float64)
+
+        counts += np.bincount(indices, minlength=n_regions)
+        for i, weights in enumerate((a, b, a * b, a * a, b * b)):
+            sums[i] += np.bincount(
+                indices, weights=weights, minlength=n_regions
+            )
+
+    sum_a, sum_b, sum_ab, sum_aa, sum_bb = sums
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = sum_ab - sum_a * sum_b / counts
+        variance_a = sum_aa - sum_a**2 / counts
+        variance_b = sum_bb - sum_b**2 / counts
+        correlation = covariance / np.sqrt(variance_a * variance_b)
+
+    keep = (counts >= min_voxels) & np.isfinite(correlation)
+    return region_ids[keep], correlation[keep], counts[keep]
+
+
+def summarise_region_correlations(
+    region_ids, correlations, counts, n_worst=N_WORST_REGIONS
+):
+    """
+    Summarise per-region correlations, listing the worst regions.
+
+    :return: Summary statistics
+    :rtype: dict
+    """
+    if len(correlations) == 0:
+        return {"n_regions": 0}
+
+    worst = np.argsort(correlations)[:n_worst]
+    return {
+        "n_regions": len(correlations),
+        "mean": np.mean(correlations),
+        "median": np.median(correlations),
+        "percentile_5": np.percentile(correlations, 5),
+        "min": np.min(correlations),
+        "worst_regions": [
+            {
+                "id": region_ids[i],
+                "correlation": correlations[i],
+                "n_voxels": counts[i],
+            }
+            for i in worst
+        ],
+    }
+
+
+def get_left_right_axis(orientation):
+    """
+    :param str orientation: brainglobe-space orientation, e.g. "asr"
+    :return: The axis running left to right
+    :rtype: int
+    """
+    for axis, initial in enumerate(orientation.lower()):
+        if initial in "lr":
+            return axis
+    raise ValueError(f"Orientation '{orientation}' has no left-right axis")
+
+
+def _reflect(mask, axis, centre):
+    """
+    Reflect a mask along an axis, about a (voxel) position.
+    """
+    n = mask.shape[axis]
+    flipped = np.flip(mask, axis=axis)
+    # flipped[i] = mask[n - 1 - i], reflected[i] = mask[2 * centre - i]
+    shift = int(round(n - 1 - 2 * centre))
+    reflected = np.zeros_like(mask)
+    source = [slice(None)] * mask.ndim
+    dest = [slice(None)] * mask.ndim
+    if shift >= 0:
+        source[axis] = slice(shift, n)
+        dest[axis] = slice(0, n - shift)
+    else:
+        source[axis] = slice(0, n + shift)
+        dest[axis] = slice(-shift, n)
+    reflected[tuple(dest)] = flipped[tuple(source)]
+    return reflected
+
+
+def hemisphere_metrics(
+    hemispheres,
+    orientation,
+    left_hemisphere_value=1,
+    right_hemisphere_value=2,
+):
+    """
+    Compare the registered hemispheres. The right hemisphere is reflected
+    about the midline of the brain, and compared to the left with the Dice
+    coefficient. Most brains are close to symmetric, so a low value
+    suggests a failed registration.
+
+    :param np.ndarray hemispheres: Registered hemispheres
+    :param str orientation: Orientation of the registered hemispheres
+    :param int left_hemisphere_value:
+    :param int right_hemisphere_value:
+    :return: Hemisphere metrics
+    :rtype: dict
+    """
+    left = hemispheres == left_hemisphere_value
+    right = hemispheres == right_hemisphere_value
+    n_left = int(np.count_nonzero(left))
+    n_right = int(np.count_nonzero(right))
+    metrics = {"left_voxels": n_left, "right_voxels": n_right}
+    if n_left == 0 or n_right == 0:
+        # e.g. single hemisphere data
+        metrics["left_right_volume_ratio"] = None
+        metrics["symmetry_dice"] = None
+        return metrics
+
+    axis = get_left_right_axis(orientation)
+    brain = left | right
+    other_axes = tuple(i for i in range(brain.ndim) if i != axis)
+    profile = brain.sum(axis=other_axes)
+    centre = np.sum(profile * np.arange(len(profile))) / profile.sum()
+
+    overlap = np.count_nonzero(left & _reflect(right, axis, centre))
+    metrics["left_right_volume_ratio"] = n_left / n_right
+    metrics["symmetry_dice"] = 2 * overlap / (n_left + n_right)
+    return metrics
+
+
+def deformation_metrics(
+    deformation_field, atlas_resolution, labels=None, slab_size=16
+):
+    """
+    Statistics of the Jacobian determinant of the deformation field (local
+    volume change from sample to atlas). Values at or below zero mean the
+    transform folds.
+
+    :param deformation_field: (X, Y, Z, 3) array, in mm
+    :param atlas_resolution: Atlas voxel sizes in um
+    :param np.ndarray labels: If given, only include voxels with a non-zero
+        label (i.e. the brain)
+    :param int slab_size: Number of planes to process at once
+    :return: Deformation metrics
+    :rtype: dict
+    """
+    n = 0
+    total = 0.0
+    total_squared = 0.0
+    minimum = np.inf
+    maximum = -np.inf
+    n_folded = 0
+    for start, stop, determinant in iter_jacobian_determinant(
+        deformation_field,
+        deformation_field_scales(atlas_resolution),
+        slab_size=slab_size,
+    ):
+        if labels is not None:
+            determinant = determinant[labels[start:stop] > 0]
+        determinant = determinant[np.isfinite(determinant)]
+        if determinant.size == 0:
+            continue
+        n += determinant.size
+        total += np.sum(determinant, dtype=np.float64)
+        total_squared += np.sum(determinant**2, dtype=np.float64)
+        minimum = min(minimum, determinant.min())
+        maximum = max(maximum, determinant.max())
+        n_folded += int(np.count_nonzero(determinant <= 0))
+
+    if n == 0:
+        return {"n_voxels": 0}
+    mean = total / n
+    return {
+        "n_voxels": n,
+        "jacobian_mean": mean,
+        "jacobian_std": np.sqrt(max(total_squared / n - mean**2, 0)),
+        "jacobian_min": minimum,
+        "jacobian_max": maximum,
+        "fraction_folded": n_folded / n,
+    }
+
+
+def calculate_qc_metrics(
+    registered_atlas_brain,
+    sample,
+    registered_atlas,
+    registered_hemispheres,
+    deformation_field,
+    atlas_resolution,
+    atlas_orientation,
+    memory_budget=None,
+):
+    """
+    Calculate registration quality metrics. All images are in the
+    downsampled (atlas orientation and resolution) space.
+
+    :param np.ndarray registered_atlas_brain: Atlas reference image,
+        registered to the sample
+    :param np.ndarray sample: Filtered sample image
+    :param np.ndarray registered_atlas: Registered atlas labels
+    :param np.ndarray registered_hemispheres: Registered hemispheres. If
+        None, hemisphere metrics are not calculated.
+    :param deformation_field: (X, Y, Z, 3) deformation field, in mm. If
+        None, deformation field metrics are not calculated.
+    :param atlas_resolution: Atlas voxel sizes in um
+    :param str atlas_orientation: Atlas orientation
+    :param MemoryBudget memory_budget: If given, images are processed in
+        slabs that fit in the available memory
+    :return: QC metrics
+    :rtype: dict
+    """
+    plane_size = np.prod(sample.shape[1:])
+    if memory_budget is None:
+        memory_budget = MemoryBudget()
+    # a few float64 (or intp) copies of each image
+    slab_size = memory_budget.slab_size(sample.shape[0], 64 * plane_size)
+
+    logging.debug("Calculating image similarity")
+    metrics = {
+        "nmi": normalised_mutual_information(
+            registered_atlas_brain, sample, slab_size=slab_size
+        ),
+        "ncc": normalised_cross_correlation(
+            registered_atlas_brain, sample, slab_size=slab_size
+        ),
+    }
+
+    logging.debug("Calculating region correlations")
+    metrics["region_correlation"] = summarise_region_correlations(
+        *region_correlations(
+            registered_atlas_brain,
+            sample,
+            registered_atlas,
+            slab_size=slab_size,
+        )
+    )
+
+    if registered_hemispheres is not None:
+        logging.debug("Calculating hemisphere metrics")
+        metrics["hemispheres"] = hemisphere_metrics(
+            registered_hemispheres, atlas_orientation
+        )
+
+    if deformation_field is None:
+        return metrics
+
+    logging.debug("Calculating deformation field metrics")
+    metrics["deformation"] = deformation_metrics(
+        deformation_field,
+        atlas_resolution,
+        labels=registered_atlas,
+        # the field, its derivatives and the Jacobian
+        slab_size=memory_budget.slab_size(
+            sample.shape[0], 128 * plane_size, default=16
+        ),
+    )
+    return metrics
+
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def save_qc_metrics(metrics, dest_path):
+    """
+    Save QC metrics as JSON. Non-finite values are saved as null.
+
+    :param dict metrics:
+    :param dest_path:
+    """
+    with open(dest_path, "w") as f:
+        json.dump(_to_json(metrics), f, indent=4)
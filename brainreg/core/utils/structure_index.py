@@ -0,0 +1,299 @@
+"""
+structure_index
+===============
+
+A spatial index of a registered atlas, so that the voxels, bounding box or
+mask of any structure (or ontology subtree) can be found without scanning
+the whole image.
+
+The voxels of each structure are stored as runs of consecutive voxels along
+the last axis (so each run lies within a single row). These are found by
+reading the image one plane at a time, and then grouped by structure with
+a single sort of the runs (which are far fewer than the voxels). The index
+of ``registered_atlas.tiff`` is saved as ``registered_atlas_index.npz``,
+with arrays:
+
+- "shape": shape of the registered atlas
+- "structure_ids": atlas ID of each structure (not including 0, outside
+  the brain)
+- "voxel_counts": number of voxels of each structure
+- "bounding_boxes": (structures, 2, 3) array of the first voxel, and one
+  past the last voxel, of each structure along each axis
+- "run_offsets": the runs of structure ``i`` are
+  ``run_offsets[i]:run_offsets[i + 1]``
+- "run_starts": flat index of the first voxel of each run
+- "run_lengths": number of voxels in each run
+"""
+
+import numpy as np
+
+
+class StructureIndex:
+    """
+    Spatial index of a registered atlas. Build it with
+    ``build_structure_index``, or load a saved index with ``load``.
+
+    Structures can be given as a single atlas ID, or any number of IDs
+    (e.g. from ``get_subtree_ids``), in which case the result covers all of
+    them. Structures that are not in the registered atlas have no voxels.
+
+    :param shape: Shape of the registered atlas
+    :param structure_ids: Sorted atlas IDs of the structures
+    :param run_offsets: Start of the runs of each structure, and the total
+        number of runs
+    :param run_starts: Flat index of the first voxel of each run
+    :param run_lengths: Number of voxels in each run
+    :param voxel_counts: Number of voxels of each structure (found from the
+        runs if not given)
+    :param bounding_boxes: Bounding box of each structure (found from the
+        runs if not given)
+    """
+
+    def __init__(
+        self,
+        shape,
+        structure_ids,
+        run_offsets,
+        run_starts,
+        run_lengths,
+        voxel_counts=None,
+        bounding_boxes=None,
+    ):
+        self.shape = tuple(int(n) for n in shape)
+        self.structure_ids = np.asarray(structure_ids)
+        self.run_offsets = np.asarray(run_offsets)
+        self.run_starts = np.asarray(run_starts)
+        self.run_lengths = np.asarray(run_lengths)
+        if voxel_counts is None:
+            voxel_counts = _reduce_runs(
+                np.add, self.run_lengths.astype(np.int64), self.run_offsets
+            )
+        self.voxel_counts = np.asarray(voxel_counts)
+        if bounding_boxes is None:
+            bounding_boxes = self._find_bounding_boxes()
+        self.bounding_boxes = np.asarray(bounding_boxes)
+
+    def _find_bounding_boxes(self):
+        first = np.stack(
+            np.unravel_index(self.run_starts, self.shape), axis=-1
+        )
+        last = first.copy()
+        last[:, -1] += self.run_lengths.astype(np.int64) - 1
+        return np.stack(
+            (
+                _reduce_runs(np.minimum, first, self.run_offsets),
+                _reduce_runs(np.maximum, last, self.run_offsets) + 1,
+            ),
+            axis=1,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: Path of a saved index (e.g.
+            ``registered_atlas_index.npz``)
+        :return: StructureIndex
+        """
+        with np.load(path) as saved:
+            return cls(**{name: saved[name] for name in saved.files})
+
+    def save(self, path):
+        """
+        :param path: Where to save the index (an .npz file)
+        """
+        np.savez(
+            path,
+            shape=np.array(self.shape),
+            structure_ids=self.structure_ids,
+            voxel_counts=self.voxel_counts,
+            bounding_boxes=self.bounding_boxes,
+            run_offsets=self.run_offsets,
+            run_starts=self.run_starts,
+            run_lengths=self.run_lengths,
+        )
+
+    def _positions(self, structures):
+        # positions of the structures in the index
+        structures = np.atleast_1d(np.asarray(structures))
+        positions = np.searchsorted(self.structure_ids, structures)
+        positions = positions[positions < len(self.structure_ids)]
+        return positions[self.structure_ids[positions] == structures]
+
+    def _runs(self, structures):
+        positions = self._positions(structures)
+        runs = np.concatenate(
+            [
+                np.arange(self.run_offsets[i], self.run_offsets[i + 1])
+                for i in positions
+            ]
+            + [np.empty(0, dtype=np.int64)]
+        )
+        return self.run_starts[runs], self.run_lengths[runs]
+
+    def voxel_count(self, structures):
+        """
+        :param structures: Atlas ID(s)
+        :return: Number of voxels
+        :rtype: int
+        """
+        return int(self.voxel_counts[self._positions(structures)].sum())
+
+    def bounding_box(self, structures):
+        """
+        :param structures: Atlas ID(s)
+        :return: Slices of the registered atlas covering the structures, or
+            None if they have no voxels
+        :rtype: tuple
+        """
+        positions = self._positions(structures)
+        if len(positions) == 0:
+            return None
+        boxes = self.bounding_boxes[positions]
+        return tuple(
+            slice(int(start), int(stop))
+            for start, stop in zip(boxes[:, 0].min(0), boxes[:, 1].max(0))
+        )
+
+    def flat_indices(self, structures):
+        """
+        :param structures: Atlas ID(s)
+        :return: Flat indices of the voxels of the structures, sorted within
+            each structure
+        :rtype: np.ndarray
+        """
+        starts, lengths = self._runs(structures)
+        starts = starts.astype(np.int64)
+        lengths = lengths.astype(np.int64)
+        # the start of each voxel's run, less the number of voxels before
+        # that run, plus the voxel number
+        run_offsets = np.repeat(
+            starts - (np.cumsum(lengths) - lengths), lengths
+        )
+        return run_offsets + np.arange(len(run_offsets))
+
+    def voxels(self, structures):
+        """
+        :param structures: Atlas ID(s)
+        :return: N x 3 array of the voxel coordinates of the structures
+        :rtype: np.ndarray
+        """
+        return np.stack(
+            np.unravel_index(self.flat_indices(structures), self.shape),
+            axis=-1,
+        )
+
+    def mask(self, structures, crop=False):
+        """
+        :param structures: Atlas ID(s)
+        :param bool crop: If True, only return the bounding box of the
+            structures (see ``bounding_box``)
+        :return: Mask of the structures
+        :rtype: np.ndarray
+        """
+        if not crop:
+            mask = np.zeros(self.shape, dtype=bool)
+            mask.reshape(-1)[self.flat_indices(structures)] = True
+            return mask
+
+        bounding_box = self.bounding_box(structures)
+        if bounding_box is None:
+            return np.zeros((0, 0, 0), dtype=bool)
+        voxels = self.voxels(structures)
+        voxels -= [axis.start for axis in bounding_box]
+        mask = np.zeros(
+            [axis.stop - axis.start for axis in bounding_box], dtype=bool
+        )
+        mask[tuple(voxels.T)] = True
+        return mask
+
+    def crop(self, image, structures):
+        """
+        Crop an image (in the same space as the registered atlas, e.g.
+        ``downsampled.tiff``) to the bounding box of some structures.
+
+        :param image: Image (e.g. a memory map)
+        :param structures: Atlas ID(s)
+        :return: Copy of the bounding box of the image, with voxels outside
+            the structures set to 0, or None if they have no voxels
+        :rtype: np.ndarray
+        """
+        bounding_box = self.bounding_box(structures)
+        if bounding_box is None:
+            return None
+        cropped = np.array(image[bounding_box])
+        cropped[~self.mask(structures, crop=True)] = 0
+        return cropped
+
+
+def _reduce_runs(ufunc, values, run_offsets):
+    """
+    Reduce the values of the runs of each structure.
+    """
+    if len(values) == 0:
+        return values[:0]
+    return ufunc.reduceat(values, run_offsets[:-1], axis=0)
+
+
+def build_structure_index(registered_atlas, labels_lookup=None):
+    """
+    Index the voxels of each structure of a registered atlas. The atlas is
+    read one plane at a time.
+
+    :param registered_atlas: Registered atlas (e.g. a memory map)
+    :param labels_lookup: If the registered atlas is compact, its lookup
+        table
+    :return: StructureIndex
+    """
+    shape = registered_atlas.shape
+    plane_size = int(np.prod(shape[1:]))
+    labels, starts, lengths = [], [], []
+    for plane_number in range(shape[0]):
+        plane = np.asarray(registered_atlas[plane_number]).reshape(-1)
+        # a new run wherever the label changes, or a new row starts
+        new_run = np.empty(len(plane), dtype=bool)
+        new_run[1:] = plane[1:] != plane[:-1]
+        new_run[:: shape[-1]] = True
+        run_first = np.flatnonzero(new_run)
+        run_labels = plane[run_first]
+        inside = run_labels != 0
+        labels.append(run_labels[inside])
+        starts.append(run_first[inside] + plane_number * plane_size)
+        lengths.append(np.diff(run_first, append=len(plane))[inside])
+
+    labels = np.concatenate(labels)
+    # stable, so that runs stay in order of their position
+    order = np.argsort(labels, kind="stable")
+    labels = labels[order]
+    structure_ids, first_run = np.unique(labels, return_index=True)
+    if labels_lookup is not None:
+        structure_ids = np.asarray(labels_lookup)[structure_ids]
+    flat_dtype = np.uint32 if np.prod(shape) <= 2**32 else np.uint64
+    return StructureIndex(
+        shape,
+        structure_ids.astype(np.uint32),
+        np.append(first_run, len(labels)).astype(np.int64),
+        np.concatenate(starts)[order].astype(flat_dtype),
+        np.concatenate(lengths)[order].astype(np.uint32),
+    )
+
+
+def get_subtree_ids(atlas, structure):
+    """
+    :param atlas: BrainGlobeAtlas
+    :param structure: Atlas ID or acronym
+    :return: Atlas IDs of the structure and all of its descendants
+    :rtype: np.ndarray
+    """
+    for candidate in atlas.structures_list:
+        if structure in (candidate["id"], candidate["acronym"]):
+            structure_id = candidate["id"]
+            break
+    else:
+        raise KeyError(f"Structure {structure} is not in the atlas")
+    return np.array(
+        [
+            candidate["id"]
+            for candidate in atlas.structures_list
+            if structure_id in candidate["structure_id_path"]
+        ]
+    )
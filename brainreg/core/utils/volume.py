@@ -9,9 +9,11 @@ import logging
 
 import numpy as np
 import pandas as pd
-from brainglobe_utils.IO.image.load import load_any
 from brainglobe_utils.pandas.misc import initialise_df, safe_pandas_concat
 
+from brainreg.core.utils.cohort import append_cohort_volumes
+from brainreg.core.utils.image_io import load_image
+
 
 class UnknownAtlasValue(Exception):
     pass
@@ -35,14 +37,29 @@ def lateralise_atlas(
     return atlas_left, atlas_right
 
 
+def count_labels(labels, labels_lookup):
+    """
+    Count the voxels of each label in a compact label image.
+
+    :param np.ndarray labels: Compact label values
+    :param np.ndarray labels_lookup: Atlas ID of each compact label
+    :return: Atlas IDs present, and their counts
+    """
+    counts = np.bincount(labels, minlength=len(labels_lookup))
+    present = np.flatnonzero(counts)
+    return labels_lookup[present], counts[present]
+
+
 def get_lateralised_atlas(
     atlas_path,
     hemispheres_path,
     left_hemisphere_value=1,
     right_hemisphere_value=2,
+    labels_lookup=None,
 ):
-    atlas = load_any(atlas_path)
-    hemispheres = load_any(hemispheres_path)
+    # either may already be loaded
+    atlas = load_image(atlas_path)
+    hemispheres = load_image(hemispheres_path)
 
     atlas_left, atlas_right = lateralise_atlas(
         atlas,
@@ -51,10 +68,19 @@ def get_lateralised_atlas(
         right_hemisphere_value=right_hemisphere_value,
     )
 
-    unique_vals_left, counts_left = np.unique(atlas_left, return_counts=True)
-    unique_vals_right, counts_right = np.unique(
-        atlas_right, return_counts=True
-    )
+    if labels_lookup is not None:
+        # counting compact labels avoids sorting
+        unique_vals_left, counts_left = count_labels(atlas_left, labels_lookup)
+        unique_vals_right, counts_right = count_labels(
+            atlas_right, labels_lookup
+        )
+    else:
+        unique_vals_left, counts_left = np.unique(
+            atlas_left, return_counts=True
+        )
+        unique_vals_right, counts_right = np.unique(
+            atlas_right, return_counts=True
+        )
     return unique_vals_left, unique_vals_right, counts_left, counts_right
 
 
@@ -123,7 +149,27 @@ def calculate_volumes(
     left_hemisphere_value=1,
     right_hemisphere_value=2,
     brain_geometry="full",
+    labels_lookup=None,
+    cohort_store=None,
+    sample_id=None,
 ):
+    """
+    Calculate the volume of each brain region, in each hemisphere, and save
+    them to a csv file.
+
+    :param atlas: BrainGlobeAtlas
+    :param registered_atlas_path: The registered atlas, or its path
+    :param hemispheres_path: The registered hemispheres, or their path
+    :param output_file: Where to save the volumes
+    :param int left_hemisphere_value: Value of the left hemisphere
+    :param int right_hemisphere_value: Value of the right hemisphere
+    :param str brain_geometry: "full", "hemisphere_l" or "hemisphere_r"
+    :param labels_lookup: If the registered atlas is compact, its lookup
+        table
+    :param cohort_store: If given, the volumes are also added to this cohort
+        store (see ``brainreg.core.utils.cohort``)
+    :param str sample_id: ID of the sample in the cohort store
+    """
     (
         unique_vals_left,
         unique_vals_right,
@@ -134,6 +180,7 @@ def calculate_volumes(
         hemispheres_path,
         left_hemisphere_value=left_hemisphere_value,
         right_hemisphere_value=right_hemisphere_value,
+        labels_lookup=labels_lookup,
     )
 
     structures_reference_df = atlas.lookup_df
@@ -146,6 +193,7 @@ def calculate_volumes(
         "total_volume_mm3",
     )
     unique_vals = np.union1d(unique_vals_left, unique_vals_right)
+    structure_ids = []
 
     for atlas_value in unique_vals:
         if atlas_value != 0:  # outside brain
@@ -161,6 +209,7 @@ def calculate_volumes(
                     voxel_volume_in_mm,
                     brain_geometry,
                 )
+                structure_ids.append(atlas_value)
             except UnknownAtlasValue:
                 print(
                     "Value: {} is not in the atlas structure reference file. "
@@ -168,3 +217,13 @@ def calculate_volumes(
                 )
 
     df.to_csv(output_file, index=False)
+
+    if cohort_store is not None:
+        append_cohort_volumes(
+            cohort_store,
+            sample_id,
+            atlas.atlas_name,
+            structure_ids,
+            df["left_volume_mm3"],
+            df["right_volume_mm3"],
+        )
@@ -0,0 +1,138 @@
+"""
+writer
+======
+
+Write outputs in background threads, so that encoding and writing each
+image overlaps with the next stage of the pipeline, rather than holding it
+up. The number of writes waiting at once is bounded, which limits the
+memory held by images that have not been written yet.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from brainreg.core.utils.image_io import save_tiff
+
+
+class OutputWriteError(Exception):
+    pass
+
+
+class AsyncWriter:
+    """
+    A bounded pool of threads writing outputs.
+
+    Errors are raised by the next call to ``write``, ``wait``, ``flush`` or
+    ``close``, as an ``OutputWriteError`` naming the file that could not be
+    written.
+
+    :param int n_threads: Number of writer threads. If 0, outputs are written
+        immediately, in the calling thread.
+    :param int max_pending: Maximum number of outputs queued or being
+        written. Further calls to ``write`` wait until one has finished.
+    """
+
+    def __init__(self, n_threads=2, max_pending=4):
+        self.n_threads = n_threads
+        self._executor = None
+        if n_threads > 0:
+            self._executor = ThreadPoolExecutor(
+                max_workers=n_threads, thread_name_prefix="brainreg_writer"
+            )
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self._futures = {}
+
+    def write(self, function, data, dest_path, **kwargs):
+        """
+        Write ``data`` to ``dest_path`` by calling
+        ``function(data, dest_path, **kwargs)``. The data must not be
+        modified until it has been written.
+
+        :param function: Function that writes the data
+        :param data: Data to write
+        :param dest_path: Where to write the data
+        """
+        self._raise_errors()
+        dest_path = str(dest_path)
+        if self._executor is None:
+            self._run(function, data, dest_path, kwargs)
+            return
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                self._run, function, data, dest_path, kwargs
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures[dest_path] = future
+
+    def write_tiff(self, image, dest_path):
+        """
+        Write an image to a tiff file (see ``save_tiff``).
+
+        :param np.ndarray image: Image to write, which can be a reoriented
+            view
+        :param dest_path: Where to write the image
+        """
+        self.write(save_tiff, image, dest_path)
+
+    @staticmethod
+    def _run(function, data, dest_path, kwargs):
+        logging.debug(f"Writing {dest_path}")
+        try:
+            function(data, dest_path, **kwargs)
+        except Exception as err:
+            raise OutputWriteError(
+                f"Could not write {dest_path}; {err}"
+            ) from err
+
+    def _raise_errors(self):
+        for dest_path, future in list(self._futures.items()):
+            if future.done():
+                del self._futures[dest_path]
+                future.result()
+
+    def wait(self, *dest_paths):
+        """
+        Wait until the given outputs have been written, e.g. before reading
+        them back.
+
+        :param dest_paths: Outputs to wait for
+        """
+        for dest_path in dest_paths:
+            future = self._futures.pop(str(dest_path), None)
+            if future is not None:
+                future.result()
+        self._raise_errors()
+
+    def flush(self):
+        """
+        Wait until all outputs have been written.
+        """
+        self.wait(*list(self._futures))
+
+    def close(self):
+        """
+        Wait until all outputs have been written, and stop the writer
+        threads.
+        """
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # finish what has been queued, but do not hide the original error
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,468 @@
+"""
+worker
+======
+
+Register a cohort of samples from a queue directory on a shared file system.
+Any number of workers, on any number of machines, can process the same
+queue at once, with no other service needed.
+
+Each sample is a JSON file in the queue directory, listing the arguments to
+pass to brainreg, e.g. ``brain_1.json``::
+
+    {"args": ["/data/brain_1", "/results/brain_1", "-v", "5", "2", "2",
+              "--orientation", "psl"]}
+
+A worker claims a sample by atomically creating ``brain_1.claim``,
+containing its worker id. While the sample is registered, the worker updates
+the modification time of the claim file (a heartbeat). When registration
+finishes, ``brain_1.done`` or ``brain_1.failed`` is written, and the claim is
+removed. If a worker crashes, its claim stops being updated, and after
+``stale_timeout`` seconds another worker takes over the sample. A worker
+checks that the claim file still contains its own id before each heartbeat,
+before writing the result and before removing the claim, so a worker that
+was only slow (rather than crashed) does not interfere with the worker that
+took over.
+"""
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from datetime import datetime
+from glob import glob
+
+from brainglobe_utils.general.numerical import (
+    check_positive_float,
+    check_positive_int,
+)
+from fancylog import fancylog
+
+import brainreg as package_for_log
+
+TASK_SUFFIX = ".json"
+CLAIM_SUFFIX = ".claim"
+RECOVERY_SUFFIX = ".recover"
+DONE_SUFFIX = ".done"
+FAILED_SUFFIX = ".failed"
+LOG_SUFFIX = ".log"
+
+PENDING = "pending"
+CLAIMED = "claimed"
+STALE = "stale"
+DONE = "done"
+FAILED = "failed"
+
+
+def worker_cli_parser():
+    parser = ArgumentParser(
+        prog="brainreg worker",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+        description="Register samples from a queue directory, until none "
+        "are left. Several workers can share the same queue.",
+    )
+    parser.add_argument(
+        dest="queue_directory",
+        type=str,
+        help="Queue directory, containing one JSON file per sample.",
+    )
+    parser.add_argument(
+        "--heartbeat-interval",
+        dest="heartbeat_interval",
+        type=check_positive_float,
+        default=30,
+        help="How often (in seconds) to mark a claimed sample as still being "
+        "processed.",
+    )
+    parser.add_argument(
+        "--stale-timeout",
+        dest="stale_timeout",
+        type=check_positive_float,
+        default=600,
+        help="How long (in seconds) without a heartbeat before a claimed "
+        "sample is assumed to belong to a crashed worker, and is taken "
+        "over. Must be much longer than the heartbeat interval.",
+    )
+    parser.add_argument(
+        "--wait",
+        dest="wait",
+        action="store_true",
+        help="Keep running until every sample is done or failed, so that "
+        "samples claimed by workers that crash are taken over. Otherwise, "
+        "exit once there are no samples left to claim.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        dest="poll_interval",
+        type=check_positive_int,
+        default=60,
+        help="With --wait, how often (in seconds) to check the queue.",
+    )
+    return parser
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Claim:
+    """
+    A claim on a sample in the queue, kept alive by a heartbeat thread.
+
+    :param str name: Name of the sample
+    :param str path: Path of the claim file
+    :param float heartbeat_interval: Seconds between heartbeats
+    :param str worker_id: Id of the worker that made the claim
+    """
+
+    def __init__(self, name, path, heartbeat_interval, worker_id):
+        self.name = name
+        self.path = path
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = worker_id
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+
+    def is_owned(self):
+        """
+        :return: True if the claim file still belongs to this worker, i.e.
+            it has not been taken over by another worker
+        :rtype: bool
+        """
+        try:
+            with open(self.path) as f:
+                return f.read() == self.worker_id
+        except FileNotFoundError:
+            return False
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            if not self.is_owned():
+                logging.warning(
+                    f"Claim on {self.name} was taken over by another worker"
+                )
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        if not self.is_owned():
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class TaskQueue:
+    """
+    A directory of samples to register, shared by any number of workers.
+
+    :param str queue_directory: Queue directory
+    :param float stale_timeout: Seconds without a heartbeat before a claim is
+        considered stale
+    :param float heartbeat_interval: Seconds between heartbeats
+    :param str worker_id: Identifies this worker in claim and result files
+    """
+
+    def __init__(
+        self,
+        queue_directory,
+        stale_timeout=600,
+        heartbeat_interval=30,
+        worker_id=None,
+    ):
+        self.queue_directory = str(queue_directory)
+        self.stale_timeout = stale_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = worker_id or get_worker_id()
+
+    def path(self, name, suffix):
+        return os.path.join(self.queue_directory, name + suffix)
+
+    def tasks(self):
+        """
+        :return: Names of all samples in the queue
+        :rtype: list
+        """
+        return sorted(
+            os.path.basename(path)[: -len(TASK_SUFFIX)]
+            for path in glob(os.path.join(self.queue_directory, "*.json"))
+        )
+
+    def load_task(self, name):
+        with open(self.path(name, TASK_SUFFIX)) as f:
+            return json.load(f)
+
+    def _file_system_time(self):
+        """
+        The current time according to the file system. Heartbeats are
+        compared to this, rather than to the local clock, so that the clocks
+        of different machines do not need to agree.
+        """
+        clock_path = self.path(f".clock_{self.worker_id}", "")
+        with open(clock_path, "w"):
+            pass
+        now = os.stat(clock_path).st_mtime
+        os.remove(clock_path)
+        return now
+
+    def _is_stale(self, path, now):
+        try:
+            return now - os.stat(path).st_mtime > self.stale_timeout
+        except FileNotFoundError:
+            return False
+
+    def status(self, name, now=None):
+        """
+        :param str name: Name of the sample
+        :param now: File system time (looked up if not given)
+        :return: One of "pending", "claimed", "stale", "done" or "failed"
+        :rtype: str
+        """
+        if os.path.exists(self.path(name, DONE_SUFFIX)):
+            return DONE
+        if os.path.exists(self.path(name, FAILED_SUFFIX)):
+            return FAILED
+        claim_path = self.path(name, CLAIM_SUFFIX)
+        if not os.path.exists(claim_path):
+            return PENDING
+        if now is None:
+            now = self._file_system_time()
+        return STALE if self._is_stale(claim_path, now) else CLAIMED
+
+    def _create_exclusive(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker_id)
+        return True
+
+    def _recover(self, name, now):
+        """
+        Remove a stale claim. Only one worker can hold the recovery lock, and
+        it checks again that the claim is stale, so a claim that has just
+        been made by another worker is never removed.
+        """
+        recovery_path = self.path(name, RECOVERY_SUFFIX)
+        if self._is_stale(recovery_path, now):
+            # a worker crashed while recovering
+            try:
+                os.remove(recovery_path)
+            except FileNotFoundError:
+                pass
+        if not self._create_exclusive(recovery_path):
+            return
+        try:
+            claim_path = self.path(name, CLAIM_SUFFIX)
+            if self._is_stale(claim_path, now):
+                with open(claim_path) as f:
+                    previous_worker = f.read()
+                logging.warning(
+                    f"Taking over {name} from {previous_worker}, which has "
+                    f"not updated its claim in {self.stale_timeout} seconds"
+                )
+                os.remove(claim_path)
+        finally:
+            os.remove(recovery_path)
+
+    def claim(self, name, now=None):
+        """
+        Try to claim a sample. Stale claims are recovered first.
+
+        :param str name: Name of the sample
+        :param now: File system time (looked up if not given)
+        :return: The claim, or None if the sample could not be claimed
+        :rtype: Claim
+        """
+        if now is None:
+            now = self._file_system_time()
+        status = self.status(name, now=now)
+        if status == STALE:
+            self._recover(name, now)
+        elif status != PENDING:
+            return None
+
+        claim_path = self.path(name, CLAIM_SUFFIX)
+        if not self._create_exclusive(claim_path):
+            return None
+        if self.status(name, now=now) in (DONE, FAILED):
+            # finished by another worker after the status was checked
+            os.remove(claim_path)
+            return None
+        return Claim(name, claim_path, self.heartbeat_interval, self.worker_id)
+
+    def claim_next(self):
+        """
+        Claim the next sample that is not being processed.
+
+        :return: The claim, or None if there are no samples to claim
+        :rtype: Claim
+        """
+        now = self._file_system_time()
+        for name in self.tasks():
+            claim = self.claim(name, now=now)
+            if claim is not None:
+                return claim
+        return None
+
+    def unfinished(self):
+        """
+        :return: Names of samples that are not done or failed
+        :rtype: list
+        """
+        now = self._file_system_time()
+        return [
+            name
+            for name in self.tasks()
+            if self.status(name, now=now) not in (DONE, FAILED)
+        ]
+
+    def record_result(self, name, returncode, start_time, end_time):
+        """
+        Mark a sample as done (or failed, for a non-zero return code).
+        """
+        result = {
+            "worker": self.worker_id,
+            "returncode": returncode,
+            "start_time": start_time.isoformat(),
+            "end_time": end_time.isoformat(),
+            "duration": (end_time - start_time).total_seconds(),
+        }
+        suffix = DONE_SUFFIX if returncode == 0 else FAILED_SUFFIX
+        with open(self.path(name, suffix), "w") as f:
+            json.dump(result, f, indent=4)
+
+
+def _record_result(queue, claim, returncode, start_time, end_time):
+    if claim.is_owned():
+        queue.record_result(claim.name, returncode, start_time, end_time)
+    else:
+        logging.warning(
+            f"Not recording the result of {claim.name}, as it was taken over "
+            f"by another worker"
+        )
+
+
+def run_task(queue, claim):
+    """
+    Run brainreg for a claimed sample, in a subprocess, and record the
+    result (unless the sample has been taken over by another worker in the
+    meantime). The output of brainreg is saved to a log file in the queue.
+
+    :param TaskQueue queue:
+    :param Claim claim:
+    :return: brainreg return code
+    :rtype: int
+    """
+    name = claim.name
+    with claim:
+        try:
+            args = [str(arg) for arg in queue.load_task(name)["args"]]
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logging.error(f"Could not read the arguments for {name}: {err}")
+            now = datetime.now()
+            _record_result(queue, claim, -1, now, now)
+            return -1
+
+        logging.info(f"Registering {name}")
+        start_time = datetime.now()
+        with open(queue.path(name, LOG_SUFFIX), "a") as log_file:
+            returncode = subprocess.call(
+                [sys.executable, "-m", "brainreg.core.cli", *args],
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+        end_time = datetime.now()
+        _record_result(queue, claim, returncode, start_time, end_time)
+
+    if returncode == 0:
+        logging.info(f"Finished {name} in {end_time - start_time}")
+    else:
+        logging.error(
+            f"{name} failed (return code {returncode}), see "
+            f"{queue.path(name, LOG_SUFFIX)}"
+        )
+    return returncode
+
+
+def run_worker(
+    queue_directory,
+    heartbeat_interval=30,
+    stale_timeout=600,
+    wait=False,
+    poll_interval=60,
+):
+    """
+    Register samples from the queue until none are left.
+
+    :param queue_directory: Queue directory
+    :param float heartbeat_interval: Seconds between heartbeats
+    :param float stale_timeout: Seconds without a heartbeat before a claim
+        is taken over
+    :param bool wait: If True, keep running until all samples are done or
+        failed, rather than exiting when there is nothing left to claim
+    :param int poll_interval: Seconds between checks of the queue, if wait
+    :return: Number of samples processed, and number that failed
+    :rtype: tuple
+    """
+    queue = TaskQueue(
+        queue_directory,
+        stale_timeout=stale_timeout,
+        heartbeat_interval=heartbeat_interval,
+    )
+    n_processed = 0
+    n_failed = 0
+    while True:
+        claim = queue.claim_next()
+        if claim is not None:
+            n_processed += 1
+            n_failed += run_task(queue, claim) != 0
+            continue
+
+        if not wait or not queue.unfinished():
+            break
+        time.sleep(poll_interval)
+
+    return n_processed, n_failed
+
+
+def main(argv=None):
+    start_time = datetime.now()
+    args = worker_cli_parser().parse_args(argv)
+
+    fancylog.start_logging(
+        args.queue_directory,
+        package=package_for_log,
+        variables=[args],
+        log_header="BRAINREG WORKER LOG",
+        filename=f"brainreg_worker_{get_worker_id().replace(':', '_')}",
+        multiprocessing_aware=False,
+    )
+
+    n_processed, n_failed = run_worker(
+        args.queue_directory,
+        heartbeat_interval=args.heartbeat_interval,
+        stale_timeout=args.stale_timeout,
+        wait=args.wait,
+        poll_interval=args.poll_interval,
+    )
+
+    logging.info(
+        f"Processed {n_processed} samples ({n_failed} failed). "
+        f"Total time taken: {datetime.now() - start_time}"
+    )
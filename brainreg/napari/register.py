@@ -24,9 +24,11 @@ from qtpy.QtWidgets import QScrollArea
 import brainreg as package_for_log
 from brainreg.core.backend.niftyreg.run import run_niftyreg
 from brainreg.core.paths import Paths
+from brainreg.core.utils.artifacts import ArtifactStore
 from brainreg.core.utils.boundaries import boundaries
 from brainreg.core.utils.misc import log_metadata
 from brainreg.core.utils.volume import calculate_volumes
+from brainreg.core.utils.writer import AsyncWriter
 from brainreg.napari.util import (
     NiftyregArgs,
     downsample_and_save_brain,
@@ -475,6 +477,7 @@ def brainreg_register():
                 data_orientation, atlas.metadata["orientation"], target_brain
             )
             sort_input_file = False
+            artifacts = ArtifactStore(AsyncWriter())
             run_niftyreg(
                 registration_output_folder,
                 paths,
@@ -493,13 +496,14 @@ def brainreg_register():
                 save_original_orientation=save_original_orientation,
                 brain_geometry=brain_geometry.value,
                 debug=debug,
+                artifacts=artifacts,
             )
 
             logging.info("Calculating volumes of each brain area")
             calculate_volumes(
                 atlas,
-                paths.registered_atlas,
-                paths.registered_hemispheres,
+                artifacts.get(paths.registered_atlas),
+                artifacts.get(paths.registered_hemispheres),
                 paths.volume_csv_path,
                 # for all brainglobe atlases
                 left_hemisphere_value=1,
@@ -508,7 +512,12 @@ def brainreg_register():
             )
 
             logging.info("Generating boundary image")
-            boundaries(paths.registered_atlas, paths.boundaries_file_path)
+            boundaries(
+                artifacts.get(paths.registered_atlas),
+                paths.boundaries_file_path,
+                writer=artifacts.writer,
+            )
+            artifacts.writer.close()
 
             logging.info(
                 f"brainreg completed. Results can be found here: "
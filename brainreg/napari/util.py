@@ -55,8 +55,11 @@ def downsample_and_save_brain(
         preserve_range=preserve_range,
         mode=mode,
     ).shape
+    # float32 is enough for the downsampled image, which is scaled to uint16
+    # for registration
     preallocated_array = np.empty(
-        (img_layer.data.shape[0], first_frame_shape[0], first_frame_shape[1])
+        (img_layer.data.shape[0], first_frame_shape[0], first_frame_shape[1]),
+        dtype=np.float32,
     )
     print("Downsampling data in x, y")
     for i, img in tqdm(enumerate(img_layer.data)):
@@ -77,7 +80,8 @@ def downsample_and_save_brain(
         mode=mode,
     ).shape
     downsampled_array = np.empty(
-        (first_ds_frame_shape[0], first_frame_shape[0], first_frame_shape[1])
+        (first_ds_frame_shape[0], first_frame_shape[0], first_frame_shape[1]),
+        dtype=np.float32,
     )
     print("Downsampling data in z")
     for i, img in tqdm(enumerate(preallocated_array.T)):
@@ -109,3 +113,4 @@ class NiftyregArgs:
     histogram_n_bins_floating: float
     histogram_n_bins_reference: float
     debug: bool
+    inverse_method: str = "freeform"
@@ -63,3 +63,72 @@ def test_register_hemispheres_raises_segmentation_error():
     ):
         with pytest.raises(SegmentationError):
             reg.register_hemispheres()
+
+
+@pytest.mark.parametrize(
+    "inverse_method, expected_transform",
+    [
+        ("freeform", "inverse_cpp.nii"),
+        ("invert", "inverse_def.nii"),
+        ("symmetric", "cpp_backward.nii"),
+    ],
+)
+def test_transform_to_standard_space_uses_inverse_method(
+    inverse_method, expected_transform
+):
+    """
+    Ensure images are resampled into standard space with the transform
+    generated by the selected inverse method.
+    """
+    reg = _make_registration()
+    reg.reg_params.inverse_method = inverse_method
+    reg.paths.inverse_control_point_file_path = "inverse_cpp.nii"
+    reg.paths.inverse_deformation_field = "inverse_def.nii"
+    reg.paths.backward_control_point_file_path = "cpp_backward.nii"
+
+    cmd = reg._prepare_inverse_registration_cmd("flo.nii", "res.nii")
+    assert cmd[cmd.index("-cpp") + 1] == expected_transform
+
+
+def test_invert_mode_skips_inverse_freeform_registration():
+    """
+    Ensure the invert mode inverts the forward transform rather than
+    running a second freeform registration.
+    """
+    reg = _make_registration()
+    reg.reg_params.inverse_method = "invert"
+    reg.reg_params.transform_program_path = "reg_transform"
+    reg.paths.inverse_deformation_field = "inverse_def.nii"
+    reg.brain_of_atlas_img_path = "brain_filtered.nii"
+
+    with patch(
+        "brainreg.core.backend.niftyreg.registration.safe_execute_command"
+    ) as execute:
+        reg.generate_inverse_transforms()
+
+    assert execute.call_count == 1
+    cmd = execute.call_args[0][0]
+    assert cmd[0] == "reg_transform"
+    assert cmd[cmd.index("-invNrr") + 1 :] == [
+        "cpp.nii",
+        "brain_filtered.nii",
+        "inverse_def.nii",
+    ]
+
+
+def test_symmetric_mode_uses_velocity_field():
+    """
+    Ensure the symmetric mode runs a single velocity field freeform
+    registration, and no separate inverse step.
+    """
+    reg = _make_registration()
+    reg.reg_params.inverse_method = "symmetric"
+    reg.reg_params.format_freeform_params.return_value = ""
+
+    assert "-vel" in reg._prepare_freeform_reg_cmd()
+
+    with patch(
+        "brainreg.core.backend.niftyreg.registration.safe_execute_command"
+    ) as execute:
+        reg.generate_inverse_transforms()
+    execute.assert_not_called()
@@ -0,0 +1,39 @@
+import numpy as np
+from brainglobe_utils.IO.image.load import load_any
+from brainglobe_utils.IO.image.save import to_tiff
+
+from brainreg.core.utils.artifacts import ArtifactStore
+from brainreg.core.utils.writer import AsyncWriter
+
+
+def test_artifacts_are_kept_in_memory(tmp_path):
+    image = np.arange(60, dtype=np.uint32).reshape(3, 4, 5)
+    dest_path = tmp_path / "registered_atlas.tiff"
+    with AsyncWriter() as writer:
+        artifacts = ArtifactStore(writer)
+        artifacts.put(dest_path, image)
+        assert dest_path in artifacts
+        assert artifacts.get(dest_path) is image
+
+    np.testing.assert_array_equal(load_any(dest_path), image)
+
+    artifacts.discard(dest_path)
+    assert dest_path not in artifacts
+    np.testing.assert_array_equal(artifacts.get(dest_path), image)
+
+
+def test_artifacts_read_from_disk(tmp_path):
+    image = np.arange(60, dtype=np.uint16).reshape(3, 4, 5)
+    existing_path = tmp_path / "existing.tiff"
+    to_tiff(image, existing_path)
+    new_path = tmp_path / "new.tiff"
+
+    artifacts = ArtifactStore(AsyncWriter(), keep_in_memory=False)
+    artifacts.put(new_path, image)
+    assert new_path not in artifacts
+
+    for path in (existing_path, new_path):
+        loaded = artifacts.get(path)
+        assert loaded is not image
+        np.testing.assert_array_equal(loaded, image)
+    artifacts.writer.close()
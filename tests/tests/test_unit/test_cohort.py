@@ -0,0 +1,121 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from brainreg.core.cli import main as brainreg_run
+from brainreg.core.utils.volume import calculate_volumes
+
+pytest.importorskip("pyarrow")
+
+from brainreg.core.utils.cohort import (  # noqa: E402
+    append_cohort_volumes,
+    load_cohort_volumes,
+)
+
+
+def test_append_and_load(tmp_path):
+    store = tmp_path / "cohort"
+    append_cohort_volumes(store, "a", "atlas", [1, 5], [1.0, 2.0], [3.0, 4.0])
+    append_cohort_volumes(store, "b/1", "atlas", [5, 9], [0.5, 1.0], [0, 0])
+
+    volumes = load_cohort_volumes(store)
+    assert volumes.index.tolist() == [1, 5, 9]
+    assert sorted(volumes.columns) == ["a", "b/1"]
+    np.testing.assert_array_equal(volumes["a"], [4.0, 6.0, 0.0])
+    np.testing.assert_array_equal(volumes["b/1"], [0.0, 0.5, 1.0])
+    np.testing.assert_array_equal(
+        load_cohort_volumes(store, "left_volume_mm3")["a"], [1.0, 2.0, 0.0]
+    )
+
+    # adding a sample again replaces it
+    append_cohort_volumes(store, "a", "atlas", [1], [10.0], [0.0])
+    np.testing.assert_array_equal(load_cohort_volumes(store)["a"], [10, 0, 0])
+
+    with pytest.raises(ValueError):
+        load_cohort_volumes(store, "volume")
+
+
+def test_concurrent_appends(tmp_path):
+    store = tmp_path / "cohort"
+
+    def append(idx):
+        append_cohort_volumes(
+            store, f"sample_{idx}", "atlas", [1, 2], [idx, 1.0], [idx, 0]
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(append, range(32)))
+
+    volumes = load_cohort_volumes(store)
+    assert volumes.shape == (2, 32)
+    for idx in range(32):
+        np.testing.assert_array_equal(volumes[f"sample_{idx}"], [2 * idx, 1])
+    # no temporary files are left behind
+    assert len(list(store.iterdir())) == 32
+
+
+def test_mixed_atlases(tmp_path):
+    store = tmp_path / "cohort"
+    append_cohort_volumes(store, "a", "atlas_1", [1], [1.0], [1.0])
+    append_cohort_volumes(store, "b", "atlas_2", [1], [1.0], [1.0])
+    with pytest.raises(ValueError):
+        load_cohort_volumes(store)
+
+
+def test_calculate_volumes(tmp_path):
+    atlas = SimpleNamespace(
+        atlas_name="atlas",
+        metadata={"resolution": (100, 100, 100)},
+        lookup_df=pd.DataFrame({"id": [5, 7], "name": ["five", "seven"]}),
+    )
+    registered_atlas = np.zeros((4, 4, 4), dtype=np.uint32)
+    registered_atlas[:2, :2] = 5
+    registered_atlas[2:, 2:] = 7
+    hemispheres = np.ones((4, 4, 4), dtype=np.uint8)
+    hemispheres[..., 2:] = 2
+
+    store = tmp_path / "cohort"
+    calculate_volumes(
+        atlas,
+        registered_atlas,
+        hemispheres,
+        tmp_path / "volumes.csv",
+        cohort_store=store,
+        sample_id="sample",
+    )
+
+    csv_volumes = pd.read_csv(tmp_path / "volumes.csv")
+    volumes = load_cohort_volumes(store)
+    assert volumes.index.tolist() == [5, 7]
+    np.testing.assert_allclose(
+        volumes["sample"], csv_volumes["total_volume_mm3"]
+    )
+
+
+def test_missing_pyarrow_fails_before_registering(tmp_path, monkeypatch):
+    # importing pyarrow fails
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "brainreg",
+            str(tmp_path / "raw"),
+            str(tmp_path / "output"),
+            "-v",
+            "50",
+            "50",
+            "50",
+            "--orientation",
+            "psl",
+            "--cohort-volumes",
+            str(tmp_path / "cohort"),
+        ],
+    )
+    with pytest.raises(SystemExit):
+        brainreg_run()
+    assert not (tmp_path / "output").exists()
@@ -0,0 +1,111 @@
+import os
+import sys
+
+import pytest
+
+from brainreg.core.utils import cores as cores_module
+from brainreg.core.utils.cores import (
+    CorePinningNotSupportedError,
+    NoFreeCoresError,
+    choose_node,
+    get_numa_nodes,
+    parse_cpu_list,
+    reserve_cores,
+)
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="Reserving CPU cores is only supported on Linux",
+)
+
+
+@pytest.fixture
+def node_directory(tmp_path, monkeypatch):
+    # two NUMA nodes with four cores each
+    node_directory = tmp_path / "node"
+    for node, cpu_list in enumerate(["0-3", "4-7"]):
+        (node_directory / f"node{node}").mkdir(parents=True)
+        (node_directory / f"node{node}" / "cpulist").write_text(cpu_list)
+    monkeypatch.setattr(cores_module, "get_available_cores", lambda: range(8))
+    return node_directory
+
+
+@pytest.fixture
+def reserve(node_directory, tmp_path):
+    def reserve(n_cores, **kwargs):
+        return reserve_cores(
+            n_cores,
+            lock_directory=tmp_path / "locks",
+            node_directory=node_directory,
+            **kwargs,
+        )
+
+    return reserve
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+
+
+def test_get_numa_nodes(node_directory):
+    assert get_numa_nodes(node_directory=node_directory) == [
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+    ]
+    assert get_numa_nodes(cores=[1, 2, 5], node_directory=node_directory) == [
+        [1, 2],
+        [5],
+    ]
+
+
+def test_get_numa_nodes_no_topology(tmp_path):
+    assert get_numa_nodes(cores=[0, 1], node_directory=tmp_path) == [[0, 1]]
+
+
+@pytest.mark.parametrize(
+    "n_free, n_cores, expected",
+    [
+        ([4, 2], 2, 1),
+        ([4, 3], 4, 0),
+        ([1, 3], 4, 1),
+    ],
+)
+def test_choose_node(n_free, n_cores, expected):
+    free_cores = [list(range(n)) for n in n_free]
+    assert choose_node(free_cores, n_cores) == expected
+
+
+def test_reservations_are_disjoint(reserve):
+    first = reserve(3)
+    second = reserve(3)
+    third = reserve(3)
+
+    # each reservation stays on one node
+    assert first.cores == [0, 1, 2]
+    assert second.cores == [4, 5, 6]
+    assert third.cores == [3]
+
+    second.release()
+    with reserve(4) as fourth:
+        assert fourth.cores == [4, 5, 6, 7]
+
+
+def test_reserve_cores_timeout(reserve):
+    with reserve(4), reserve(4):
+        with pytest.raises(NoFreeCoresError):
+            reserve(1, timeout=0)
+
+
+def test_pin():
+    available = sorted(os.sched_getaffinity(0))
+    reservation = cores_module.CoreReservation(available[:1], [])
+    reservation.pin()
+    assert sorted(os.sched_getaffinity(0)) == available[:1]
+    reservation.release()
+    assert sorted(os.sched_getaffinity(0)) == available
+
+
+def test_pinning_not_supported(reserve, monkeypatch):
+    monkeypatch.setattr(cores_module, "CORE_PINNING_SUPPORTED", False)
+    with pytest.raises(CorePinningNotSupportedError):
+        reserve(1)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from brainglobe_utils.IO.image.load import load_any
+
+from brainreg.core.paths import Paths
+from brainreg.core.transform import load_deformation_field
+from brainreg.core.utils.deformation import (
+    jacobian_determinant,
+    save_deformation_field,
+    save_deformation_field_component,
+    save_jacobian_determinant,
+)
+
+
+@pytest.fixture
+def niftyreg_field():
+    # (X, Y, Z, 1, 3), Fortran ordered, as read from a niftyreg output
+    rng = np.random.default_rng(0)
+    field = rng.random((7, 5, 6, 1, 3)).astype(np.float32)
+    return np.asfortranarray(field)
+
+
+@pytest.mark.parametrize("slab_size", [1, 3, 16])
+def test_save_deformation_field(tmp_path, niftyreg_field, slab_size):
+    dest_path = tmp_path / "deformation_field.npy"
+    save_deformation_field(niftyreg_field, dest_path, slab_size=slab_size)
+
+    saved = np.load(dest_path, mmap_mode="r")
+    assert saved.shape == (7, 5, 6, 3)
+    assert saved.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(saved, niftyreg_field[..., 0, :])
+
+    for component in range(3):
+        tiff_path = tmp_path / f"deformation_field_{component}.tiff"
+        save_deformation_field_component(
+            saved, tiff_path, component, slab_size=slab_size
+        )
+        np.testing.assert_array_equal(
+            load_any(tiff_path), niftyreg_field[..., 0, component]
+        )
+
+
+def test_load_deformation_field(tmp_path, niftyreg_field):
+    paths = Paths(tmp_path)
+    for component, tiff_path in enumerate(
+        [
+            paths.deformation_field_0,
+            paths.deformation_field_1,
+            paths.deformation_field_2,
+        ]
+    ):
+        save_deformation_field_component(
+            niftyreg_field[..., 0, :], tiff_path, component
+        )
+    np.testing.assert_array_equal(
+        load_deformation_field(paths), niftyreg_field[..., 0, :]
+    )
+
+    # the single file is used if it exists
+    save_deformation_field(niftyreg_field * 2, paths.deformation_field)
+    loaded = load_deformation_field(paths)
+    assert isinstance(loaded, np.memmap)
+    np.testing.assert_array_equal(loaded, niftyreg_field[..., 0, :] * 2)
+
+
+@pytest.mark.parametrize("slab_size", [1, 3, 16])
+def test_save_jacobian_determinant(tmp_path, niftyreg_field, slab_size):
+    field = np.ascontiguousarray(niftyreg_field[..., 0, :])
+    scales = (20, 40, 10)
+    dest_path = tmp_path / "jacobian_determinant.tiff"
+    save_jacobian_determinant(field, scales, dest_path, slab_size=slab_size)
+
+    saved = load_any(str(dest_path))
+    assert saved.dtype == np.float32
+    np.testing.assert_array_equal(saved, jacobian_determinant(field, scales))
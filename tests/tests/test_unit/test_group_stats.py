@@ -0,0 +1,127 @@
+import sys
+
+import numpy as np
+import pytest
+from brainglobe_utils.IO.image.load import read_with_dask
+from brainglobe_utils.IO.image.save import to_tiff
+from scipy import stats
+
+from brainreg.core.cli import main as brainreg_run
+from brainreg.core.group_stats import RunningStatistics, group_statistics
+
+shape = (7, 5, 6)
+
+
+def make_cohort(directory, n_samples, offset, seed):
+    rng = np.random.default_rng(seed)
+    directories, images = [], []
+    for sample in range(n_samples):
+        sample_directory = directory / f"sample_{sample}"
+        sample_directory.mkdir(parents=True)
+        image = rng.integers(0, 100, shape, dtype=np.uint16) + offset
+        to_tiff(image, str(sample_directory / "downsampled_standard.tiff"))
+        directories.append(str(sample_directory))
+        images.append(image.astype(np.float64))
+    return directories, np.stack(images)
+
+
+def load(path):
+    return np.asarray(read_with_dask(str(path)))
+
+
+def test_group_stats(tmp_path):
+    directories_a, images_a = make_cohort(tmp_path / "a", 5, 0, 0)
+    directories_b, images_b = make_cohort(tmp_path / "b", 4, 20, 1)
+    output_directory = tmp_path / "stats"
+    sys.argv = [
+        "brainreg",
+        "group-stats",
+        str(output_directory),
+        *directories_a,
+        "--compare",
+        *directories_b,
+        "--slab-size",
+        "3",
+        "--n-free-cpus",
+        "0",
+    ]
+    brainreg_run()
+
+    for prefix, images in (("", images_a), ("compare_", images_b)):
+        np.testing.assert_allclose(
+            load(output_directory / f"{prefix}mean.tiff"),
+            images.mean(axis=0),
+            rtol=1e-6,
+        )
+        np.testing.assert_allclose(
+            load(output_directory / f"{prefix}variance.tiff"),
+            images.var(axis=0, ddof=1),
+            rtol=1e-5,
+        )
+        np.testing.assert_array_equal(
+            load(output_directory / f"{prefix}count.tiff"), len(images)
+        )
+
+    t_statistic, p_value = stats.ttest_ind(
+        images_a, images_b, axis=0, equal_var=False
+    )
+    np.testing.assert_allclose(
+        load(output_directory / "difference.tiff"),
+        images_a.mean(axis=0) - images_b.mean(axis=0),
+        rtol=1e-5,
+        atol=1e-4,
+    )
+    np.testing.assert_allclose(
+        load(output_directory / "t_statistic.tiff"), t_statistic, rtol=1e-5
+    )
+    np.testing.assert_allclose(
+        load(output_directory / "p_value.tiff"),
+        p_value,
+        rtol=1e-4,
+        atol=1e-12,
+    )
+
+
+def test_group_stats_exclude_zeros(tmp_path):
+    directories, images = make_cohort(tmp_path, 3, 1, 2)
+    images[0, :2] = 0
+    images[1, 0] = 0
+    paths = [
+        f"{directory}/downsampled_standard.tiff" for directory in directories
+    ]
+    to_tiff(images[0].astype(np.uint16), paths[0])
+    to_tiff(images[1].astype(np.uint16), paths[1])
+
+    group_statistics(paths, str(tmp_path), exclude_zeros=True, n_free_cpus=0)
+
+    masked = np.where(images == 0, np.nan, images)
+    np.testing.assert_array_equal(
+        load(tmp_path / "count.tiff"), (images != 0).sum(axis=0)
+    )
+    np.testing.assert_allclose(
+        load(tmp_path / "mean.tiff"), np.nanmean(masked, axis=0), rtol=1e-6
+    )
+    # a single value has no variance
+    variance = load(tmp_path / "variance.tiff")
+    assert np.isnan(variance[0]).all()
+    np.testing.assert_allclose(
+        variance[1:], np.nanvar(masked[:, 1:], axis=0, ddof=1), rtol=1e-5
+    )
+
+
+def test_running_statistics():
+    statistics = RunningStatistics((2,))
+    for value in ([1.0, np.nan], [2.0, np.inf], [6.0, 4.0]):
+        statistics.add(np.array(value))
+    np.testing.assert_array_equal(statistics.count, [3, 1])
+    np.testing.assert_allclose(statistics.mean, [3, 4])
+    np.testing.assert_allclose(statistics.variance, [7, np.nan])
+
+
+def test_group_stats_shape_mismatch(tmp_path):
+    to_tiff(np.zeros(shape, dtype=np.uint16), str(tmp_path / "a.tiff"))
+    to_tiff(np.zeros((3, 3, 3), dtype=np.uint16), str(tmp_path / "b.tiff"))
+    with pytest.raises(ValueError):
+        group_statistics(
+            [tmp_path / "a.tiff", tmp_path / "b.tiff"], str(tmp_path)
+        )
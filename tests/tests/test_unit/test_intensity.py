@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from brainreg.core.utils.intensity import RegionIndex, calculate_intensities
+from brainreg.core.utils.labels import to_compact_labels
+
+STRUCTURE_IDS = [0, 3, 70, 1000000]
+
+
+@pytest.fixture
+def registered_atlas():
+    rng = np.random.default_rng(0)
+    registered_atlas = rng.choice(STRUCTURE_IDS, (9, 10, 11)).astype(np.uint32)
+    # only in the left hemisphere
+    registered_atlas[registered_atlas == 70] = 3
+    registered_atlas[:, :, :3] = 70
+    return registered_atlas
+
+
+@pytest.fixture
+def hemispheres():
+    hemispheres = np.ones((9, 10, 11), dtype=np.uint8)
+    hemispheres[:, :, 6:] = 2
+    hemispheres[0] = 0
+    return hemispheres
+
+
+def expected_statistics(registered_atlas, hemispheres, image, structure_id):
+    in_region = registered_atlas == structure_id
+    statistics = {}
+    for side, mask in (
+        ("left", in_region & (hemispheres == 1)),
+        ("right", in_region & (hemispheres == 2)),
+        ("total", in_region & (hemispheres > 0)),
+    ):
+        values = image[mask].astype(np.float64)
+        statistics[side] = {
+            "mean": values.mean() if values.size else np.nan,
+            "median": np.median(values) if values.size else np.nan,
+            "sum": values.sum(),
+        }
+    return statistics
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.float32])
+@pytest.mark.parametrize("compact", [False, True])
+def test_region_statistics(registered_atlas, hemispheres, dtype, compact):
+    rng = np.random.default_rng(1)
+    image = (rng.random(registered_atlas.shape) * 250).astype(dtype)
+    labels, labels_lookup = registered_atlas, None
+    if compact:
+        labels, labels_lookup = to_compact_labels(registered_atlas)
+
+    region_index = RegionIndex(
+        labels, hemispheres, labels_lookup=labels_lookup
+    )
+    np.testing.assert_array_equal(region_index.structure_ids, [3, 70, 1000000])
+    statistics = region_index.statistics(image)
+
+    for idx, structure_id in enumerate(region_index.structure_ids):
+        expected = expected_statistics(
+            registered_atlas, hemispheres, image, structure_id
+        )
+        for side, side_statistics in expected.items():
+            for statistic, value in side_statistics.items():
+                np.testing.assert_allclose(
+                    statistics[side][statistic][idx], value, rtol=1e-6
+                )
+    # region 70 is only in the left hemisphere
+    assert np.isnan(statistics["right"]["median"][1])
+
+
+def test_region_statistics_shape(registered_atlas, hemispheres):
+    region_index = RegionIndex(registered_atlas, hemispheres)
+    with pytest.raises(ValueError):
+        region_index.statistics(registered_atlas[1:])
+
+
+def test_calculate_intensities(tmp_path, registered_atlas, hemispheres):
+    atlas = SimpleNamespace(
+        lookup_df=pd.DataFrame({"id": [3, 70], "name": ["three", "seventy"]})
+    )
+    image = registered_atlas.astype(np.uint16) % 7
+    output_file = tmp_path / "intensities.csv"
+    calculate_intensities(
+        atlas, RegionIndex(registered_atlas, hemispheres), image, output_file
+    )
+
+    # structures missing from the atlas are skipped
+    intensities = pd.read_csv(output_file)
+    assert intensities["structure_name"].tolist() == ["three", "seventy"]
+    np.testing.assert_array_equal(
+        intensities["total_median_intensity"], [3, 0]
+    )
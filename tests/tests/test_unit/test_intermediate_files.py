@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from brainreg.core.backend.niftyreg.run import (
+    delete_intermediate_files,
+    intermediate_directory,
+)
+
+
+def write_intermediate_files(niftyreg_directory):
+    for name in ("deformation_field.nii", "freeform.log"):
+        with open(os.path.join(niftyreg_directory, name), "w") as f:
+            f.write(name)
+
+
+def test_default_directory(tmp_path):
+    with intermediate_directory(tmp_path) as niftyreg_directory:
+        assert niftyreg_directory == str(tmp_path / "niftyreg")
+        os.makedirs(niftyreg_directory)
+        write_intermediate_files(niftyreg_directory)
+    assert not os.path.exists(niftyreg_directory)
+
+
+@pytest.mark.parametrize("debug", [False, True])
+def test_scratch_directory(tmp_path, debug):
+    scratch_directory = tmp_path / "scratch"
+    with intermediate_directory(
+        tmp_path / "output", scratch_directory, debug=debug
+    ) as niftyreg_directory:
+        assert os.path.dirname(niftyreg_directory) == str(scratch_directory)
+        write_intermediate_files(niftyreg_directory)
+
+    assert os.listdir(scratch_directory) == []
+    copied = tmp_path / "output" / "niftyreg"
+    if debug:
+        assert sorted(os.listdir(copied)) == [
+            "deformation_field.nii",
+            "freeform.log",
+        ]
+    else:
+        assert not copied.exists()
+
+
+def test_scratch_directory_keeps_logs_on_failure(tmp_path):
+    scratch_directory = tmp_path / "scratch"
+    with pytest.raises(RuntimeError):
+        with intermediate_directory(
+            tmp_path / "output", scratch_directory
+        ) as niftyreg_directory:
+            write_intermediate_files(niftyreg_directory)
+            raise RuntimeError
+
+    assert os.listdir(scratch_directory) == []
+    assert os.listdir(tmp_path / "output" / "niftyreg") == ["freeform.log"]
+
+
+def test_delete_intermediate_files(tmp_path):
+    file_path = tmp_path / "control_point_file.nii"
+    file_path.touch()
+    delete_intermediate_files(file_path, tmp_path / "missing.nii")
+    assert not file_path.exists()
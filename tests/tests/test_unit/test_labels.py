@@ -0,0 +1,81 @@
+import numpy as np
+from brainglobe_utils.IO.image.save import to_tiff
+
+from brainreg.core.utils.labels import (
+    labels_lookup_path,
+    load_labels_lookup,
+    load_registered_atlas,
+    remove_labels_lookup,
+    restore_labels,
+    save_labels_lookup,
+    to_compact_labels,
+)
+from brainreg.core.utils.native_resolution import NativeResolutionAtlas
+from brainreg.core.utils.volume import get_lateralised_atlas
+
+
+def make_labels():
+    rng = np.random.default_rng(0)
+    ids = np.array([0, 7, 1_000_000, 4_000_000_000], dtype=np.uint32)
+    return ids[rng.integers(0, 4, size=(6, 5, 11))]
+
+
+def test_compact_labels_round_trip(tmp_path):
+    labels = make_labels()
+    compact, lookup = to_compact_labels(labels)
+
+    assert compact.dtype == np.uint16
+    assert lookup[0] == 0
+    np.testing.assert_array_equal(restore_labels(compact, lookup), labels)
+
+    image_path = tmp_path / "registered_atlas.tiff"
+    to_tiff(compact, image_path)
+    save_labels_lookup(lookup, image_path)
+    assert labels_lookup_path(image_path) == str(
+        tmp_path / "registered_atlas_labels.csv"
+    )
+    np.testing.assert_array_equal(load_labels_lookup(image_path), lookup)
+    np.testing.assert_array_equal(load_registered_atlas(image_path), labels)
+
+    remove_labels_lookup(image_path)
+    assert load_labels_lookup(image_path) is None
+    np.testing.assert_array_equal(load_registered_atlas(image_path), compact)
+
+
+def test_compact_labels_without_background():
+    labels = np.full((2, 3, 4), 12, dtype=np.uint32)
+    compact, lookup = to_compact_labels(labels)
+    np.testing.assert_array_equal(lookup, [0, 12])
+    assert (compact == 1).all()
+
+
+def test_too_many_labels():
+    labels = np.arange(70_000, dtype=np.uint32).reshape(7, 100, 100)
+    compact, lookup = to_compact_labels(labels)
+    assert lookup is None
+    assert compact is labels
+
+
+def test_volumes_from_compact_labels():
+    labels = make_labels()
+    hemispheres = np.ones(labels.shape, dtype=np.uint8)
+    hemispheres[..., 5:] = 2
+    compact, lookup = to_compact_labels(labels)
+
+    expected = get_lateralised_atlas(labels, hemispheres)
+    counts = get_lateralised_atlas(compact, hemispheres, labels_lookup=lookup)
+    for expected_values, values in zip(expected, counts):
+        np.testing.assert_array_equal(values, expected_values)
+
+
+def test_native_resolution_from_compact_labels():
+    labels = make_labels()
+    compact, lookup = to_compact_labels(labels)
+    raw_shape = (20, 33, 12)
+
+    expected = NativeResolutionAtlas(labels, "asr", "psl", raw_shape)
+    native = NativeResolutionAtlas(
+        compact, "asr", "psl", raw_shape, labels_lookup=lookup
+    )
+    assert native.dtype == np.uint32
+    np.testing.assert_array_equal(native[3:9], expected[3:9])
@@ -0,0 +1,100 @@
+from argparse import ArgumentTypeError
+
+import numpy as np
+import pytest
+from brainglobe_utils.IO.image.load import load_any
+from brainglobe_utils.IO.image.save import to_tiff
+
+from brainreg.core.utils.boundaries import boundaries
+from brainreg.core.utils.memory import MemoryBudget, parse_memory_size
+from brainreg.core.utils.preprocess import filter_image
+from brainreg.core.utils.qc import calculate_qc_metrics
+
+shape = (12, 10, 16)
+
+
+@pytest.fixture
+def small_budget(monkeypatch):
+    # small enough that every step is split into several slabs
+    budget = MemoryBudget(1)
+    monkeypatch.setattr(budget, "available", lambda: 4000)
+    return budget
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 1000, size=shape).astype(np.uint16)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("16G", 16 * 1024**3),
+        ("512m", 512 * 1024**2),
+        ("1.5", int(1.5 * 1024**3)),
+        ("100KB", 100 * 1024),
+    ],
+)
+def test_parse_memory_size(value, expected):
+    assert parse_memory_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "lots", "-1G", "0"])
+def test_parse_memory_size_invalid(value):
+    with pytest.raises(ArgumentTypeError):
+        parse_memory_size(value)
+
+
+def test_slab_size(small_budget):
+    assert MemoryBudget().slab_size(10, 1000) == 10
+    assert MemoryBudget().slab_size(10, 1000, default=2) == 2
+    assert small_budget.slab_size(10, 1000) == 4
+    assert small_budget.slab_size(10, 10**6) == 1
+    assert small_budget.slab_size(2, 1) == 2
+
+
+def test_filter_image_low_memory(image, small_budget):
+    expected = filter_image(image.copy())
+    filtered = filter_image(image, memory_budget=small_budget, in_place=True)
+
+    assert filtered.dtype == np.uint16
+    assert filtered is image
+    # both are calculated in float32
+    np.testing.assert_array_equal(filtered, expected)
+
+
+def test_boundaries_low_memory(tmp_path, small_budget):
+    labels = np.zeros(shape, dtype=np.uint32)
+    labels[2:9, 3:7, 4:12] = 5
+    labels[5:11, 1:8, 8:14] = 7
+    atlas_path = tmp_path / "registered_atlas.tiff"
+    to_tiff(labels, atlas_path)
+
+    boundaries(atlas_path, tmp_path / "expected.tiff")
+    boundaries(atlas_path, tmp_path / "boundaries.tiff", small_budget)
+
+    np.testing.assert_array_equal(
+        load_any(tmp_path / "boundaries.tiff"),
+        load_any(tmp_path / "expected.tiff"),
+    )
+
+
+def test_qc_metrics_low_memory(image, small_budget):
+    labels = np.zeros(shape, dtype=np.uint32)
+    labels[:, :, :8] = 3
+    labels[:, :, 8:] = 4
+    hemispheres = (labels - 2).astype(np.uint8)
+    other = image + np.random.default_rng(1).integers(0, 100, size=shape)
+    field = np.stack(np.indices(shape), axis=-1).astype(np.float32) / 40
+    args = (image, other, labels, hemispheres, field, (25, 25, 25), "asr")
+
+    expected = calculate_qc_metrics(*args)
+    metrics = calculate_qc_metrics(*args, memory_budget=small_budget)
+
+    assert metrics["ncc"] == pytest.approx(expected["ncc"])
+    assert metrics["nmi"] == pytest.approx(expected["nmi"])
+    assert metrics["region_correlation"] == pytest.approx(
+        expected["region_correlation"]
+    )
+    assert metrics["deformation"] == pytest.approx(expected["deformation"])
@@ -0,0 +1,73 @@
+import brainglobe_space as bg
+import numpy as np
+import pytest
+import tifffile
+
+from brainreg.core.utils.native_resolution import (
+    NativeResolutionAtlas,
+    get_nearest_indices,
+    save_native_resolution_atlas,
+)
+
+raw_shape = (20, 33, 12)
+
+
+@pytest.fixture
+def registered_atlas():
+    # atlas orientation ("asr") at atlas resolution
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 500, size=(6, 5, 11), dtype=np.uint32)
+
+
+def upsample_in_memory(registered_atlas, data_orientation):
+    labels = bg.map_stack_to("asr", data_orientation, registered_atlas)
+    indices = [
+        get_nearest_indices(n_raw, n_down)
+        for n_raw, n_down in zip(raw_shape, labels.shape)
+    ]
+    return labels[np.ix_(*indices)]
+
+
+def test_get_nearest_indices():
+    np.testing.assert_array_equal(
+        get_nearest_indices(6, 3), [0, 0, 1, 1, 2, 2]
+    )
+    np.testing.assert_array_equal(
+        get_nearest_indices(7, 3), [0, 0, 1, 1, 1, 2, 2]
+    )
+    # upsampling by a whole factor gives blocks of the same size
+    np.testing.assert_array_equal(
+        np.bincount(get_nearest_indices(40, 8)), np.full(8, 5)
+    )
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        np.s_[:],
+        np.s_[3],
+        np.s_[2:5, ::2],
+        np.s_[-1, 4, :],
+        np.s_[1:3, 0, 1:11:3],
+    ],
+)
+def test_native_resolution_atlas_indexing(registered_atlas, key):
+    native_atlas = NativeResolutionAtlas(
+        registered_atlas, "asr", "lsp", raw_shape
+    )
+    expected = upsample_in_memory(registered_atlas, "lsp")
+
+    assert native_atlas.shape == raw_shape == expected.shape
+    np.testing.assert_array_equal(native_atlas[key], expected[key])
+
+
+def test_save_native_resolution_atlas(registered_atlas, tmp_path):
+    dest_path = tmp_path / "native.tiff"
+    save_native_resolution_atlas(
+        registered_atlas, "asr", "psl", raw_shape, dest_path, slab_size=3
+    )
+    saved = tifffile.imread(dest_path)
+    assert saved.dtype == registered_atlas.dtype
+    np.testing.assert_array_equal(
+        saved, upsample_in_memory(registered_atlas, "psl")
+    )
@@ -0,0 +1,42 @@
+import brainglobe_space as bg
+import nibabel as nib
+import numpy as np
+import pytest
+
+from brainreg.core.backend.niftyreg.utils import load_nii, save_nii
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.uint32])
+@pytest.mark.parametrize("slab_size", [1, 4, 16])
+def test_save_nii(tmp_path, dtype, slab_size):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 200, (7, 5, 6)).astype(dtype)
+    # a reoriented view, as passed to niftyreg
+    image = bg.map_stack_to("asr", "psl", image)
+    dest_path = tmp_path / "image.nii"
+    save_nii(image, (50, 25, 10), dest_path, slab_size=slab_size)
+
+    saved = nib.load(str(dest_path))
+    assert saved.shape == image.shape
+    assert saved.get_data_dtype() == dtype
+    np.testing.assert_allclose(saved.header.get_zooms(), (0.05, 0.025, 0.01))
+    np.testing.assert_allclose(
+        saved.affine, np.diag([0.05, 0.025, 0.01, 1]), atol=1e-7
+    )
+    np.testing.assert_array_equal(np.asarray(saved.dataobj), image)
+
+
+def test_load_nii(tmp_path):
+    image = np.arange(7 * 5 * 6, dtype=np.uint16).reshape(7, 5, 6)
+    dest_path = tmp_path / "image.nii"
+    save_nii(image, (50, 50, 50), dest_path)
+
+    lazy = load_nii(dest_path, lazy=True)
+    assert isinstance(lazy, np.memmap)
+    np.testing.assert_array_equal(lazy, image)
+
+    loaded = load_nii(dest_path, dtype=np.uint32)
+    assert not isinstance(loaded, np.memmap)
+    assert loaded.dtype == np.uint32
+    assert loaded.flags.c_contiguous
+    np.testing.assert_array_equal(loaded, image)
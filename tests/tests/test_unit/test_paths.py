@@ -0,0 +1,25 @@
+import pytest
+
+from brainreg.core.paths import OUTPUTS, resolve_outputs
+
+
+def test_resolve_outputs():
+    assert resolve_outputs() == set(OUTPUTS)
+    assert resolve_outputs([]) == set()
+    assert resolve_outputs(["boundaries"]) == {"boundaries"}
+    assert resolve_outputs(["volumes", "qc"]) == {
+        "volumes",
+        "hemispheres",
+        "deformation_field",
+        "qc",
+    }
+    assert resolve_outputs(["qc"]) == {
+        "qc",
+        "deformation_field",
+        "hemispheres",
+    }
+
+
+def test_resolve_outputs_unknown():
+    with pytest.raises(ValueError):
+        resolve_outputs(["registered_atlas", "cells"])
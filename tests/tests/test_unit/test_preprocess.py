@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from brainglobe_utils.image.scale import scale_and_convert_to_16_bits
+
+from brainreg.core.utils.preprocess import (
+    filter_image,
+    filter_plane,
+    scale_to_uint16,
+)
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    z, y, x = np.indices((12, 30, 34))
+    brain = 20000 * np.exp(
+        -((z - 6) ** 2 / 40 + (y - 15) ** 2 / 100 + (x - 17) ** 2 / 120)
+    )
+    return (brain + rng.integers(0, 500, brain.shape)).astype(np.uint16)
+
+
+def filter_image_float64(brain, preprocessing_args=None):
+    # the filtering as it was done before, in float64
+    brain = brain.astype(np.float64)
+    if not (preprocessing_args and preprocessing_args.preprocessing == "skip"):
+        for i in range(brain.shape[-1]):
+            brain[..., i] = filter_plane(brain[..., i])
+    return scale_and_convert_to_16_bits(brain)
+
+
+@pytest.mark.parametrize("preprocessing", ["default", "skip"])
+def test_filter_image_precision(image, preprocessing):
+    preprocessing_args = SimpleNamespace(preprocessing=preprocessing)
+    expected = filter_image_float64(image, preprocessing_args)
+    filtered = filter_image(image, preprocessing_args)
+
+    assert filtered.dtype == np.uint16
+    difference = np.abs(filtered.astype(np.int64) - expected)
+    assert difference.max() <= 1
+    assert np.mean(difference > 0) < 0.01
+
+
+def test_filter_image_float32(image):
+    float_image = image.astype(np.float32)
+    original = float_image.copy()
+    filtered = filter_image(float_image)
+    np.testing.assert_array_equal(float_image, original)
+    np.testing.assert_array_equal(filtered, filter_image(image))
+
+    filtered_in_place = filter_image(float_image, in_place=True)
+    np.testing.assert_array_equal(filtered_in_place, filtered)
+    assert not np.array_equal(float_image, original)
+
+
+@pytest.mark.parametrize("slab_size", [1, 5, 16])
+def test_scale_to_uint16(image, slab_size):
+    expected = scale_and_convert_to_16_bits(image.astype(np.float64))
+    scaled = scale_to_uint16(image, slab_size=slab_size)
+
+    assert scaled.dtype == np.uint16
+    assert scaled.max() == 2**16 - 1
+    assert np.abs(scaled.astype(np.int64) - expected).max() <= 1
+
+    out = np.empty(image.shape, dtype=np.uint16)
+    assert scale_to_uint16(image, out=out, slab_size=slab_size) is out
+    np.testing.assert_array_equal(out, scaled)
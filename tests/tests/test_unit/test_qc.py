@@ -0,0 +1,128 @@
+import json
+
+import numpy as np
+import pytest
+
+from brainreg.core.utils.deformation import jacobian_determinant
+from brainreg.core.utils.qc import (
+    calculate_qc_metrics,
+    deformation_metrics,
+    hemisphere_metrics,
+    normalised_cross_correlation,
+    normalised_mutual_information,
+    region_correlations,
+    save_qc_metrics,
+)
+
+shape = (12, 10, 16)
+resolution = (25, 25, 25)
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 1000, size=shape).astype(np.uint16)
+
+
+@pytest.fixture
+def hemispheres():
+    # "asr" orientation, so the last axis is left-right
+    hemispheres = np.zeros(shape, dtype=np.uint8)
+    hemispheres[2:10, 2:8, 3:8] = 2
+    hemispheres[2:10, 2:8, 8:13] = 1
+    return hemispheres
+
+
+def identity_field(scale=1.0):
+    grid = np.stack(np.indices(shape), axis=-1).astype(np.float32)
+    # deformation fields are in mm
+    return grid * scale * np.array(resolution, dtype=np.float32) / 1000
+
+
+def test_similarity_identical_images(image):
+    assert normalised_cross_correlation(image, image) == pytest.approx(1)
+    assert normalised_mutual_information(image, image) == pytest.approx(2)
+
+
+def test_similarity_independent_images(image):
+    other = np.random.default_rng(1).integers(0, 1000, size=shape)
+    assert abs(normalised_cross_correlation(image, other)) < 0.05
+    assert normalised_mutual_information(image, other) < 1.2
+
+
+def test_region_correlations(image):
+    labels = np.zeros(shape, dtype=np.uint32)
+    labels[:6] = 10
+    labels[6:] = 20
+    other = image.astype(np.float64)
+    other[6:] = np.random.default_rng(1).integers(0, 1000, size=(6, 10, 16))
+
+    region_ids, correlations, counts = region_correlations(
+        image, other, labels
+    )
+    np.testing.assert_array_equal(region_ids, [10, 20])
+    np.testing.assert_array_equal(counts, [6 * 10 * 16] * 2)
+    assert correlations[0] == pytest.approx(1)
+    assert correlations[1] == pytest.approx(
+        np.corrcoef(image[6:].ravel(), other[6:].ravel())[0, 1]
+    )
+
+
+def test_hemisphere_metrics(hemispheres):
+    metrics = hemisphere_metrics(hemispheres, "asr")
+    assert metrics["symmetry_dice"] == pytest.approx(1)
+    assert metrics["left_right_volume_ratio"] == pytest.approx(1)
+
+    hemispheres[hemispheres == 1] = 0
+    metrics = hemisphere_metrics(hemispheres, "asr")
+    assert metrics["symmetry_dice"] is None
+
+
+@pytest.mark.parametrize("scale", [1.0, 0.5])
+def test_jacobian_determinant(scale):
+    determinant = jacobian_determinant(
+        identity_field(scale), 1000 / np.array(resolution), slab_size=5
+    )
+    np.testing.assert_allclose(determinant, scale**3, rtol=1e-5)
+
+
+def test_deformation_metrics_folding():
+    field = identity_field()
+    field[:, :, :, 0] = field[::-1, :, :, 0]
+    metrics = deformation_metrics(field, resolution)
+    assert metrics["fraction_folded"] == 1
+    assert metrics["jacobian_mean"] == pytest.approx(-1)
+
+
+def test_calculate_and_save_qc_metrics(image, hemispheres, tmp_path):
+    labels = (hemispheres > 0).astype(np.uint32) * 5
+    metrics = calculate_qc_metrics(
+        image,
+        image,
+        labels,
+        hemispheres,
+        identity_field(),
+        resolution,
+        "asr",
+    )
+    dest_path = tmp_path / "qc.json"
+    save_qc_metrics(metrics, dest_path)
+
+    with open(dest_path) as f:
+        saved = json.load(f)
+
+    assert saved["ncc"] == pytest.approx(1)
+    assert saved["region_correlation"]["worst_regions"][0]["id"] == 5
+    assert saved["hemispheres"]["symmetry_dice"] == pytest.approx(1)
+    assert saved["deformation"]["jacobian_mean"] == pytest.approx(1)
+    assert saved["deformation"]["fraction_folded"] == 0
+
+
+def test_qc_metrics_without_optional_outputs(image):
+    labels = np.full(shape, 5, dtype=np.uint32)
+    metrics = calculate_qc_metrics(
+        image, image, labels, None, None, resolution, "asr"
+    )
+    assert metrics["ncc"] == pytest.approx(1)
+    assert "hemispheres" not in metrics
+    assert "deformation" not in metrics
@@ -0,0 +1,215 @@
+import json
+import sys
+from types import SimpleNamespace
+
+import brainglobe_space as bg
+import numpy as np
+import pandas as pd
+import pytest
+from brainglobe_utils.IO.image.save import to_tiff
+
+from brainreg.core.cli import main as brainreg_run
+from brainreg.core.paths import Paths
+from brainreg.core.regions import (
+    RegionLookup,
+    count_points,
+    get_structure_names,
+)
+from brainreg.core.utils.labels import save_labels_lookup, to_compact_labels
+from brainreg.core.utils.native_resolution import (
+    NativeResolutionAtlas,
+    get_nearest_indices,
+)
+
+# the registered atlas, at atlas resolution and in the atlas orientation
+atlas_shape = (12, 14, 10)
+# raw data at twice the atlas resolution
+scaling = (0.5, 0.5, 0.5)
+raw_shape_psl = tuple(
+    2 * n for n in bg.map_stack_to("asr", "psl", np.empty(atlas_shape)).shape
+)
+STRUCTURES = [
+    {"id": 997, "acronym": "root", "name": "root", "structure_id_path": [997]},
+    {"id": 3, "acronym": "a", "name": "A", "structure_id_path": [997, 3]},
+    {
+        "id": 70,
+        "acronym": "b",
+        "name": "B",
+        "structure_id_path": [997, 3, 70],
+    },
+    {
+        "id": 1000000,
+        "acronym": "c",
+        "name": "C",
+        "structure_id_path": [997, 1000000],
+    },
+]
+
+
+@pytest.fixture
+def fake_atlas():
+    return SimpleNamespace(
+        resolution=(100, 100, 100),
+        metadata={"orientation": "asr"},
+        space=bg.AnatomicalSpace("asr"),
+        structures_list=STRUCTURES,
+    )
+
+
+@pytest.fixture
+def registered_atlas():
+    rng = np.random.default_rng(0)
+    return rng.choice([0, 3, 70, 1000000], atlas_shape).astype(np.uint32)
+
+
+@pytest.fixture
+def registered_hemispheres():
+    hemispheres = np.ones(atlas_shape, dtype=np.uint8)
+    hemispheres[..., 5:] = 2
+    return hemispheres
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(1)
+    points = rng.random((5000, 3)) * (np.array(raw_shape_psl) + 4) - 2
+    points[0] = np.nan
+    return points
+
+
+def expected_regions(points, registered_atlas, registered_hemispheres):
+    """
+    The labels of the nearest raw voxel, in the registered atlas and
+    hemispheres at native resolution.
+    """
+    voxels = np.floor(points + 0.5)
+    inside = np.all((voxels >= 0) & (voxels < raw_shape_psl), axis=1)
+    index = tuple(voxels[inside].astype(int).T)
+    structure_ids = np.zeros(len(points), dtype=np.uint32)
+    hemispheres = np.zeros(len(points), dtype=np.uint8)
+    for image, values in (
+        (registered_atlas, structure_ids),
+        (registered_hemispheres, hemispheres),
+    ):
+        native = NativeResolutionAtlas(image, "asr", "psl", raw_shape_psl)
+        values[inside] = native[:][index]
+    return structure_ids, hemispheres
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_assign(points, registered_atlas, registered_hemispheres, compact):
+    atlas_image, labels_lookup = registered_atlas, None
+    if compact:
+        atlas_image, labels_lookup = to_compact_labels(registered_atlas)
+    region_lookup = RegionLookup(
+        atlas_image,
+        registered_hemispheres,
+        "psl",
+        "asr",
+        scaling,
+        labels_lookup=labels_lookup,
+        chunk_size=700,
+    )
+    structure_ids, hemispheres = region_lookup.assign(points)
+
+    expected_ids, expected_hemispheres = expected_regions(
+        points, registered_atlas, registered_hemispheres
+    )
+    np.testing.assert_array_equal(structure_ids, expected_ids)
+    np.testing.assert_array_equal(hemispheres, expected_hemispheres)
+    assert structure_ids[0] == 0
+
+    with pytest.raises(ValueError):
+        region_lookup.assign(points[:, :2])
+
+
+def test_assign_every_raw_voxel():
+    # ten raw voxels per atlas voxel along the first axis
+    registered_atlas = np.arange(1, 5, dtype=np.uint32).reshape(4, 1, 1)
+    region_lookup = RegionLookup(
+        registered_atlas, None, "asr", "asr", (0.1, 1, 1)
+    )
+    points = np.zeros((42, 3))
+    points[:, 0] = np.arange(-1, 41)
+    structure_ids, _ = region_lookup.assign(points)
+
+    np.testing.assert_array_equal(structure_ids[[0, -1]], 0)
+    np.testing.assert_array_equal(
+        structure_ids[1:-1], get_nearest_indices(40, 4) + 1
+    )
+    np.testing.assert_array_equal(
+        np.bincount(structure_ids[1:-1]), [0] + [10] * 4
+    )
+
+
+def test_count_points(fake_atlas):
+    structure_ids = np.array([0, 3, 3, 70, 70, 70, 1000000, 5])
+    hemispheres = np.array([0, 1, 2, 1, 1, 0, 2, 1])
+    counts = count_points(structure_ids, hemispheres, fake_atlas)
+
+    assert counts["structure_id"].tolist() == [3, 70, 997, 1000000]
+    assert counts["acronym"].tolist() == ["a", "b", "root", "c"]
+    assert counts["left_count"].tolist() == [1, 2, 0, 0]
+    assert counts["right_count"].tolist() == [1, 0, 0, 1]
+    assert counts["total_count"].tolist() == [2, 3, 0, 1]
+    assert counts["left_count_with_descendants"].tolist() == [3, 2, 3, 0]
+    assert counts["total_count_with_descendants"].tolist() == [5, 3, 6, 1]
+
+    names = get_structure_names(structure_ids, fake_atlas)
+    assert names.tolist() == [None, "A", "A", "B", "B", "B", "C", None]
+
+
+def test_regions_cli(
+    tmp_path,
+    mocker,
+    fake_atlas,
+    points,
+    registered_atlas,
+    registered_hemispheres,
+):
+    mocker.patch(
+        "brainreg.core.regions.BrainGlobeAtlas", return_value=fake_atlas
+    )
+    paths = Paths(tmp_path / "brainreg")
+    (tmp_path / "brainreg").mkdir()
+    with open(paths.metadata_path, "w") as f:
+        json.dump(
+            {
+                "atlas": "fake_atlas",
+                "orientation": "psl",
+                "voxel_sizes": ["50", "50", "50"],
+            },
+            f,
+        )
+    compact, labels_lookup = to_compact_labels(registered_atlas)
+    to_tiff(compact, paths.registered_atlas)
+    save_labels_lookup(labels_lookup, paths.registered_atlas)
+    to_tiff(registered_hemispheres, paths.registered_hemispheres)
+    points_path = tmp_path / "points.npy"
+    np.save(points_path, points)
+
+    sys.argv = [
+        "brainreg",
+        "regions",
+        str(tmp_path / "brainreg"),
+        str(points_path),
+        str(tmp_path / "output"),
+        "--chunk-size",
+        "1000",
+    ]
+    brainreg_run()
+
+    point_regions = np.load(tmp_path / "output" / "point_regions.npy")
+    expected_ids, expected_hemispheres = expected_regions(
+        points, registered_atlas, registered_hemispheres
+    )
+    np.testing.assert_array_equal(point_regions["structure_id"], expected_ids)
+    np.testing.assert_array_equal(
+        point_regions["hemisphere"], expected_hemispheres
+    )
+
+    counts = pd.read_csv(tmp_path / "output" / "region_counts.csv")
+    root = counts[counts["acronym"] == "root"].iloc[0]
+    assert root["total_count_with_descendants"] == np.count_nonzero(
+        expected_ids
+    )
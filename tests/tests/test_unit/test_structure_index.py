@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from brainreg.core.utils.labels import to_compact_labels
+from brainreg.core.utils.structure_index import (
+    StructureIndex,
+    build_structure_index,
+    get_subtree_ids,
+)
+
+STRUCTURES = [
+    {"id": 997, "acronym": "root", "structure_id_path": [997]},
+    {"id": 3, "acronym": "a", "structure_id_path": [997, 3]},
+    {"id": 70, "acronym": "b", "structure_id_path": [997, 3, 70]},
+    {"id": 1000000, "acronym": "c", "structure_id_path": [997, 1000000]},
+]
+
+
+@pytest.fixture
+def registered_atlas():
+    rng = np.random.default_rng(0)
+    registered_atlas = np.zeros((9, 10, 11), dtype=np.uint32)
+    registered_atlas[1:8, 2:9, 1:10] = rng.choice(
+        [0, 3, 3, 70, 1000000], (7, 7, 9)
+    )
+    # a structure in a single voxel
+    registered_atlas[0, 0, 5] = 997
+    return registered_atlas
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_structure_index(tmp_path, registered_atlas, compact):
+    labels, labels_lookup = registered_atlas, None
+    if compact:
+        labels, labels_lookup = to_compact_labels(registered_atlas)
+    index = build_structure_index(labels, labels_lookup=labels_lookup)
+    index.save(tmp_path / "index.npz")
+    index = StructureIndex.load(tmp_path / "index.npz")
+
+    np.testing.assert_array_equal(index.structure_ids, [3, 70, 997, 1000000])
+    for structure_id in index.structure_ids:
+        expected_mask = registered_atlas == structure_id
+        assert index.voxel_count(structure_id) == expected_mask.sum()
+        np.testing.assert_array_equal(index.mask(structure_id), expected_mask)
+        np.testing.assert_array_equal(
+            index.flat_indices(structure_id),
+            np.flatnonzero(expected_mask),
+        )
+
+        bounding_box = index.bounding_box(structure_id)
+        voxels = np.argwhere(expected_mask)
+        assert bounding_box == tuple(
+            slice(start, stop)
+            for start, stop in zip(voxels.min(0), voxels.max(0) + 1)
+        )
+        np.testing.assert_array_equal(
+            index.mask(structure_id, crop=True), expected_mask[bounding_box]
+        )
+
+
+def test_structure_index_subtree(registered_atlas):
+    index = build_structure_index(registered_atlas)
+    atlas = SimpleNamespace(structures_list=STRUCTURES)
+
+    subtree = get_subtree_ids(atlas, "a")
+    np.testing.assert_array_equal(sorted(subtree), [3, 70])
+    expected_mask = np.isin(registered_atlas, subtree)
+    assert index.voxel_count(subtree) == expected_mask.sum()
+    np.testing.assert_array_equal(index.mask(subtree), expected_mask)
+
+    image = np.arange(registered_atlas.size).reshape(registered_atlas.shape)
+    bounding_box = index.bounding_box(subtree)
+    np.testing.assert_array_equal(
+        index.crop(image, subtree),
+        np.where(expected_mask, image, 0)[bounding_box],
+    )
+
+    # not in the registered atlas
+    assert index.voxel_count(5) == 0
+    assert index.bounding_box(5) is None
+    assert index.crop(image, 5) is None
+    assert not index.mask(5).any()
+    with pytest.raises(KeyError):
+        get_subtree_ids(atlas, "d")
@@ -0,0 +1,71 @@
+import pytest
+
+from brainreg.core.sweep import (
+    flatten_metrics,
+    get_configurations,
+    parse_sweep_options,
+    sweep_cli_parser,
+)
+
+
+def test_parse_sweep_options():
+    parser = sweep_cli_parser()
+    swept = parse_sweep_options(
+        [
+            "bending_energy_weight=0.9,0.95",
+            "--grid-spacing=-5,-10",
+            "inverse_method=invert",
+        ],
+        parser,
+    )
+    assert swept == {
+        "bending_energy_weight": [0.9, 0.95],
+        "grid_spacing": [-5, -10],
+        "inverse_method": ["invert"],
+    }
+
+
+@pytest.mark.parametrize(
+    "option",
+    [
+        "not_an_option=1,2",
+        "grid_spacing=",
+        "grid_spacing=a",
+        "freeform_use_n_steps=-1",
+        "inverse_method=unknown",
+    ],
+)
+def test_parse_sweep_options_invalid(option):
+    parser = sweep_cli_parser()
+    with pytest.raises(SystemExit):
+        parse_sweep_options([option], parser)
+
+
+def test_get_configurations():
+    base = {"bending_energy_weight": 0.95, "grid_spacing": -10, "other": 1}
+    swept = {"bending_energy_weight": [0.5, 0.9], "grid_spacing": [-5, -10]}
+    configurations = get_configurations(base, swept)
+
+    assert len(configurations) == 4
+    assert [name for name, _, _ in configurations] == [
+        "configuration_0",
+        "configuration_1",
+        "configuration_2",
+        "configuration_3",
+    ]
+    _, swept_values, options = configurations[1]
+    assert swept_values == {"bending_energy_weight": 0.5, "grid_spacing": -10}
+    assert options == {**base, **swept_values}
+
+
+def test_flatten_metrics():
+    metrics = {
+        "nmi": 1.5,
+        "region_correlation": {"median": 0.8, "worst_regions": [{"id": 1}]},
+        "deformation": {"jacobian_min": 0.1},
+    }
+    assert flatten_metrics(metrics) == {
+        "nmi": 1.5,
+        "region_correlation_median": 0.8,
+        "deformation_jacobian_min": 0.1,
+    }
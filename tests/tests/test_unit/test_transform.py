@@ -0,0 +1,160 @@
+import brainglobe_space as bg
+import numpy as np
+import pytest
+
+from brainreg.core.transform import RegistrationTransform, remap_points
+
+atlas_resolution = (25, 25, 25)
+downsampled_shape = (30, 40, 20)
+
+
+def make_affine_field(shape, matrix, offset):
+    """
+    Deformation field (in mm) of an affine mapping from the downsampled
+    grid to atlas voxels.
+    """
+    grid = np.stack(
+        np.meshgrid(*[np.arange(n) for n in shape], indexing="ij"), axis=-1
+    )
+    atlas_voxels = grid @ matrix.T + offset
+    return (atlas_voxels * np.array(atlas_resolution) / 1000).astype(
+        np.float32
+    )
+
+
+@pytest.fixture
+def affine():
+    matrix = np.array([[1.1, 0.05, 0], [0, 0.9, 0.1], [0.02, 0, 1.05]])
+    offset = np.array([2.0, -1.5, 3.0])
+    return matrix, offset
+
+
+@pytest.mark.parametrize(
+    "source, target", [("psl", "asr"), ("asr", "asr"), ("lip", "psr")]
+)
+def test_remap_points_matches_map_stack_to(source, target):
+    """
+    Check that remapped points land on the same voxel as the data in a
+    stack remapped with brainglobe-space.
+    """
+    shape = (5, 7, 9)
+    stack = np.zeros(shape)
+    point = np.array([[1, 5, 2]])
+    stack[tuple(point[0])] = 1
+
+    mapped_stack = bg.map_stack_to(source, target, stack)
+    mapped_point = remap_points(point, source, target, shape)
+
+    assert mapped_stack[tuple(mapped_point[0].astype(int))] == 1
+
+
+def test_sample_to_atlas_round_trip(affine):
+    matrix, offset = affine
+    transform = RegistrationTransform(
+        make_affine_field(downsampled_shape, matrix, offset),
+        atlas_resolution,
+        "asr",
+        "asr",
+        scaling=(0.5, 0.25, 0.25),
+        chunk_size=100,
+    )
+    rng = np.random.default_rng(0)
+    raw_points = rng.uniform(8, 60, size=(500, 3))
+    raw_points[:, 0] /= 2
+
+    atlas_points = transform.sample_to_atlas(raw_points)
+    downsampled_points = (raw_points + 0.5) * transform.scaling - 0.5
+    expected = downsampled_points @ matrix.T + offset
+    np.testing.assert_allclose(atlas_points, expected, atol=1e-3)
+
+    np.testing.assert_allclose(
+        transform.atlas_to_sample(atlas_points), raw_points, atol=0.1
+    )
+
+
+def test_points_outside_field_are_nan(affine):
+    matrix, offset = affine
+    transform = RegistrationTransform(
+        make_affine_field(downsampled_shape, matrix, offset),
+        atlas_resolution,
+        "asr",
+        "asr",
+        scaling=(1, 1, 1),
+    )
+    atlas_points = transform.sample_to_atlas(np.array([[-5.0, 1, 1]]))
+    assert np.isnan(atlas_points).all()
+
+    sample_points = transform.atlas_to_sample(np.array([[500.0, 1, 1]]))
+    assert np.isnan(sample_points).all()
+
+
+def test_points_at_edge_of_volume(affine):
+    matrix, offset = affine
+    shape = (4, 6, 5)
+    # ten raw voxels per downsampled voxel
+    scaling = (0.1, 0.1, 0.1)
+    raw_shape = (40, 60, 50)
+    transform = RegistrationTransform(
+        make_affine_field(shape, matrix, offset),
+        atlas_resolution,
+        "asr",
+        "asr",
+        scaling=scaling,
+    )
+    raw_points = np.array(
+        [[0, 0, 0], [39, 59, 49], [35, 2, 45], [31, 57, 3], [20, 30, 25]],
+        dtype=np.float64,
+    )
+    downsampled_points = transform.raw_to_downsampled(raw_points)
+    np.testing.assert_allclose(downsampled_points[0], [0, 0, 0])
+    np.testing.assert_allclose(downsampled_points[1], np.array(shape) - 1)
+    np.testing.assert_allclose(downsampled_points[4], [1.55, 2.55, 2.05])
+
+    atlas_points = transform.sample_to_atlas(raw_points)
+    assert np.all(np.isfinite(atlas_points))
+    np.testing.assert_allclose(
+        atlas_points, downsampled_points @ matrix.T + offset, atol=1e-3
+    )
+    # points away from the edge come back to where they started
+    np.testing.assert_allclose(
+        transform.atlas_to_sample(atlas_points[4:]), raw_points[4:], atol=0.1
+    )
+
+    # only points outside the raw image are NaN
+    outside = np.array([[-1, 0, 0], [40, 0, 0], [0, 60, 0]], dtype=float)
+    assert np.isnan(transform.sample_to_atlas(outside)).all()
+    assert np.isfinite(
+        transform.sample_to_atlas(np.array(raw_shape)[np.newaxis] - 1)
+    ).all()
+
+
+def test_points_must_be_n_by_3(affine):
+    matrix, offset = affine
+    transform = RegistrationTransform(
+        make_affine_field(downsampled_shape, matrix, offset),
+        atlas_resolution,
+        "asr",
+        "asr",
+        scaling=(1, 1, 1),
+    )
+    with pytest.raises(ValueError):
+        transform.sample_to_atlas(np.zeros((10, 2)))
+
+
+def test_points_converging_on_last_iteration(affine):
+    matrix, offset = affine
+    transform = RegistrationTransform(
+        make_affine_field(downsampled_shape, matrix, offset),
+        atlas_resolution,
+        "asr",
+        "asr",
+        scaling=(1, 1, 1),
+    )
+    downsampled_points = np.array([[10.3, 20.6, 7.2], [15.5, 12.1, 9.9]])
+    atlas_points = downsampled_points @ matrix.T + offset
+    # a single Newton step solves an affine field exactly
+    np.testing.assert_allclose(
+        transform._atlas_to_downsampled(atlas_points, max_iterations=1),
+        downsampled_points,
+        atol=0.01,
+    )
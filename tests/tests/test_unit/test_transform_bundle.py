@@ -0,0 +1,240 @@
+from types import SimpleNamespace
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from brainreg.core.backend.niftyreg.transform_bundle import (
+    SPLINE_VELOCITY_GRID,
+    ControlPointGrid,
+    DenseDeformationField,
+    TransformBundle,
+    save_transform_bundle,
+)
+from brainreg.core.paths import Paths
+from brainreg.core.transform import load_deformation_field
+
+REFERENCE_SHAPE = (20, 16, 18)
+# 50um voxels, in mm
+REFERENCE_AFFINE = np.diag([0.05, 0.05, 0.05, 1])
+# a control point every 5 voxels, starting one spacing before the origin,
+# as saved by reg_f3d
+GRID_AFFINE = np.array(
+    [
+        [0.25, 0, 0, -0.25],
+        [0, 0.25, 0, -0.25],
+        [0, 0, 0.25, -0.25],
+        [0, 0, 0, 1],
+    ]
+)
+GRID_SHAPE = (7, 7, 7)
+MATRIX = np.array([[1.1, 0.1, 0], [0, 0.9, 0.05], [0.02, 0, 1.0]])
+OFFSET = np.array([0.2, -0.1, 0.3])
+
+
+def linear_coefficients():
+    # a cubic B-spline with coefficients sampled from an affine transform
+    # reproduces that transform exactly
+    indices = np.stack(np.indices(GRID_SHAPE), axis=-1).reshape(-1, 3)
+    grid_positions = indices @ GRID_AFFINE[:3, :3].T + GRID_AFFINE[:3, 3]
+    return (grid_positions @ MATRIX.T + OFFSET).reshape(*GRID_SHAPE, 3)
+
+
+def expected_positions(points):
+    return (points @ REFERENCE_AFFINE[:3, :3].T) @ MATRIX.T + OFFSET
+
+
+def save_grid(path, coefficients, transformation_type=2):
+    image = nib.Nifti1Image(
+        coefficients.reshape(*coefficients.shape[:3], 1, 3).astype(np.float32),
+        GRID_AFFINE,
+    )
+    # NIFTI_INTENT_VECTOR, with the niftyreg transformation type
+    image.header.set_intent("vector", name="NREG_TRANS")
+    image.header["intent_p1"] = transformation_type
+    nib.save(image, str(path))
+
+
+@pytest.fixture
+def grid():
+    return ControlPointGrid(
+        linear_coefficients(), GRID_AFFINE, REFERENCE_AFFINE, REFERENCE_SHAPE
+    )
+
+
+def test_transform_points(grid):
+    rng = np.random.default_rng(0)
+    points = rng.random((100, 3)) * (np.array(REFERENCE_SHAPE) - 1)
+    np.testing.assert_allclose(
+        grid.transform(points), expected_positions(points), atol=1e-6
+    )
+    np.testing.assert_allclose(
+        grid.displacement(points),
+        expected_positions(points) - points * 0.05,
+        atol=1e-6,
+    )
+
+
+def test_transform_outside_grid(grid):
+    positions = grid.transform(np.array([[-20.0, 1, 1], [1.0, 1, 1]]))
+    assert np.all(np.isnan(positions[0]))
+    assert np.all(np.isfinite(positions[1]))
+
+
+def test_deformation_field(grid):
+    field = grid.deformation_field()
+    assert field.shape == (*REFERENCE_SHAPE, 3)
+    assert field.dtype == np.float32
+    indices = np.stack(np.indices(REFERENCE_SHAPE), axis=-1)
+    np.testing.assert_allclose(
+        field,
+        expected_positions(indices.reshape(-1, 3)).reshape(field.shape),
+        atol=1e-5,
+    )
+
+    # sub-volumes, and the dense and point evaluations, agree
+    np.testing.assert_allclose(
+        grid.deformation_field((3, 2, 5), (11, 9, 17)),
+        field[3:11, 2:9, 5:17],
+        atol=1e-6,
+    )
+    np.testing.assert_allclose(
+        grid.transform(indices[4:6, 3:5, 1:8].reshape(-1, 3)),
+        field[4:6, 3:5, 1:8].reshape(-1, 3),
+        atol=1e-6,
+    )
+    slabs = np.concatenate(
+        [slab for _, _, slab in grid.iter_deformation_field(slab_size=6)]
+    )
+    np.testing.assert_array_equal(slabs, field)
+
+
+@pytest.fixture
+def niftyreg_paths(tmp_path):
+    niftyreg_directory = tmp_path / "niftyreg"
+    niftyreg_directory.mkdir()
+    niftyreg_paths = SimpleNamespace(
+        control_point_file_path=niftyreg_directory / "control_point_file.nii",
+        inverse_control_point_file_path=niftyreg_directory
+        / "inverse_control_point_file.nii",
+        backward_control_point_file_path=niftyreg_directory
+        / "control_point_file_backward.nii",
+        affine_matrix_path=niftyreg_directory / "affine_matrix.txt",
+        invert_affine_matrix_path=niftyreg_directory
+        / "invert_affine_matrix.txt",
+        downsampled_filtered=niftyreg_directory / "downsampled_filtered.nii",
+        brain_filtered=niftyreg_directory / "brain_filtered.nii",
+    )
+    for path in (
+        niftyreg_paths.control_point_file_path,
+        niftyreg_paths.inverse_control_point_file_path,
+    ):
+        save_grid(path, linear_coefficients())
+    save_grid(
+        niftyreg_paths.backward_control_point_file_path,
+        linear_coefficients(),
+        transformation_type=SPLINE_VELOCITY_GRID,
+    )
+    np.savetxt(niftyreg_paths.affine_matrix_path, np.eye(4))
+    np.savetxt(niftyreg_paths.invert_affine_matrix_path, 2 * np.eye(4))
+    for path in (
+        niftyreg_paths.downsampled_filtered,
+        niftyreg_paths.brain_filtered,
+    ):
+        nib.save(
+            nib.Nifti1Image(
+                np.zeros(REFERENCE_SHAPE, dtype=np.float32), REFERENCE_AFFINE
+            ),
+            str(path),
+        )
+    return niftyreg_paths
+
+
+def test_transform_bundle(tmp_path, niftyreg_paths):
+    paths = Paths(tmp_path)
+    save_transform_bundle(
+        niftyreg_paths, paths.transform_directory, "freeform"
+    )
+
+    bundle = TransformBundle(paths.transform_directory)
+    assert bundle.has_inverse
+    np.testing.assert_array_equal(bundle.affine, np.eye(4))
+    np.testing.assert_array_equal(bundle.inverse_affine, 2 * np.eye(4))
+    np.testing.assert_allclose(
+        bundle.inverse.deformation_field(),
+        bundle.forward.deformation_field(),
+    )
+
+    # without a saved deformation field, it is evaluated from the grid
+    np.testing.assert_array_equal(
+        load_deformation_field(paths), bundle.forward.deformation_field()
+    )
+
+
+def test_transform_bundle_without_inverse(tmp_path, niftyreg_paths):
+    bundle_directory = tmp_path / "transform"
+    save_transform_bundle(niftyreg_paths, bundle_directory, "freeform")
+    save_transform_bundle(niftyreg_paths, bundle_directory, "invert")
+
+    bundle = TransformBundle(bundle_directory)
+    assert not bundle.has_inverse
+    assert bundle.inverse is None
+    assert bundle.inverse_affine is None
+    assert not (bundle_directory / "inverse_control_point_file.nii").exists()
+
+
+def test_velocity_grid(tmp_path, niftyreg_paths):
+    # a constant velocity integrates to a translation
+    translation = np.array([0.1, -0.05, 0.02])
+    indices = np.stack(np.indices(GRID_SHAPE), axis=-1)
+    grid_positions = indices @ GRID_AFFINE[:3, :3].T + GRID_AFFINE[:3, 3]
+    save_grid(
+        niftyreg_paths.backward_control_point_file_path,
+        grid_positions + translation,
+        transformation_type=SPLINE_VELOCITY_GRID,
+    )
+    paths = Paths(tmp_path)
+    save_transform_bundle(
+        niftyreg_paths, paths.transform_directory, "symmetric"
+    )
+
+    velocity_field = TransformBundle(paths.transform_directory).inverse
+    assert isinstance(velocity_field, DenseDeformationField)
+    field = velocity_field.deformation_field()
+    assert field.shape == (*REFERENCE_SHAPE, 3)
+    assert field.dtype == np.float32
+    indices = np.stack(np.indices(REFERENCE_SHAPE), axis=-1)
+    np.testing.assert_allclose(
+        field, indices @ REFERENCE_AFFINE[:3, :3].T + translation, atol=1e-5
+    )
+    np.testing.assert_array_equal(
+        velocity_field.deformation_field((3, 2, 5), (11, 9, 17)),
+        field[3:11, 2:9, 5:17],
+    )
+
+    points = np.array([[2.5, 3.25, 7.75], [-5.0, 1, 1]])
+    positions = velocity_field.transform(points)
+    np.testing.assert_allclose(
+        positions[0], points[0] * 0.05 + translation, atol=1e-5
+    )
+    assert np.all(np.isnan(positions[1]))
+
+
+def test_grid_coordinates_on_control_points():
+    # reference voxel 0 is on the first control point inside the grid, but
+    # a float32 affine puts it at a grid coordinate just below 1
+    reference_affine = REFERENCE_AFFINE.copy()
+    reference_affine[:3, 3] = -1.5e-8
+    grid = ControlPointGrid(
+        linear_coefficients(), GRID_AFFINE, reference_affine, REFERENCE_SHAPE
+    )
+    assert grid._to_grid(np.zeros((1, 3)))[0, 0] < 1
+
+    field = grid.deformation_field()
+    assert np.all(np.isfinite(field))
+    indices = np.stack(np.indices(REFERENCE_SHAPE), axis=-1).reshape(-1, 3)
+    np.testing.assert_allclose(
+        grid.transform(indices),
+        expected_positions(indices),
+        atol=1e-5,
+    )
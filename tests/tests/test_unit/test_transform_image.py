@@ -0,0 +1,202 @@
+import json
+import sys
+from argparse import ArgumentTypeError
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import tifffile
+from brainglobe_utils.IO.image.save import to_tiff
+
+from brainreg.core.cli import main as brainreg_run
+from brainreg.core.paths import Paths
+from brainreg.core.transform_image import (
+    RawImageReader,
+    check_tile_size,
+    get_output_shape,
+    sample_raw_image,
+)
+
+atlas_shape = (12, 14, 10)
+atlas_resolution = (100, 100, 100)
+
+
+@pytest.fixture
+def fake_atlas():
+    return SimpleNamespace(
+        resolution=atlas_resolution,
+        shape=atlas_shape,
+        metadata={"orientation": "asr"},
+    )
+
+
+@pytest.fixture
+def registration_directory(tmp_path):
+    """
+    A registration where the sample, at atlas resolution, is the atlas
+    shifted by one voxel along the first axis.
+    """
+    paths = Paths(tmp_path)
+    with open(paths.metadata_path, "w") as f:
+        json.dump(
+            {
+                "atlas": "fake_atlas",
+                "orientation": "asr",
+                "voxel_sizes": ["50", "50", "50"],
+            },
+            f,
+        )
+    grid = list(
+        np.meshgrid(*[np.arange(n) for n in atlas_shape], indexing="ij")
+    )
+    grid[0] = grid[0] + 1.0
+    for axis, path in enumerate(
+        [
+            paths.deformation_field_0,
+            paths.deformation_field_1,
+            paths.deformation_field_2,
+        ]
+    ):
+        to_tiff(
+            (grid[axis] * atlas_resolution[axis] / 1000).astype(np.float32),
+            path,
+        )
+    return tmp_path
+
+
+def test_get_output_shape(fake_atlas):
+    shape, output_to_atlas = get_output_shape(fake_atlas, [50])
+    assert shape == (24, 28, 20)
+    np.testing.assert_array_equal(output_to_atlas, [0.5, 0.5, 0.5])
+
+    shape, _ = get_output_shape(fake_atlas, None)
+    assert shape == atlas_shape
+
+
+def test_sample_raw_image_outside_is_zero():
+    raw = np.arange(27, dtype=np.uint16).reshape(3, 3, 3)
+    points = np.array([[1, 1, 1], [np.nan, 0, 0], [10, 0, 0]], dtype=float)
+    values = sample_raw_image(raw, points, interpolation_order=0)
+    np.testing.assert_array_equal(values, [13, 0, 0])
+
+
+class PlaneReader:
+    """
+    An image that is read lazily, one plane at a time, counting the planes
+    read.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.shape = image.shape
+        self.dtype = image.dtype
+        self.planes_read = []
+
+    def __getitem__(self, key):
+        self.planes_read.append(key)
+        return self.image[key]
+
+
+def test_raw_image_reader_caches_planes():
+    image = np.arange(5 * 4 * 3, dtype=np.uint16).reshape(5, 4, 3)
+    lazy_image = PlaneReader(image)
+    plane_bytes = 4 * 3 * 2
+    reader = RawImageReader(lazy_image, cache_size=3 * plane_bytes)
+
+    np.testing.assert_array_equal(
+        reader.read_block((0, 1, 0), (2, 3, 2)), image[0:2, 1:3, 0:2]
+    )
+    np.testing.assert_array_equal(
+        reader.read_block((1, 0, 1), (4, 4, 3)), image[1:4, 0:4, 1:3]
+    )
+    assert lazy_image.planes_read == [0, 1, 2, 3]
+
+    # plane 0 was dropped, to keep to the cache size
+    reader.read_block((0, 0, 0), (1, 1, 1))
+    assert lazy_image.planes_read == [0, 1, 2, 3, 0]
+
+    # blocks larger than the cache are read directly
+    np.testing.assert_array_equal(
+        reader.read_block((0, 0, 0), (5, 2, 2)), image[:, :2, :2]
+    )
+    assert len(lazy_image.planes_read) == 6
+
+    # arrays (including memory maps) are not cached
+    assert RawImageReader(image, cache_size=10 * plane_bytes).max_planes == 0
+
+
+def run_transform_image(registration_directory, raw_path, output_path, *args):
+    sys.argv = [
+        "brainreg",
+        "transform-image",
+        str(registration_directory),
+        str(raw_path),
+        str(output_path),
+        "--slab-size",
+        "3",
+        "--interpolation-order",
+        "0",
+        *args,
+    ]
+    brainreg_run()
+    return tifffile.imread(output_path)
+
+
+def test_transform_image(registration_directory, fake_atlas, mocker, tmp_path):
+    mocker.patch(
+        "brainreg.core.transform_image.BrainGlobeAtlas",
+        return_value=fake_atlas,
+    )
+    # raw data at twice the atlas resolution, where each 2 x 2 x 2 block
+    # of raw voxels (one sample voxel) has the same value
+    rng = np.random.default_rng(0)
+    sample = rng.integers(0, 1000, size=atlas_shape, dtype=np.uint16)
+    raw = sample.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+    raw_path = tmp_path / "raw.tiff"
+    to_tiff(raw, raw_path)
+    output_path = tmp_path / "output" / "standard.tiff"
+
+    output = run_transform_image(registration_directory, raw_path, output_path)
+    with tifffile.TiffFile(output_path) as tiff:
+        assert tiff.pages[0].is_tiled
+    assert output.shape == atlas_shape
+    assert output.dtype == np.uint16
+    # atlas voxel i along the first axis is sample voxel i - 1
+    np.testing.assert_array_equal(output[1:], sample[:-1])
+    assert not output[0].any()
+
+
+def test_transform_image_in_tiles(
+    registration_directory, fake_atlas, mocker, tmp_path
+):
+    mocker.patch(
+        "brainreg.core.transform_image.BrainGlobeAtlas",
+        return_value=fake_atlas,
+    )
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 1000, size=(24, 28, 20), dtype=np.uint16)
+    raw_path = tmp_path / "raw.tiff"
+    to_tiff(raw, raw_path)
+
+    # output planes of 56 x 40 voxels, in 4 x 3 tiles
+    whole = run_transform_image(
+        registration_directory, raw_path, tmp_path / "whole.tiff", "-r", "25"
+    )
+    tiled = run_transform_image(
+        registration_directory,
+        raw_path,
+        tmp_path / "tiled.tiff",
+        "-r",
+        "25",
+        "--tile-size",
+        "16",
+    )
+    assert whole.shape == (48, 56, 40)
+    assert whole.any()
+    np.testing.assert_array_equal(tiled, whole)
+
+
+def test_check_tile_size():
+    assert check_tile_size("32") == 32
+    with pytest.raises(ArgumentTypeError):
+        check_tile_size("20")
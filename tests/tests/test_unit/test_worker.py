@@ -0,0 +1,120 @@
+import json
+import os
+
+import pytest
+
+from brainreg.core.worker import (
+    CLAIMED,
+    DONE,
+    FAILED,
+    PENDING,
+    STALE,
+    TaskQueue,
+    run_task,
+    run_worker,
+)
+
+
+def add_task(queue_directory, name, args):
+    with open(queue_directory / f"{name}.json", "w") as f:
+        json.dump({"args": args}, f)
+
+
+@pytest.fixture
+def queue_directory(tmp_path):
+    add_task(tmp_path, "brain_1", ["--version"])
+    add_task(tmp_path, "brain_2", [])
+    return tmp_path
+
+
+def make_stale(path, age=1000):
+    mtime = os.stat(path).st_mtime - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_claims_are_exclusive(queue_directory):
+    worker_1 = TaskQueue(queue_directory, worker_id="worker_1")
+    worker_2 = TaskQueue(queue_directory, worker_id="worker_2")
+
+    assert worker_1.tasks() == ["brain_1", "brain_2"]
+    assert worker_1.status("brain_1") == PENDING
+
+    claim_1 = worker_1.claim_next()
+    claim_2 = worker_2.claim_next()
+    assert claim_1.name == "brain_1"
+    assert claim_2.name == "brain_2"
+    assert worker_2.status("brain_1") == CLAIMED
+    assert worker_2.claim("brain_1") is None
+    assert worker_2.claim_next() is None
+
+
+def test_stale_claim_is_recovered(queue_directory):
+    crashed = TaskQueue(queue_directory, worker_id="crashed")
+    worker = TaskQueue(queue_directory, stale_timeout=60, worker_id="worker")
+
+    claim = crashed.claim("brain_1")
+    assert worker.claim("brain_1") is None
+
+    make_stale(claim.path)
+    assert worker.status("brain_1") == STALE
+    recovered = worker.claim("brain_1")
+    assert recovered is not None
+    with open(recovered.path) as f:
+        assert f.read() == "worker"
+
+
+def test_heartbeat_keeps_claim_fresh(queue_directory):
+    queue = TaskQueue(
+        queue_directory, stale_timeout=60, heartbeat_interval=0.01
+    )
+    claim = queue.claim("brain_1")
+    make_stale(claim.path)
+    with claim:
+        for _ in range(100):
+            if queue.status("brain_1") == CLAIMED:
+                break
+            claim._stop.wait(0.01)
+        assert queue.status("brain_1") == CLAIMED
+    assert not os.path.exists(claim.path)
+
+
+def test_run_task(queue_directory):
+    queue = TaskQueue(queue_directory)
+
+    assert run_task(queue, queue.claim("brain_1")) == 0
+    assert queue.status("brain_1") == DONE
+    assert queue.claim("brain_1") is None
+
+    # missing the required arguments
+    assert run_task(queue, queue.claim("brain_2")) != 0
+    assert queue.status("brain_2") == FAILED
+    with open(queue_directory / "brain_2.failed") as f:
+        assert json.load(f)["returncode"] != 0
+
+
+def test_run_worker(queue_directory):
+    (queue_directory / "brain_3.json").write_text("not json")
+    assert run_worker(queue_directory) == (3, 2)
+    assert TaskQueue(queue_directory).unfinished() == []
+
+
+def test_claim_taken_over_is_left_alone(queue_directory):
+    slow = TaskQueue(
+        queue_directory, heartbeat_interval=0.01, worker_id="slow"
+    )
+    worker = TaskQueue(queue_directory, stale_timeout=60, worker_id="worker")
+
+    claim = slow.claim("brain_1")
+    make_stale(claim.path)
+    taken_over = worker.claim("brain_1")
+    assert taken_over is not None
+    assert not claim.is_owned()
+    assert taken_over.is_owned()
+
+    make_stale(claim.path)
+    assert run_task(slow, claim) == 0
+    # the slow worker neither refreshed, removed, nor finished the claim
+    assert os.path.exists(taken_over.path)
+    assert worker.status("brain_1") == STALE
+    with open(taken_over.path) as f:
+        assert f.read() == "worker"
@@ -0,0 +1,73 @@
+import threading
+
+import brainglobe_space as bg
+import numpy as np
+import pytest
+from brainglobe_utils.IO.image.load import load_any
+
+from brainreg.core.utils.writer import AsyncWriter, OutputWriteError
+
+
+@pytest.mark.parametrize("n_threads", [0, 2])
+def test_write_tiff(tmp_path, n_threads):
+    images = [np.full((3, 4, 5), i, dtype=np.uint16) for i in range(5)]
+    with AsyncWriter(n_threads=n_threads, max_pending=2) as writer:
+        for i, image in enumerate(images):
+            writer.write_tiff(image, tmp_path / f"image_{i}.tiff")
+        writer.wait(tmp_path / "image_0.tiff")
+        np.testing.assert_array_equal(
+            load_any(tmp_path / "image_0.tiff"), images[0]
+        )
+
+    for i, image in enumerate(images):
+        np.testing.assert_array_equal(
+            load_any(tmp_path / f"image_{i}.tiff"), image
+        )
+
+
+def test_pending_writes_are_bounded(tmp_path):
+    release = threading.Event()
+    n_running = []
+
+    def slow_write(data, dest_path):
+        n_running.append(data)
+        release.wait()
+
+    writer = AsyncWriter(n_threads=4, max_pending=2)
+    writer.write(slow_write, 0, tmp_path / "0")
+    writer.write(slow_write, 1, tmp_path / "1")
+
+    third = threading.Thread(
+        target=writer.write, args=(slow_write, 2, tmp_path / "2")
+    )
+    third.start()
+    third.join(timeout=0.2)
+    # blocked until one of the first two writes has finished
+    assert third.is_alive()
+
+    release.set()
+    third.join()
+    writer.close()
+    assert sorted(n_running) == [0, 1, 2]
+
+
+def test_errors_are_raised(tmp_path):
+    def failing_write(data, dest_path):
+        raise OSError("disk full")
+
+    writer = AsyncWriter()
+    writer.write(failing_write, None, tmp_path / "image.tiff")
+    with pytest.raises(OutputWriteError, match="image.tiff"):
+        writer.close()
+
+
+def test_write_reoriented_tiff(tmp_path):
+    image = np.arange(3 * 4 * 5, dtype=np.uint16).reshape(3, 4, 5)
+    # a transposed and flipped view, written without a contiguous copy
+    reoriented = bg.map_stack_to("asr", "lip", image)
+    assert not reoriented.flags.c_contiguous
+    with AsyncWriter(n_threads=0) as writer:
+        writer.write_tiff(reoriented, tmp_path / "reoriented.tiff")
+    np.testing.assert_array_equal(
+        load_any(tmp_path / "reoriented.tiff"), reoriented
+    )